@@ -0,0 +1,331 @@
+"""
+上游调用的准入控制
+
+原先所有 LLM 和搜索调用都直接发往上游，没有全局并发上限。突发流量时请求
+在上游和连接池里越积越多，最后一起超时。这里分别为 LLM 调用和搜索调用设置
+并发上限：
+- 超出上限的调用在有界的等待队列中按优先级排队：交互式的 /api/chat/stream
+  优先于 /chat 等 API 调用，API 调用优先于批量任务（请求头
+  X-Request-Priority: batch）
+- 队列已满时，新来的高优先级调用挤掉队尾优先级最低的等待者；没有更低优先级
+  的等待者时直接拒绝新调用
+- 按近期调用的平均耗时估算排队时间，超过 ADMISSION_MAX_WAIT 时立即拒绝；
+  实际等待超过 ADMISSION_MAX_WAIT 同样拒绝
+- 被拒绝的调用抛出 AdmissionRejected，接口据此返回 503 和 Retry-After
+
+请求的优先级保存在 contextvar 中，同一请求内的工具调用、摘要生成等上游调用
+自动继承。
+
+并发上限是整台机器的值。多 worker 时各 worker 的并发数记在 shared_state 的
+计数器中，获取名额时按所有 worker 的合计判断是否超限；排队的调用轮询计数器，
+其他 worker 释放名额后即可获得。优先级只在同一 worker 的等待队列内生效。
+各 worker 定期为自己的计数续期，worker 异常退出后它占用的名额在 _SHARED_TTL
+秒后释放。
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from shared_state import SharedState, shared_state
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_API = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_API: "api",
+    PRIORITY_BATCH: "batch",
+}
+
+# 整台机器的 LLM / 搜索并发上限
+ADMISSION_LLM_LIMIT = int(os.getenv("ADMISSION_LLM_LIMIT", "32"))
+ADMISSION_SEARCH_LIMIT = int(os.getenv("ADMISSION_SEARCH_LIMIT", "32"))
+# 每类调用的等待队列长度
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+# 最长排队时间（秒）
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+
+# 估算排队时间时使用的平均调用耗时的初始值（秒）和平滑系数
+_INITIAL_HOLD_SECONDS = 1.0
+_HOLD_EWMA_ALPHA = 0.2
+# 多 worker 时：排队期间轮询共享计数器的间隔、为本 worker 的计数续期的间隔和计数的过期时间（秒）
+_SHARED_POLL_INTERVAL = 0.05
+_SHARED_SYNC_INTERVAL = 1.0
+_SHARED_TTL = 10.0
+
+_current_priority = contextvars.ContextVar("request_priority", default=PRIORITY_API)
+
+
+def get_priority() -> int:
+    return _current_priority.get()
+
+
+def set_priority(priority: int):
+    """设置当前请求（及其派生任务）的优先级"""
+    _current_priority.set(priority)
+
+
+def parse_priority(value: Optional[str], default: int) -> int:
+    """解析 X-Request-Priority 请求头，只允许调低优先级"""
+    if value and value.strip().lower() == PRIORITY_NAMES[PRIORITY_BATCH]:
+        return PRIORITY_BATCH
+    return default
+
+
+class AdmissionRejected(Exception):
+    """上游调用排队超限，被拒绝"""
+
+    def __init__(self, name: str, retry_after: float, reason: str):
+        super().__init__(f"服务繁忙（{name} {reason}），请 {math.ceil(retry_after)} 秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    带优先级等待队列的并发上限
+
+    Args:
+        shared: 多 worker 共享状态，不为空时 limit 是所有 worker 合计的上限
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int = ADMISSION_MAX_QUEUE,
+                 max_wait: float = ADMISSION_MAX_WAIT, shared: Optional[SharedState] = None):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.shared = shared
+        self.in_flight = 0  # 本 worker 占用的名额
+        self.total_in_flight = 0  # 所有 worker 占用的名额（多 worker 时是最近一次读到的合计）
+        self._counter_key = f"admission:{name}:in_flight"
+        self._sync_task: Optional[asyncio.Task] = None
+        self._sync_wakeup: Optional[asyncio.Event] = None
+        self._pending = set()  # 未完成的共享计数器写入
+        self._queue = []  # [priority, seq, future]，已结束的 future 延迟清理
+        self._seq = itertools.count()
+        self._avg_hold = _INITIAL_HOLD_SECONDS
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_wait": 0,
+            "rejected_full": 0,
+            "rejected_timeout": 0,
+            "evicted": 0,
+        }
+
+    def _waiters(self) -> list:
+        return [entry for entry in self._queue if not entry[2].done()]
+
+    def estimate_wait(self, priority: int) -> float:
+        """按排在前面的等待者数量和平均调用耗时估算排队时间（秒）"""
+        if self.total_in_flight < self.limit and not self._waiters():
+            return 0.0
+        ahead = sum(1 for entry in self._waiters() if entry[0] <= priority)
+        return (ahead + 1) * self._avg_hold / self.limit
+
+    def check(self, priority: int):
+        """
+        在接受请求之前检查是否会被拒绝（不占用名额）
+
+        Raises:
+            AdmissionRejected: 预计排队时间超过上限时
+        """
+        wait = self.estimate_wait(priority)
+        if wait > self.max_wait:
+            self.stats["rejected_wait"] += 1
+            raise AdmissionRejected(self.name, wait, "预计排队时间过长")
+
+    def _reject(self, counter: str, reason: str, retry_after: Optional[float] = None):
+        self.stats[counter] += 1
+        logger.warning(f"🚦 {self.name} 调用被拒绝: {reason}")
+        raise AdmissionRejected(self.name, retry_after or self.max_wait, reason)
+
+    async def acquire(self, priority: int):
+        """
+        获取一个并发名额，必要时按优先级排队
+
+        Raises:
+            AdmissionRejected: 队列已满、预计或实际排队时间超过上限时
+        """
+        if self.shared is not None:
+            self._ensure_sync_task()
+        waiters = self._waiters()
+        if not waiters and await self._take():
+            self.stats["admitted"] += 1
+            return
+
+        self.check(priority)
+        if len(waiters) >= self.max_queue:
+            # 队列已满：挤掉优先级最低、最晚到达的等待者，没有更低优先级的则拒绝新调用
+            victim = max(waiters, key=lambda entry: (entry[0], entry[1]))
+            if victim[0] <= priority:
+                self._reject("rejected_full", "等待队列已满")
+            victim[2].set_exception(AdmissionRejected(self.name, self.max_wait, "被更高优先级的请求挤出队列"))
+            self.stats["evicted"] += 1
+            logger.warning(f"🚦 {self.name} 调用被更高优先级的请求挤出队列")
+
+        self._queue = self._waiters()
+        heapq.heapify(self._queue)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, [priority, next(self._seq), future])
+        self.stats["queued"] += 1
+        if self.shared is not None:
+            self._sync_wakeup.set()
+        # 不用 wait_for：名额转交过来的同时被取消时，wait_for 可能吞掉取消
+        timer = asyncio.get_running_loop().call_later(self.max_wait, self._expire, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        finally:
+            timer.cancel()
+        self.stats["admitted"] += 1
+
+    async def _take(self) -> bool:
+        """未超过上限时占用一个名额"""
+        if self.shared is None:
+            if self.in_flight >= self.limit:
+                return False
+        else:
+            write = asyncio.ensure_future(asyncio.to_thread(
+                self.shared.counter_add, self._counter_key, 1, self.limit, _SHARED_TTL
+            ))
+            try:
+                taken, self.total_in_flight = await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # 写入仍会完成，完成后归还已经增加的计数
+                write.add_done_callback(self._undo_take)
+                raise
+            if not taken:
+                return False
+        self.in_flight += 1
+        if self.shared is None:
+            self.total_in_flight = self.in_flight
+        return True
+
+    def _undo_take(self, write: asyncio.Future):
+        if not write.cancelled() and write.exception() is None and write.result()[0]:
+            self._release_shared()
+
+    def _expire(self, future: asyncio.Future):
+        """排队超时，拒绝仍在等待的调用"""
+        if not future.done():
+            self.stats["rejected_timeout"] += 1
+            logger.warning(f"🚦 {self.name} 调用被拒绝: 排队超时")
+            future.set_exception(AdmissionRejected(self.name, self.max_wait, "排队超时"))
+
+    def _abandon(self, future: asyncio.Future):
+        """放弃等待；如果名额恰好已经转交过来，则归还"""
+        if future.done():
+            if not future.cancelled() and future.exception() is None:
+                self.release(0.0)
+        else:
+            future.cancel()
+
+    def release(self, held_seconds: Optional[float] = None):
+        """归还名额，直接转交给优先级最高的等待者"""
+        if held_seconds:
+            self._avg_hold += _HOLD_EWMA_ALPHA * (held_seconds - self._avg_hold)
+        if self._hand_over():
+            return
+        self.in_flight -= 1
+        if self.shared is None:
+            self.total_in_flight = self.in_flight
+        else:
+            self._release_shared()
+
+    def _hand_over(self) -> bool:
+        """把本 worker 占用的一个名额转交给优先级最高的等待者"""
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(True)
+                return True
+        return False
+
+    def _release_shared(self):
+        task = asyncio.get_running_loop().create_task(self._shared_release())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _shared_release(self):
+        try:
+            _, self.total_in_flight = await asyncio.to_thread(
+                self.shared.counter_add, self._counter_key, -1, None, _SHARED_TTL
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ {self.name} 归还共享并发计数失败: {e}")
+
+    def _ensure_sync_task(self):
+        loop = asyncio.get_running_loop()
+        if self._sync_task is None or self._sync_task.done() or self._sync_task.get_loop() is not loop:
+            self._sync_wakeup = asyncio.Event()
+            self._sync_task = loop.create_task(self._sync_loop())
+
+    async def _sync_loop(self):
+        """
+        多 worker 时的后台任务
+
+        - 有调用在排队时轮询共享计数器：其他 worker 释放名额不会通知到这里
+        - 定期为本 worker 的计数续期
+        """
+        last_sync = 0.0
+        while True:
+            self._sync_wakeup.clear()
+            try:
+                while self._waiters() and await self._take():
+                    if not self._hand_over():
+                        self.release(0.0)
+                if time.monotonic() - last_sync >= _SHARED_SYNC_INTERVAL:
+                    self.total_in_flight = await asyncio.to_thread(
+                        self.shared.counter_touch, self._counter_key, _SHARED_TTL
+                    )
+                    last_sync = time.monotonic()
+            except Exception as e:
+                logger.warning(f"⚠️ {self.name} 同步共享并发计数失败: {e}")
+            try:
+                await asyncio.wait_for(
+                    self._sync_wakeup.wait(), _SHARED_POLL_INTERVAL if self._waiters() else _SHARED_SYNC_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[int] = None):
+        """在 async with 范围内占用一个名额，priority 为空时使用当前请求的优先级"""
+        await self.acquire(get_priority() if priority is None else priority)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started_at)
+
+    def get_stats(self) -> dict:
+        waiters = self._waiters()
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "total_in_flight": self.total_in_flight,
+            "waiting": {
+                name: sum(1 for entry in waiters if entry[0] == priority)
+                for priority, name in PRIORITY_NAMES.items()
+            },
+            "avg_hold_seconds": round(self._avg_hold, 3),
+        }
+
+
+llm_admission = AdmissionController("llm", ADMISSION_LLM_LIMIT, shared=shared_state)
+search_admission = AdmissionController("search", ADMISSION_SEARCH_LIMIT, shared=shared_state)
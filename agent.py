@@ -0,0 +1,408 @@
+"""
+Agentic Loop 引擎
+
+/chat 和 /api/chat/stream 原先各有一份几乎相同的循环（payload 构建、工具调用
+轮次、强制生成最终答案），浏览器标签页关闭后，流式接口的生成器仍会把 LLM
+调用和搜索执行到底。这里把循环统一为一个引擎：
+- 每次对话是一个 AgentRun，在独立的 Task 中运行，通过队列依次产出事件：
+  round_started、content（文本增量）、tool_started、tool_finished、done
+- 流式模式逐段转发上游的文本增量；非流式模式使用请求对冲，在最后一次性产出
+  答案文本
+- 最多 MAX_TOOL_ROUNDS 轮工具调用，之后去掉 tools 并设置 tool_choice=none，
+  强制生成最终答案
+- run.cancel() 立即取消 Task：进行中的上游请求被中断（连接关闭），尚未完成
+  的工具调用被取消。接口在客户端断开连接时调用它
+- 配置了 speculator 时，第一轮 LLM 调用的同时推测执行可能需要的搜索，第一轮
+  工具调用时交给 prepare_tool_context 认领；没有被使用的推测在对话结束前取消
+
+每轮 LLM 调用都先查 LLM 响应缓存（use_cache 为 True 时）。
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+import metrics
+import upstream
+from hedging import llm_hedger
+from llm_cache import llm_cache
+from logging_setup import should_log_transcript, transcript_logger
+from speculative_search import CANCELLED, UNUSED, Speculation, SpeculativeSearch
+from tools import ToolExecutor, ToolRegistry
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# 最多允许的工具调用轮数
+MAX_TOOL_ROUNDS = 3
+
+ROUND_STARTED = "round_started"
+CONTENT = "content"
+TOOL_STARTED = "tool_started"
+TOOL_FINISHED = "tool_finished"
+DONE = "done"
+
+INVALID_RESPONSE = "AI Builder Space 返回了无效的响应格式"
+
+_END = object()
+
+
+class AgentError(Exception):
+    """上游返回了无法处理的响应"""
+
+
+class AgentCancelled(Exception):
+    """对话被取消（例如客户端断开连接）"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"对话已取消: {reason}")
+        self.reason = reason
+
+
+def build_payload(model: str, messages: List[dict], tools: List[dict],
+                  temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> dict:
+    """构建 chat/completions 请求体（GPT-5 的 temperature 固定为 1.0，并使用 max_completion_tokens）"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": 1.0 if model == "gpt-5" else (temperature or 0.7),
+        "tools": tools
+    }
+    if max_tokens:
+        payload["max_completion_tokens" if model == "gpt-5" else "max_tokens"] = max_tokens
+    return payload
+
+
+def _add_usage(total: Optional[dict], usage: Optional[dict]) -> Optional[dict]:
+    if not usage:
+        return total
+    if total is None:
+        return dict(usage)
+    for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        total[key] = total.get(key, 0) + usage.get(key, 0)
+    return total
+
+
+async def _single_chunk(chunk: dict):
+    yield chunk
+
+
+class AgentRun:
+    """
+    一次 Agentic Loop 的执行
+
+    通过 events() 依次读取事件，或用 result() 直接等待 done 事件。上游或工具
+    的异常会从 events() / result() 中抛出；被取消时抛出 AgentCancelled。
+    """
+
+    def __init__(self, engine: "AgentEngine", messages: List[dict], model: str, endpoint: str, stream: bool,
+                 use_cache: bool, temperature: Optional[float], max_tokens: Optional[int], started_at: float):
+        self.engine = engine
+        self.messages = messages
+        self.model = model
+        self.endpoint = endpoint
+        self.stream = stream
+        self.use_cache = use_cache
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.started_at = started_at
+        self.first_token_ms: Optional[float] = None
+        self.cancel_reason: Optional[str] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def done(self) -> bool:
+        return self._task.done()
+
+    def cancel(self, reason: str):
+        """取消对话：中断进行中的上游请求和工具调用"""
+        if self._task.done():
+            return
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+        self._task.cancel()
+
+    def _emit(self, event: dict):
+        self._queue.put_nowait(event)
+
+    async def events(self, close_reason: str = "consumer_closed") -> AsyncIterator[dict]:
+        """依次产出事件，迭代被提前关闭时以 close_reason 为原因取消对话"""
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.cancel(close_reason)
+
+    async def result(self) -> dict:
+        """等待对话完成，返回 done 事件"""
+        done = None
+        async for event in self.events():
+            if event["type"] == DONE:
+                done = event
+        if done is None:
+            raise AgentError(INVALID_RESPONSE)
+        return done
+
+    async def _run(self):
+        self.engine.stats["runs"] += 1
+        try:
+            await self._loop()
+        except asyncio.CancelledError:
+            reason = self.cancel_reason or "cancelled"
+            self.engine.stats["cancelled"] += 1
+            metrics.cancelled_turns_total.inc(endpoint=self.endpoint, reason=reason)
+            logger.info(f"🛑 Agentic Loop 已取消（{reason}），中断进行中的上游请求和工具调用")
+            self._queue.put_nowait(AgentCancelled(reason))
+            raise
+        except Exception as e:
+            self.engine.stats["failed"] += 1
+            self._queue.put_nowait(e)
+        else:
+            self.engine.stats["completed"] += 1
+            self._queue.put_nowait(_END)
+
+    async def _loop(self):
+        messages = self.messages
+        tools = self.engine.registry.schemas()
+
+        logger.info("=" * 80)
+        logger.info(f"🚀 开始 Agentic Loop（{self.endpoint}）")
+        logger.info(f"   模型: {self.model}")
+        logger.info(f"   最大工具调用轮数: {MAX_TOOL_ROUNDS}")
+        logger.info("=" * 80)
+
+        speculation = self.engine.speculator.start(messages) if self.engine.speculator is not None else None
+        try:
+            await self._rounds(messages, tools, speculation)
+        except BaseException:
+            if speculation is not None:
+                speculation.discard(CANCELLED)
+            raise
+        if speculation is not None:
+            # 模型没有调用 search 时推测的搜索在这里取消；已被认领的不受影响
+            speculation.discard(UNUSED)
+
+    async def _rounds(self, messages: List[dict], tools: List[dict], speculation: Optional[Speculation]):
+        total_usage = None
+        tool_round = 0
+
+        while True:
+            forced_final = tool_round >= MAX_TOOL_ROUNDS
+            payload = build_payload(self.model, messages, tools, self.temperature, self.max_tokens)
+            if forced_final:
+                # 达到最大轮数：移除工具定义，强制生成最终答案
+                logger.info("⚠️  已达到最大工具调用轮数，强制生成最终答案")
+                payload.pop("tools", None)
+                payload["tool_choice"] = "none"
+
+            logger.info(f"📊 第 {tool_round + 1} 轮交互（已进行 {tool_round}/{MAX_TOOL_ROUNDS} 轮工具调用）")
+            self._emit({"type": ROUND_STARTED, "round": tool_round + 1, "tool_round": tool_round, "final": forced_final})
+            with tracer.span("llm.final_answer" if forced_final else "llm.call", round=tool_round + 1, model=self.model) as span:
+                data = await (self._stream_round(payload) if self.stream else self._post_round(payload))
+                if span is not None:
+                    usage = data.get("usage") or {}
+                    span.set(
+                        finish_reason=data["choices"][0].get("finish_reason"),
+                        prompt_tokens=usage.get("prompt_tokens"),
+                        completion_tokens=usage.get("completion_tokens")
+                    )
+
+            choice = data["choices"][0]
+            message = choice.get("message") or {}
+            total_usage = _add_usage(total_usage, data.get("usage"))
+            tool_calls = [] if forced_final else (message.get("tool_calls") or [])
+            logger.info(f"   ✅ 收到模型响应，finish reason: {choice.get('finish_reason')}")
+
+            if not tool_calls:
+                content = message.get("content") or ""
+                if forced_final and not content and choice.get("finish_reason") is None:
+                    raise AgentError("生成最终答案失败")
+                if not self.stream:
+                    self._emit({"type": CONTENT, "content": content})
+                self._finish(content, data.get("model") or self.model, total_usage, tool_round, forced_final)
+                return
+
+            tool_round += 1
+            logger.info(f"   🔧 第 {tool_round} 轮工具调用，共 {len(tool_calls)} 个")
+            for tool_call in tool_calls:
+                logger.info(f"      {tool_call['function']['name']}: {tool_call['function']['arguments']}")
+            messages.append({
+                "role": "assistant",
+                "content": None,
+                "tool_calls": tool_calls
+            })
+            # 推测的搜索只在第一轮工具调用时认领
+            tool_results = await self._run_tools(tool_round, tool_calls, speculation if tool_round == 1 else None)
+            # 按工具调用的顺序添加工具结果
+            for tool_call in tool_calls:
+                messages.append({
+                    "role": "tool",
+                    "content": tool_results.get(tool_call["id"], "工具调用失败"),
+                    "tool_call_id": tool_call["id"]
+                })
+
+    async def _post_round(self, payload: dict) -> dict:
+        """非流式调用：先查 LLM 响应缓存，未命中时经过请求对冲"""
+        if self.use_cache:
+            cached = await llm_cache.get(payload)
+            if cached is not None:
+                logger.info("   ♻️ 命中 LLM 响应缓存")
+                tracer.annotate(cached=True)
+                return cached
+        started_at = time.perf_counter()
+        data = await llm_hedger.run(payload.get("model", ""), lambda: upstream.post_chat(payload))
+        if not data.get("choices"):
+            raise AgentError(INVALID_RESPONSE)
+        metrics.llm_round_seconds.observe(time.perf_counter() - started_at, endpoint=self.endpoint, model=self.model)
+        metrics.record_usage(self.endpoint, data.get("usage"))
+        tracer.annotate(cached=False)
+        if self.use_cache:
+            await llm_cache.put(payload, data)
+        return data
+
+    async def _stream_round(self, payload: dict) -> dict:
+        """
+        流式调用：逐段产出 content 事件，返回组装后的完整响应
+
+        首个文本片段到达时记录本次对话的 TTFT（time to first token）。命中 LLM
+        响应缓存时一次性产出缓存的文本；未命中时流结束后写入缓存。
+        """
+        cached = await llm_cache.get(payload) if self.use_cache else None
+        if cached is not None:
+            logger.info("♻️ 命中 LLM 响应缓存")
+            chunks = _single_chunk(upstream.response_to_chunk(cached))
+        else:
+            chunks = upstream.stream_chat(payload)
+        tracer.annotate(cached=cached is not None)
+        assembler = upstream.ChatStreamAssembler()
+        started_at = time.perf_counter()
+
+        async for chunk in chunks:
+            delta = assembler.add(chunk)
+            if not delta:
+                continue
+            if self.first_token_ms is None:
+                self.first_token_ms = (time.perf_counter() - self.started_at) * 1000
+                logger.info(f"⏱️ 首个 token 已到达，TTFT: {self.first_token_ms:.0f} ms")
+                metrics.sse_first_token_seconds.observe(self.first_token_ms / 1000)
+                tracer.annotate(first_token_ms=round((time.perf_counter() - started_at) * 1000, 1))
+            self._emit({"type": CONTENT, "content": delta})
+
+        if assembler.finish_reason is None and not assembler.content and not assembler.tool_calls:
+            raise AgentError(INVALID_RESPONSE)
+        if cached is None:
+            metrics.llm_round_seconds.observe(time.perf_counter() - started_at, endpoint=self.endpoint, model=self.model)
+            metrics.record_usage(self.endpoint, assembler.usage)
+            if self.use_cache:
+                await llm_cache.put(payload, assembler.to_response())
+        return assembler.to_response()
+
+    async def _run_tools(self, tool_round: int, tool_calls: List[dict], speculation: Optional[Speculation]) -> dict:
+        """并发执行一轮工具调用，按完成顺序产出 tool_finished 事件"""
+        for index, tool_call in enumerate(tool_calls):
+            self._emit({
+                "type": TOOL_STARTED,
+                "round": tool_round,
+                "index": index,
+                "total": len(tool_calls),
+                "tool_call_id": tool_call["id"],
+                "name": tool_call["function"]["name"],
+                "arguments": tool_call["function"]["arguments"]
+            })
+        results = {}
+        with tracer.span("tools.round", round=tool_round, tool_calls=len(tool_calls)):
+            context = await self.engine.prepare_tool_context(tool_calls, speculation)
+            async for tool_call_id, content in self.engine.executor.iter_round(tool_calls, context):
+                results[tool_call_id] = content
+                self._emit({
+                    "type": TOOL_FINISHED,
+                    "round": tool_round,
+                    "tool_call_id": tool_call_id,
+                    "completed": len(results),
+                    "total": len(tool_calls)
+                })
+        logger.info(f"   ✅ 所有工具调用完成，共 {len(results)} 个结果")
+        return results
+
+    def _finish(self, content: str, model: str, usage: Optional[dict], tool_rounds: int, forced_final: bool):
+        elapsed = time.perf_counter() - self.started_at
+        logger.info("=" * 80)
+        logger.info(f"✅ Agentic Loop 完成，总耗时: {elapsed * 1000:.0f} ms")
+        logger.info(f"   最终答案长度: {len(content)} 字符")
+        logger.info(f"   总 Token 使用: {(usage or {}).get('total_tokens', 0)}")
+        logger.info("=" * 80)
+
+        metrics.turn_seconds.observe(elapsed, endpoint=self.endpoint)
+        metrics.turns_total.inc(endpoint=self.endpoint)
+        if tool_rounds:
+            metrics.tool_rounds_total.inc(tool_rounds, endpoint=self.endpoint)
+        if forced_final:
+            metrics.forced_final_answers_total.inc(endpoint=self.endpoint)
+        if should_log_transcript():
+            transcript_logger.debug(
+                "📋 完整消息历史",
+                extra={"model": self.model, "transcript": [*self.messages, {"role": "assistant", "content": content}]}
+            )
+
+        self._emit({
+            "type": DONE,
+            "content": content,
+            "model": model,
+            "usage": usage,
+            "tool_rounds": tool_rounds,
+            "forced_final": forced_final
+        })
+
+
+class AgentEngine:
+    """
+    Agentic Loop 引擎
+
+    Args:
+        registry: 工具注册表（生成 tools 定义）
+        executor: 工具执行器
+        prepare_tool_context: 每轮工具调用前调用（参数为本轮工具调用和第一轮时
+            待认领的推测搜索），返回透传给工具处理函数的上下文
+        speculator: 推测执行搜索，None 表示不推测
+    """
+
+    def __init__(self, registry: ToolRegistry, executor: ToolExecutor,
+                 prepare_tool_context: Callable[[List[dict], Optional[Speculation]], Awaitable[dict]],
+                 speculator: Optional[SpeculativeSearch] = None):
+        self.registry = registry
+        self.executor = executor
+        self.prepare_tool_context = prepare_tool_context
+        self.speculator = speculator
+        self.stats = {
+            "runs": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+        }
+
+    def start(self, messages: List[dict], model: str, endpoint: str, stream: bool, use_cache: bool = False,
+              temperature: Optional[float] = None, max_tokens: Optional[int] = None,
+              started_at: Optional[float] = None) -> AgentRun:
+        """
+        在新的 Task 中开始一次对话
+
+        Args:
+            messages: 发给模型的消息（会在原列表上追加工具调用和结果）
+            endpoint: 指标和日志中的接口名（chat / stream）
+            stream: 是否使用流式上游调用
+            started_at: 对话开始的 perf_counter 时间，用于计算 TTFT 和总耗时
+        """
+        return AgentRun(self, messages, model, endpoint, stream, use_cache, temperature, max_tokens,
+                        started_at if started_at is not None else time.perf_counter())
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "running": self.stats["runs"] - self.stats["completed"] - self.stats["failed"] - self.stats["cancelled"],
+        }
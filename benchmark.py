@@ -0,0 +1,398 @@
+"""
+端到端压测
+
+以逐级增加的并发数请求 /chat、/api/chat/stream、/search 和 /api/chats*，
+统计吞吐、p50/p95/p99 延迟和流式接口的 TTFT，结果写成 JSON，便于对比改动
+前后的表现。上游使用 fake_upstream.py，不需要真实的 AI_BUILDER_TOKEN。
+
+用法：
+    # 自动启动 fake upstream 和应用（应用运行在临时目录中，不影响 chat_history/）
+    python benchmark.py --spawn --concurrency 1,8,32 --output before.json
+
+    # 改动之后再跑一次，并与之前的结果对比
+    python benchmark.py --spawn --concurrency 1,8,32 --output after.json --compare before.json
+
+    # 压测已经在运行的服务（服务需要以 AI_BUILDER_BASE_URL 指向 fake upstream 启动）
+    python benchmark.py --base-url http://127.0.0.1:8000
+
+fake upstream 的延迟分布等通过 FAKE_* 环境变量配置（见 fake_upstream.py）。
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+SCENARIOS = ("chat", "stream", "search", "chats")
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Sample:
+    """一次请求的结果"""
+
+    __slots__ = ("latency", "ok", "status", "ttft", "operation")
+
+    def __init__(self, latency: float, ok: bool, status: str, ttft: Optional[float] = None,
+                 operation: Optional[str] = None):
+        self.latency = latency
+        self.ok = ok
+        self.status = status
+        self.ttft = ttft
+        self.operation = operation
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """第 p 百分位（最近秩法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+
+def summarize_latencies(values: List[float]) -> Optional[dict]:
+    """延迟分布（毫秒）"""
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50) * 1000, 1),
+        "p95": round(percentile(values, 95) * 1000, 1),
+        "p99": round(percentile(values, 99) * 1000, 1),
+        "mean": round(sum(values) / len(values) * 1000, 1),
+        "max": round(max(values) * 1000, 1),
+    }
+
+
+class Benchmark:
+    """各场景的请求构造和统计"""
+
+    def __init__(self, client: httpx.AsyncClient, model: str, distinct_inputs: int):
+        self.client = client
+        self.model = model
+        self.distinct_inputs = distinct_inputs
+        self.run_id = uuid.uuid4().hex[:6]
+        self.chat_ids: List[str] = []
+        self._sequence = itertools.count()
+
+    def _input_id(self) -> str:
+        """distinct_inputs 为 0 时每个请求（包括预热和各并发级别）的输入都不同，否则在 distinct_inputs 个输入中循环（可命中缓存）"""
+        n = next(self._sequence)
+        return f"{self.run_id}-{n % self.distinct_inputs if self.distinct_inputs else n}"
+
+    async def _timed(self, operation: Optional[str], fn: Callable[[], Awaitable[httpx.Response]]) -> Sample:
+        started_at = time.perf_counter()
+        try:
+            response = await fn()
+            ok = response.status_code < 400
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            ok, status = False, type(e).__name__
+        return Sample(time.perf_counter() - started_at, ok, status, operation=operation)
+
+    async def chat(self, i: int) -> Sample:
+        payload = {"message": f"最新的进展是什么？#{self._input_id()}", "model": self.model}
+        return await self._timed(None, lambda: self.client.post("/chat", json=payload))
+
+    async def search(self, i: int) -> Sample:
+        payload = {"keyword": f"压测关键字 {self._input_id()}", "max_results": 6}
+        return await self._timed(None, lambda: self.client.post("/search", json=payload))
+
+    async def stream(self, i: int) -> Sample:
+        payload = {"message": f"最新的进展是什么？#{self._input_id()}", "model": self.model}
+        started_at = time.perf_counter()
+        ttft = None
+        status = "incomplete"
+        try:
+            async with self.client.stream("POST", "/api/chat/stream", json=payload) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    return Sample(time.perf_counter() - started_at, False, str(response.status_code))
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    if event["type"] == "content" and ttft is None:
+                        ttft = time.perf_counter() - started_at
+                    elif event["type"] == "complete":
+                        status = "200"
+                    elif event["type"] == "error":
+                        status = "error_event"
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        return Sample(time.perf_counter() - started_at, status == "200", status, ttft=ttft)
+
+    async def setup_chats(self, count: int):
+        """预先创建 count 个带消息的对话，供 chats 场景读取"""
+        for n in range(count):
+            response = await self.client.post("/api/chats", json={"first_message": f"压测对话 {self.run_id} {n}"})
+            response.raise_for_status()
+            chat_id = response.json()["id"]
+            response = await self.client.post(f"/api/chats/{chat_id}/messages", json={"messages": [
+                {"role": "user", "content": f"压测对话 {self.run_id} {n} 的问题"},
+                {"role": "assistant", "content": f"压测对话 {self.run_id} {n} 的回答，" * 20},
+            ]})
+            response.raise_for_status()
+            self.chat_ids.append(chat_id)
+
+    async def chats(self, i: int) -> Sample:
+        """对话历史接口的混合负载：列表、详情、检索、追加消息各占四分之一"""
+        chat_id = self.chat_ids[i % len(self.chat_ids)]
+        operation = ("list", "get", "search", "append")[i % 4]
+        if operation == "list":
+            fn = lambda: self.client.get("/api/chats", params={"limit": 50})
+        elif operation == "get":
+            fn = lambda: self.client.get(f"/api/chats/{chat_id}")
+        elif operation == "search":
+            fn = lambda: self.client.get("/api/chats/search", params={"q": f"压测对话 {i % len(self.chat_ids)}"})
+        else:
+            fn = lambda: self.client.post(f"/api/chats/{chat_id}/messages", json={"messages": [
+                {"role": "user", "content": f"追加消息 {i}"},
+            ]})
+        return await self._timed(operation, fn)
+
+
+async def run_level(fn: Callable[[int], Awaitable[Sample]], concurrency: int, requests: int) -> dict:
+    """以 concurrency 个并发的闭环客户端发出 requests 个请求"""
+    samples: List[Sample] = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            samples.append(await fn(i))
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - started_at
+
+    ok = [sample for sample in samples if sample.ok]
+    status_codes: Dict[str, int] = {}
+    for sample in samples:
+        status_codes[sample.status] = status_codes.get(sample.status, 0) + 1
+    result = {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_rate": round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(ok) / duration, 2) if duration else 0.0,
+        "latency_ms": summarize_latencies([sample.latency for sample in ok]),
+        "ttft_ms": summarize_latencies([sample.ttft for sample in ok if sample.ttft is not None]),
+        "status_codes": status_codes,
+    }
+    operations = sorted({sample.operation for sample in samples if sample.operation})
+    if operations:
+        result["operations"] = {
+            operation: summarize_latencies([s.latency for s in ok if s.operation == operation])
+            for operation in operations
+        }
+    return result
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _check_running(processes: List[subprocess.Popen]):
+    """子进程已经退出时立即失败（例如端口被占用），避免压测到端口上的其他服务"""
+    for process in processes:
+        code = process.poll()
+        if code is not None:
+            raise RuntimeError(f"{process.name} 已退出（退出码 {code}），日志: {process.log_file.name}")
+
+
+async def _wait_ready(url: str, processes: List[subprocess.Popen], timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            _check_running(processes)
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"服务没有在 {timeout:.0f} 秒内启动: {url}")
+                await asyncio.sleep(0.2)
+
+
+def _spawn(name: str, command: List[str], log_path: str, **kwargs) -> subprocess.Popen:
+    """启动子进程，标准输出和标准错误写入 log_path"""
+    log_file = open(log_path, "w")
+    try:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, **kwargs)
+    except Exception:
+        log_file.close()
+        raise
+    process.name = name
+    process.log_file = log_file
+    return process
+
+
+async def spawn_servers(args) -> List[subprocess.Popen]:
+    """启动 fake upstream 和应用，应用的工作目录是临时目录"""
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    env = {
+        **os.environ,
+        "AI_BUILDER_BASE_URL": upstream_url,
+        "AI_BUILDER_TOKEN": "benchmark",
+        "WEB_CONCURRENCY": str(args.workers),
+    }
+    processes = []
+    try:
+        processes.append(_spawn(
+            "fake upstream",
+            [sys.executable, os.path.join(REPO_DIR, "fake_upstream.py"), "--port", str(args.upstream_port)],
+            os.path.join(workdir, "fake_upstream.log"),
+            env=env
+        ))
+        processes.append(_spawn(
+            "应用",
+            [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO_DIR,
+             "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+            os.path.join(workdir, "app.log"),
+            env=env, cwd=workdir
+        ))
+        await _wait_ready(f"{upstream_url}/fake/stats", processes)
+        await _wait_ready(f"http://127.0.0.1:{args.port}/api/debug/stats", processes)
+        # 应用启动期间 fake upstream 如果因为端口被占用而退出，这里也能发现
+        _check_running(processes)
+    except Exception:
+        stop_servers(processes)
+        raise
+    print(f"已启动 fake upstream（{upstream_url}）和应用（端口 {args.port}），日志目录 {workdir}")
+    return processes
+
+
+def stop_servers(processes: List[subprocess.Popen]):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.log_file.close()
+
+
+def print_results(results: List[dict], baseline: Optional[List[dict]] = None):
+    """打印结果表格，有 baseline 时附上吞吐和 p95 的变化"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline or []}
+    print()
+    print(f"{'场景':<8}{'并发':>6}{'请求':>7}{'错误':>6}{'吞吐/s':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'TTFT p95':>10}")
+    for r in results:
+        latency = r["latency_ms"] or {}
+        ttft = r["ttft_ms"] or {}
+        line = (f"{r['scenario']:<8}{r['concurrency']:>6}{r['requests']:>7}{r['errors']:>6}"
+                f"{r['throughput_rps']:>10}{latency.get('p50', '-'):>9}{latency.get('p95', '-'):>9}"
+                f"{latency.get('p99', '-'):>9}{ttft.get('p95', '-'):>10}")
+        before = previous.get((r["scenario"], r["concurrency"]))
+        if before and before["throughput_rps"] and before["latency_ms"] and r["latency_ms"]:
+            throughput_change = (r["throughput_rps"] / before["throughput_rps"] - 1) * 100
+            p95_change = (r["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+            line += f"   吞吐 {throughput_change:+.1f}%  p95 {p95_change:+.1f}%"
+        print(line)
+
+
+async def run(args) -> dict:
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"未知的场景: {', '.join(sorted(unknown))}（可选: {', '.join(SCENARIOS)}）")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    processes = await spawn_servers(args) if args.spawn else []
+    base_url = f"http://127.0.0.1:{args.port}" if args.spawn else args.base_url
+    limits = httpx.Limits(max_connections=max(levels) * 2, max_keepalive_connections=max(levels) * 2)
+    results = []
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            bench = Benchmark(client, args.model, args.distinct_inputs)
+            if "chats" in scenarios:
+                await bench.setup_chats(args.seed_chats)
+            for scenario in scenarios:
+                fn = getattr(bench, scenario)
+                if args.warmup:
+                    await run_level(fn, min(levels), args.warmup)
+                for concurrency in levels:
+                    result = {"scenario": scenario, **await run_level(fn, concurrency, args.requests)}
+                    results.append(result)
+                    print(f"✅ {scenario} 并发 {concurrency}: {result['throughput_rps']} 请求/秒，"
+                          f"p95 {(result['latency_ms'] or {}).get('p95')} ms，错误 {result['errors']}")
+            try:
+                server_stats = (await client.get("/api/debug/stats")).json()
+            except (httpx.HTTPError, ValueError):
+                server_stats = None
+    finally:
+        if processes:
+            stop_servers(processes)
+
+    return {
+        "meta": {
+            "started_at": datetime.now().isoformat(),
+            "git_revision": _git_revision(),
+            "base_url": base_url,
+            "spawned": args.spawn,
+            "workers": args.workers if args.spawn else None,
+            "model": args.model,
+            "requests_per_level": args.requests,
+            "distinct_inputs": args.distinct_inputs,
+            "fake_upstream": {key: value for key, value in os.environ.items() if key.startswith("FAKE_")},
+        },
+        "results": results,
+        "server_stats": server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测（配合 fake_upstream.py）")
+    parser.add_argument("--base-url", default=os.getenv("BENCHMARK_BASE_URL", "http://127.0.0.1:8000"),
+                        help="被测服务地址（不使用 --spawn 时）")
+    parser.add_argument("--spawn", action="store_true", help="自动启动 fake upstream 和应用")
+    parser.add_argument("--port", type=int, default=8100, help="--spawn 时应用的端口")
+    parser.add_argument("--upstream-port", type=int, default=9100, help="--spawn 时 fake upstream 的端口")
+    parser.add_argument("--workers", type=int, default=1, help="--spawn 时应用的 worker 数")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"逗号分隔，可选 {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="逗号分隔的并发级别")
+    parser.add_argument("--requests", type=int, default=100, help="每个并发级别的请求数")
+    parser.add_argument("--warmup", type=int, default=5, help="每个场景正式统计前的预热请求数")
+    parser.add_argument("--distinct-inputs", type=int, default=0,
+                        help="不同消息/关键字的数量，0 表示每个请求都不同（不命中缓存）")
+    parser.add_argument("--seed-chats", type=int, default=50, help="chats 场景预先创建的对话数")
+    parser.add_argument("--model", default="gpt-5")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时（秒）")
+    parser.add_argument("--output", help="结果 JSON 的输出路径")
+    parser.add_argument("--compare", help="之前的结果 JSON，打印吞吐和 p95 的变化")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(report["results"], baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
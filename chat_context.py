@@ -0,0 +1,258 @@
+"""
+对话上下文管理
+
+长对话每一轮都把完整历史发给 LLM，prompt token、延迟和费用会无限增长，
+最终超出上下文窗口。这里在发给 LLM 之前裁剪上下文：
+- 按消息估算 token 数，从最近的消息往前保留，直到 CONTEXT_TOKEN_BUDGET
+- 只在用户消息处切分，不会把一次工具调用和它的结果拆开
+- 更早的消息用滚动摘要代替。摘要与对话一起保存在对话存储中（文件后端为
+  chat_history/{chat_id}.summary.json），记录已覆盖的消息数；切分点后移时
+  只把新移出窗口的消息合并进已有摘要，不从头重新生成
+- 已覆盖部分的历史被改写（指纹不一致）时才从头生成
+- 生成摘要失败，或请求没有 chat_id（摘要无处保存）时，退化为直接丢弃较早的消息
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import upstream
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# 发送给 LLM 的历史消息 token 预算（不含摘要）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# 每次合并进摘要的消息 token 上限，更多的消息分批合并
+CONTEXT_SUMMARY_CHUNK_TOKENS = int(os.getenv("CONTEXT_SUMMARY_CHUNK_TOKENS", "4000"))
+# 摘要的目标长度（字）
+CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "800"))
+# 生成摘要使用的模型，留空表示使用对话本身的模型
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "")
+
+# 每条消息的固定开销（role、分隔符等）
+_MESSAGE_OVERHEAD_TOKENS = 4
+_CJK_RE = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+SUMMARY_PROMPT = """你负责维护一段对话的滚动摘要。下面给出已有摘要（可能为空）和之后新增的对话内容，请把新增内容合并进摘要，输出更新后的完整摘要。
+
+要求：
+- 保留用户的目标、偏好、已确认的事实、关键结论和搜索得到的重要信息
+- 省略寒暄和重复内容
+- 不超过 {max_chars} 字，直接输出摘要正文
+
+【已有摘要】
+{summary}
+
+【新增对话】
+{transcript}"""
+
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算文本的 token 数：中日韩文字约每字 1 个 token，其余字符约每 4 个 1 个 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """估算单条消息的 token 数"""
+    tokens = _MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_text_tokens(content)
+    elif content is not None:
+        tokens += estimate_text_tokens(json.dumps(content, ensure_ascii=False))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        tokens += estimate_text_tokens(function.get("name", "")) + estimate_text_tokens(function.get("arguments", ""))
+    return tokens
+
+
+def _fingerprint(messages: List[dict]) -> str:
+    return hashlib.sha256(
+        json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _transcript(messages: List[dict]) -> str:
+    """把消息转成供摘要使用的文本"""
+    lines = []
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content")
+        if role == "user" and content:
+            lines.append(f"用户: {content}")
+        elif role == "assistant" and content:
+            lines.append(f"助手: {content}")
+        elif role == "assistant" and message.get("tool_calls"):
+            calls = ", ".join(tc.get("function", {}).get("arguments", "") for tc in message["tool_calls"])
+            lines.append(f"助手调用工具: {calls}")
+        elif role == "tool" and content:
+            lines.append(f"工具结果: {content}")
+    return "\n".join(lines)
+
+
+def split_context(history: List[dict], budget: int) -> int:
+    """
+    计算保留窗口的起点
+
+    从最后一条消息往前累加 token，在不超过预算的前提下尽量多保留，切分点
+    总是落在用户消息上；最后一轮本身超出预算时仍然完整保留最后一轮。
+
+    Returns:
+        int: 保留窗口的起始下标，之前的消息需要用摘要代替
+    """
+    total = 0
+    cut = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        total += estimate_message_tokens(history[index])
+        if history[index].get("role") != "user":
+            continue
+        if total > budget and cut < len(history):
+            break
+        cut = index
+        if total > budget:
+            break
+    return 0 if cut == len(history) else cut
+
+
+class ChatContextManager:
+    """按 token 预算裁剪对话上下文，并维护存储中的滚动摘要"""
+
+    def __init__(self, store, budget: int = CONTEXT_TOKEN_BUDGET):
+        self.store = store
+        self.budget = budget
+        self._flight = SingleFlight()
+        self.stats = {
+            "requests": 0,
+            "trimmed": 0,
+            "summary_updates": 0,
+            "summary_rebuilds": 0,
+            "summary_failures": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+        }
+
+    async def _summarize(self, summary: str, messages: List[dict], model: str) -> str:
+        """把 messages 合并进已有摘要"""
+        prompt = SUMMARY_PROMPT.format(
+            max_chars=CONTEXT_SUMMARY_MAX_CHARS,
+            summary=summary or "（无）",
+            transcript=_transcript(messages)
+        )
+        summary_model = CONTEXT_SUMMARY_MODEL or model
+        result = await upstream.post_chat({
+            "model": summary_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 1.0 if summary_model == "gpt-5" else 0.3
+        })
+        content = result["choices"][0]["message"].get("content")
+        if not content:
+            raise ValueError("摘要模型返回了空内容")
+        return content.strip()
+
+    async def _update_summary(self, chat_id: str, history: List[dict], cut: int, model: str) -> str:
+        """把 history[:cut] 合并进滚动摘要并保存，返回摘要正文"""
+        record = await asyncio.to_thread(self.store.get_summary, chat_id)
+        if record is not None:
+            covered = record.get("covered", 0)
+            if covered > cut or record.get("fingerprint") != _fingerprint(history[:covered]):
+                # 已覆盖的历史被改写过（或被截短），从头生成
+                record = None
+                self.stats["summary_rebuilds"] += 1
+        if record is None:
+            record = {"content": "", "covered": 0}
+
+        summary = record["content"]
+        start = record["covered"]
+        while start < cut:
+            # 分批合并，每批不超过 CONTEXT_SUMMARY_CHUNK_TOKENS，批的边界同样落在用户消息上
+            end = start
+            chunk_tokens = 0
+            while end < cut:
+                message_tokens = estimate_message_tokens(history[end])
+                if end > start and chunk_tokens + message_tokens > CONTEXT_SUMMARY_CHUNK_TOKENS \
+                        and history[end].get("role") == "user":
+                    break
+                chunk_tokens += message_tokens
+                end += 1
+            summary = await self._summarize(summary, history[start:end], model)
+            self.stats["summary_updates"] += 1
+            start = end
+
+        if start != record["covered"]:
+            await asyncio.to_thread(self.store.put_summary, chat_id, {
+                "content": summary,
+                "covered": cut,
+                "fingerprint": _fingerprint(history[:cut]),
+                "updated_at": datetime.now().isoformat()
+            })
+        return summary
+
+    async def prepare(self, chat_id: Optional[str], history: List[dict], model: str) -> Tuple[List[dict], dict]:
+        """
+        生成发给 LLM 的消息列表
+
+        Args:
+            chat_id: 对话 ID，为空时不生成摘要，直接丢弃较早的消息
+            history: 完整对话历史
+            model: 对话使用的模型
+
+        Returns:
+            tuple: (messages, info)，info 包含 trimmed、summarized、kept_messages、estimated_tokens
+        """
+        self.stats["requests"] += 1
+        input_tokens = sum(estimate_message_tokens(message) for message in history)
+        self.stats["input_tokens"] += input_tokens
+        cut = split_context(history, self.budget) if input_tokens > self.budget else 0
+        if cut == 0:
+            self.stats["output_tokens"] += input_tokens
+            return list(history), {
+                "trimmed": False,
+                "summarized": False,
+                "kept_messages": len(history),
+                "estimated_tokens": input_tokens
+            }
+
+        self.stats["trimmed"] += 1
+        recent = history[cut:]
+        summary = ""
+        if chat_id:
+            try:
+                # 同一对话同一切分点的并发请求只生成一次摘要
+                summary = await self._flight.do(
+                    (chat_id, _fingerprint(history[:cut])),
+                    lambda: self._update_summary(chat_id, history, cut, model)
+                )
+            except Exception as e:
+                self.stats["summary_failures"] += 1
+                logger.error(f"⚠️ 生成对话摘要失败，直接丢弃较早的 {cut} 条消息: {e}")
+
+        messages = list(recent)
+        if summary:
+            messages.insert(0, {"role": "system", "content": f"以下是本次对话较早部分的摘要：\n{summary}"})
+        output_tokens = sum(estimate_message_tokens(message) for message in messages)
+        self.stats["output_tokens"] += output_tokens
+        logger.info(
+            f"✂️ 对话上下文裁剪: {len(history)} 条消息（约 {input_tokens} tokens）"
+            f" -> 摘要 + {len(recent)} 条（约 {output_tokens} tokens）"
+        )
+        return messages, {
+            "trimmed": True,
+            "summarized": bool(summary),
+            "kept_messages": len(recent),
+            "estimated_tokens": output_tokens
+        }
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "budget": self.budget,
+            "flight": self._flight.get_stats(),
+        }
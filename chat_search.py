@@ -0,0 +1,329 @@
+"""
+对话全文检索
+
+内存中的倒排索引，覆盖对话标题和用户/助手消息内容：
+- 中日韩文字按相邻两字切分（bigram），同时索引单字，用于检索单个字的查询
+- 拉丁字母和数字按单词切分
+- 标题中的词项按 TITLE_WEIGHT 加权
+
+保存、追加消息、修改标题和删除对话时增量更新对应文档的倒排表，不做全量
+重建。查询时所有词项都命中的对话优先（AND），没有则退化为任一词项命中
+（OR），按 BM25 打分排序。
+
+索引同时保存每个对话的可检索消息文本，检索结果的摘要直接从中截取，不需要
+再从存储中读取完整对话。
+"""
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# 标题词项的权重（相当于在正文中出现的次数）
+TITLE_WEIGHT = 3
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 摘要截取的前后字符数
+SNIPPET_CONTEXT = 30
+
+_CJK_RANGES = (
+    "\u3040-\u30ff"  # 日文假名
+    "\u3400-\u4dbf"  # 扩展 A
+    "\u4e00-\u9fff"  # 基本汉字
+    "\uac00-\ud7af"  # 韩文
+    "\uf900-\ufaff"  # 兼容汉字
+)
+_SEGMENT_RE = re.compile(f"([{_CJK_RANGES}]+)|([a-z0-9]+)")
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def _segments(text: str) -> List[Tuple[str, bool]]:
+    """切出连续的中日韩文字片段和拉丁单词，返回 (片段, 是否为中日韩文字)"""
+    return [
+        (match.group(1), True) if match.group(1) else (match.group(2), False)
+        for match in _SEGMENT_RE.finditer(_normalize(text))
+    ]
+
+
+def tokenize(text: str, for_query: bool = False) -> List[str]:
+    """
+    把文本切分为检索词项
+
+    索引时中日韩文字同时产出单字和 bigram；查询时多字片段只用 bigram，
+    只有一个字的片段用单字。
+    """
+    tokens = []
+    for segment, is_cjk in _segments(text):
+        if is_cjk and len(segment) > 1:
+            tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+            if not for_query:
+                tokens.extend(segment)
+        else:
+            tokens.append(segment)
+    return tokens
+
+
+def _message_texts(messages: Iterable[dict]) -> List[str]:
+    """可检索的消息文本（只包含用户和助手的文字内容）"""
+    return [
+        message["content"]
+        for message in messages
+        if isinstance(message, dict)
+        and message.get("role") in ("user", "assistant")
+        and isinstance(message.get("content"), str)
+        and message["content"]
+    ]
+
+
+class _Document:
+    __slots__ = ("title_tokens", "body_tokens", "length", "texts")
+
+    def __init__(self):
+        self.title_tokens: Counter = Counter()
+        self.body_tokens: Counter = Counter()
+        self.length = 0
+        self.texts: List[str] = []  # 可检索的消息文本，用于生成摘要
+
+
+class ChatSearchIndex:
+    """对话倒排索引"""
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, int]] = {}  # 词项 -> {chat_id: 加权词频}
+        self._docs: Dict[str, _Document] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+        # 后台构建期间被增量更新过的对话，构建时跳过，避免用旧数据覆盖
+        self._building = False
+        self._touched: Set[str] = set()
+
+    # ---- 倒排表维护（调用方需持有 _lock） ----
+
+    def _set_weight(self, token: str, chat_id: str, doc: _Document):
+        weight = doc.title_tokens[token] * TITLE_WEIGHT + doc.body_tokens[token]
+        postings = self._postings.get(token)
+        if weight > 0:
+            if postings is None:
+                postings = self._postings[token] = {}
+            postings[chat_id] = weight
+        elif postings is not None:
+            postings.pop(chat_id, None)
+            if not postings:
+                del self._postings[token]
+
+    def _set_length(self, doc: _Document):
+        length = sum(doc.title_tokens.values()) * TITLE_WEIGHT + sum(doc.body_tokens.values())
+        self._total_length += length - doc.length
+        doc.length = length
+
+    def _remove(self, chat_id: str):
+        doc = self._docs.pop(chat_id, None)
+        if doc is None:
+            return
+        for token in set(doc.title_tokens) | set(doc.body_tokens):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(chat_id, None)
+                if not postings:
+                    del self._postings[token]
+        self._total_length -= doc.length
+
+    def _index(self, chat_data: dict):
+        chat_id = chat_data["id"]
+        self._remove(chat_id)
+        doc = _Document()
+        doc.title_tokens.update(tokenize(chat_data.get("title") or ""))
+        doc.texts = _message_texts(chat_data.get("history") or [])
+        for text in doc.texts:
+            doc.body_tokens.update(tokenize(text))
+        self._docs[chat_id] = doc
+        for token in set(doc.title_tokens) | set(doc.body_tokens):
+            self._set_weight(token, chat_id, doc)
+        self._set_length(doc)
+
+    def _touch(self, chat_id: str):
+        if self._building:
+            self._touched.add(chat_id)
+
+    # ---- 增量更新 ----
+
+    def index_chat(self, chat_data: dict):
+        """索引（或重新索引）整个对话"""
+        with self._lock:
+            self._touch(chat_data["id"])
+            self._index(chat_data)
+
+    def add_messages(self, chat_id: str, messages: List[dict], title: Optional[str] = None):
+        """把追加的消息加入已有对话的索引，title 不为空时同时更新标题"""
+        with self._lock:
+            self._touch(chat_id)
+            doc = self._docs.get(chat_id)
+            if doc is None:
+                self._index({"id": chat_id, "title": title or "", "history": messages})
+                return
+            changed = Counter()
+            texts = _message_texts(messages)
+            doc.texts.extend(texts)
+            for text in texts:
+                changed.update(tokenize(text))
+            doc.body_tokens.update(changed)
+            if title is not None:
+                old_title_tokens = doc.title_tokens
+                doc.title_tokens = Counter(tokenize(title))
+                changed.update(old_title_tokens)
+                changed.update(doc.title_tokens)
+            for token in changed:
+                self._set_weight(token, chat_id, doc)
+            self._set_length(doc)
+
+    def update_title(self, chat_id: str, title: str):
+        """只更新对话标题的索引"""
+        self.add_messages(chat_id, [], title)
+
+    def remove_chat(self, chat_id: str):
+        """从索引中删除对话"""
+        with self._lock:
+            self._touch(chat_id)
+            self._remove(chat_id)
+
+    def clear(self):
+        """清空索引"""
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self._total_length = 0
+
+    def build(self, chats: Iterable[dict]) -> int:
+        """
+        从存储中的全部对话构建索引（启动时在后台线程调用）
+
+        构建过程中通过增量接口更新过的对话以增量结果为准。
+
+        Returns:
+            int: 本次索引的对话数
+        """
+        with self._lock:
+            self._building = True
+            self._touched.clear()
+        count = 0
+        try:
+            for chat_data in chats:
+                with self._lock:
+                    if chat_data["id"] in self._touched:
+                        continue
+                    self._index(chat_data)
+                count += 1
+        finally:
+            with self._lock:
+                self._building = False
+                self._touched.clear()
+        return count
+
+    # ---- 查询 ----
+
+    def search(self, query: str, limit: int = 20) -> List[Tuple[str, float]]:
+        """
+        检索对话
+
+        Returns:
+            list: [(chat_id, score)]，按相关度倒序
+        """
+        tokens = list(dict.fromkeys(tokenize(query, for_query=True)))
+        if not tokens:
+            return []
+        with self._lock:
+            postings = [self._postings.get(token, {}) for token in tokens]
+            doc_count = len(self._docs)
+            if doc_count == 0:
+                return []
+            avg_length = self._total_length / doc_count or 1
+
+            # 先取所有词项都命中的对话（从最短的倒排表开始求交集）
+            ordered = sorted(postings, key=len)
+            candidates = set(ordered[0])
+            for posting in ordered[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(posting)
+            if not candidates:
+                candidates = set().union(*postings)
+
+            scores = {}
+            for posting in postings:
+                if not posting:
+                    continue
+                idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+                for chat_id in candidates:
+                    tf = posting.get(chat_id)
+                    if tf is None:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._docs[chat_id].length / avg_length)
+                    scores[chat_id] = scores.get(chat_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(chat_id, round(score, 4)) for chat_id, score in ranked]
+
+    def snippet(self, chat_id: str, title: str, query: str) -> dict:
+        """用索引中保存的消息文本生成检索结果的摘要"""
+        with self._lock:
+            doc = self._docs.get(chat_id)
+            texts = list(doc.texts) if doc is not None else []
+        return make_snippet(title, texts, query)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "documents": len(self._docs),
+                "terms": len(self._postings),
+                "building": self._building,
+            }
+
+
+def _highlight_pattern(query: str) -> Optional[re.Pattern]:
+    """查询中的完整片段和中文 bigram，长的优先匹配"""
+    terms = set()
+    for segment, is_cjk in _segments(query):
+        terms.add(segment)
+        if is_cjk:
+            terms.update(segment[i:i + 2] for i in range(len(segment) - 1))
+    if not terms:
+        return None
+    alternatives = "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+    return re.compile(alternatives, re.IGNORECASE)
+
+
+def make_snippet(title: str, texts: List[str], query: str) -> dict:
+    """
+    在对话标题和消息文本中找到第一处命中，截取前后文作为摘要
+
+    Returns:
+        dict: {"text": 摘要文本, "highlights": [[start, end], ...]}（高亮位置相对 text）
+    """
+    pattern = _highlight_pattern(query)
+    if pattern is not None:
+        for text in [title] + texts:
+            text = unicodedata.normalize("NFKC", text)
+            match = pattern.search(text)
+            if match is None:
+                continue
+            start = max(0, match.start() - SNIPPET_CONTEXT)
+            end = min(len(text), match.end() + SNIPPET_CONTEXT)
+            prefix = "…" if start > 0 else ""
+            suffix = "…" if end < len(text) else ""
+            snippet = text[start:end]
+            highlights = [
+                [m.start() + len(prefix), m.end() + len(prefix)]
+                for m in pattern.finditer(snippet)
+            ]
+            return {"text": prefix + snippet + suffix, "highlights": highlights}
+    fallback = texts[0] if texts else ""
+    return {"text": fallback[:SNIPPET_CONTEXT * 2], "highlights": []}
+
+
+chat_search_index = ChatSearchIndex()
@@ -0,0 +1,910 @@
+"""
+对话历史存储
+
+/api/chats* 接口通过 ChatStore 接口读写对话历史，具体后端由环境变量
+CHAT_STORE_BACKEND 选择：
+- file：原有布局，每个对话一个 JSON 文件，外加全局 index.json
+- sqlite：单个 SQLite 数据库，对话元数据和消息分表存储，按 updated_at 建索引
+
+对话记录的格式在两个后端中一致：
+{"id", "title", "history", "created_at", "updated_at", "version"}，
+列表项不包含 history。version 是对话中已保存的消息数，增量追加消息时
+用作乐观并发控制的序号。
+"""
+import base64
+import bisect
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import metrics
+from tracing import tracer
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只能单进程运行文件后端
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CHAT_HISTORY_DIR = "chat_history"
+CHAT_STORE_BACKEND = os.getenv("CHAT_STORE_BACKEND", "file")
+CHAT_STORE_SQLITE_PATH = os.getenv("CHAT_STORE_SQLITE_PATH", os.path.join(CHAT_HISTORY_DIR, "chats.db"))
+
+# 文件后端的追加日志超过该行数时合并回对话文件
+CHAT_LOG_COMPACT_THRESHOLD = int(os.getenv("CHAT_LOG_COMPACT_THRESHOLD", "100"))
+# 不加锁读取对话时，遇到并发合并最多重试的次数，之后在写锁内读取
+CHAT_READ_RETRIES = 5
+# 文件后端索引变更后延迟多久写盘（秒），期间的多次变更合并为一次写入
+CHAT_INDEX_FLUSH_DELAY = float(os.getenv("CHAT_INDEX_FLUSH_DELAY", "0.5"))
+DEFAULT_CHAT_TITLE = "新对话"
+
+_CHAT_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class VersionConflict(Exception):
+    """追加消息时 expected_version 与当前版本不一致"""
+
+    def __init__(self, current_version: int):
+        super().__init__(f"对话版本冲突，当前版本: {current_version}")
+        self.current_version = current_version
+
+
+class _SnapshotChanged(Exception):
+    """读取追加日志期间对话文件被并发的合并替换"""
+
+
+def _atomic_write_json(path: str, data, indent: Optional[int] = None):
+    """先写临时文件并 fsync，再原子地 rename 覆盖目标文件，崩溃时不会留下半个文件"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+def encode_cursor(summary: dict) -> str:
+    """把列表项的排序键 (updated_at, id) 编码为不透明的分页游标"""
+    raw = json.dumps([summary["updated_at"], summary["id"]], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    解析分页游标
+
+    Raises:
+        ValueError: 游标格式不正确
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, chat_id = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise ValueError(f"非法的分页游标: {cursor}")
+    if not isinstance(updated_at, str) or not isinstance(chat_id, str):
+        raise ValueError(f"非法的分页游标: {cursor}")
+    return updated_at, chat_id
+
+
+def _summary(chat_data: dict) -> dict:
+    """对话列表项（不含 history）"""
+    return {
+        "id": chat_data["id"],
+        "title": chat_data["title"],
+        "created_at": chat_data["created_at"],
+        "updated_at": chat_data["updated_at"]
+    }
+
+
+class ChatStore:
+    """对话历史存储接口"""
+
+    def list_chats(self) -> List[dict]:
+        """返回所有对话的列表项，按 updated_at 倒序"""
+        raise NotImplementedError
+
+    def list_chats_page(self, limit: int, cursor: Optional[str] = None) -> dict:
+        """
+        按 (updated_at, id) 倒序分页返回对话列表项
+
+        Args:
+            limit: 每页条数
+            cursor: 上一页返回的 next_cursor，为空表示第一页
+
+        Returns:
+            dict: {"chats": [...], "next_cursor": str 或 None（没有下一页）}
+
+        Raises:
+            ValueError: 游标格式不正确
+        """
+        raise NotImplementedError
+
+    def get_chat(self, chat_id: str) -> Optional[dict]:
+        """返回完整对话记录，不存在时返回 None"""
+        raise NotImplementedError
+
+    def get_chat_entries(self, chat_ids: List[str]) -> Dict[str, dict]:
+        """返回指定对话的列表项（标题和时间，不含消息），不存在的对话不出现在结果中"""
+        wanted = set(chat_ids)
+        return {item["id"]: item for item in self.list_chats() if item["id"] in wanted}
+
+    def put_chat(self, chat_data: dict):
+        """写入（新建或覆盖）完整对话记录"""
+        raise NotImplementedError
+
+    def update_title(self, chat_id: str, title: str, updated_at: str) -> bool:
+        """更新对话标题，对话不存在时返回 False"""
+        raise NotImplementedError
+
+    def append_messages(
+        self,
+        chat_id: str,
+        messages: List[dict],
+        updated_at: str,
+        expected_version: Optional[int] = None,
+        title: Optional[str] = None
+    ) -> dict:
+        """
+        向对话末尾追加消息，只写入新增部分
+
+        对话不存在时自动创建（此时 expected_version 只能为空或 0）。
+
+        Args:
+            chat_id: 对话 ID
+            messages: 新增的消息
+            updated_at: 更新时间
+            expected_version: 客户端认为的当前版本（消息数），为空时不检查
+            title: 候选标题，仅在对话仍是默认标题时使用
+
+        Returns:
+            dict: {"version": 追加后的版本, "title": 当前标题}
+
+        Raises:
+            VersionConflict: 当 expected_version 与当前版本不一致时
+        """
+        raise NotImplementedError
+
+    def delete_chat(self, chat_id: str):
+        """删除对话（不存在时忽略）"""
+        raise NotImplementedError
+
+    def get_summary(self, chat_id: str) -> Optional[dict]:
+        """读取对话的滚动摘要（由 chat_context 维护），不存在返回 None"""
+        raise NotImplementedError
+
+    def put_summary(self, chat_id: str, summary: dict):
+        """保存对话的滚动摘要"""
+        raise NotImplementedError
+
+    def close(self):
+        """释放资源，把尚未落盘的数据写入磁盘（应用关闭时调用）"""
+
+    def iter_chats(self) -> Iterator[dict]:
+        """逐个产出完整对话记录（用于迁移）"""
+        for item in self.list_chats():
+            chat_data = self.get_chat(item["id"])
+            if chat_data is not None:
+                yield chat_data
+
+
+class FileChatStore(ChatStore):
+    """
+    每个对话一个 JSON 文件 + 全局 index.json
+
+    增量追加的消息写入每个对话的追加日志 {chat_id}.log.jsonl（每次追加一行），
+    读取时与对话文件合并；日志行数超过 CHAT_LOG_COMPACT_THRESHOLD、或整体
+    保存/修改标题时合并回对话文件。
+
+    读取不加锁，合并时先写对话文件、再删除追加日志，两步之间的读取可能同时
+    看到新的对话文件和已合并的日志。因此对话文件记录日志代数 log_generation，
+    每次合并加一，日志行记录写入时的代数：读取时跳过代数小于对话文件的行
+    （已合并）；读取日志期间对话文件被替换或删除时重新读取。
+
+    索引在启动时加载一次并常驻内存，读请求不再访问磁盘。索引变更后延迟
+    CHAT_INDEX_FLUSH_DELAY 秒写盘，期间的多次变更合并为一次原子写入
+    （临时文件 + fsync + rename）。索引有未落盘的变更时存在 index.dirty
+    标记文件；启动时如果发现该标记（上次进程崩溃）或索引缺失/损坏，
+    就扫描所有对话文件重建索引。
+
+    多进程模式（multiprocess=True，多个 worker 共用同一目录）下，所有写操作
+    在目录级的 flock 文件锁内进行：先重新加载其他 worker 改写过的 index.json，
+    修改后立即原子写回，不再延迟合并。读操作发现 index.json 变化时重新加载。
+    """
+
+    def __init__(
+        self,
+        directory: str = CHAT_HISTORY_DIR,
+        flush_delay: float = CHAT_INDEX_FLUSH_DELAY,
+        multiprocess: bool = False
+    ):
+        if multiprocess and fcntl is None:
+            raise RuntimeError("文件存储的多进程模式依赖 fcntl，当前系统不支持，请改用 sqlite 后端")
+        self.directory = directory
+        self.index_file = os.path.join(directory, "index.json")
+        self.dirty_marker = os.path.join(directory, "index.dirty")
+        self.lock_file = os.path.join(directory, ".lock")
+        self.flush_delay = flush_delay
+        self.multiprocess = multiprocess
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+        with self._process_lock():
+            self._index = self._load_index()
+            self._index_stat = self._stat_index()
+        self._build_order()
+
+    @contextmanager
+    def _process_lock(self):
+        """多进程模式下用 flock 串行化各 worker 对目录的修改"""
+        if not self.multiprocess:
+            yield
+            return
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _write_lock(self):
+        """写操作的锁：线程锁 + 多进程模式下的文件锁，并同步其他 worker 的索引变更"""
+        with self._lock, self._process_lock():
+            self._refresh_index()
+            yield
+
+    def _build_order(self):
+        # 按 (updated_at, id) 升序排列的排序键，列表和分页从尾部倒序读取
+        self._order: List[Tuple[str, str]] = sorted(
+            (item.get("updated_at", ""), chat_id) for chat_id, item in self._index.items()
+        )
+
+    def _stat_index(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.index_file)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh_index(self):
+        """多进程模式下，index.json 被其他 worker 改写过时重新加载（调用方需持有 _lock）"""
+        if not self.multiprocess:
+            return
+        stat = self._stat_index()
+        if stat is None or stat == self._index_stat:
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                self._index = {item["id"]: item for item in json.load(f)}
+        except Exception as e:
+            logger.error(f"重新加载对话索引失败: {e}")
+            return
+        self._index_stat = stat
+        self._build_order()
+
+    def _chat_path(self, chat_id: str) -> Optional[str]:
+        if not _CHAT_ID_RE.match(chat_id):
+            return None
+        return os.path.join(self.directory, f"{chat_id}.json")
+
+    def _log_path(self, chat_id: str) -> str:
+        return os.path.join(self.directory, f"{chat_id}.log.jsonl")
+
+    def _summary_path(self, chat_id: str) -> str:
+        return os.path.join(self.directory, f"{chat_id}.summary.json")
+
+    def _read_log(self, chat_id: str) -> List[dict]:
+        records = []
+        try:
+            f = open(self._log_path(chat_id), 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return []
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # 崩溃时可能留下写了一半的最后一行，忽略
+                    logger.warning(f"忽略损坏的追加日志行: {chat_id}")
+        return records
+
+    def _load_index(self) -> Dict[str, dict]:
+        """加载索引，必要时扫描对话文件重建"""
+        if os.path.exists(self.dirty_marker):
+            logger.warning("检测到未落盘的对话索引变更（上次可能异常退出），重建索引")
+            return self.rebuild_index()
+        if not os.path.exists(self.index_file):
+            if any(name.endswith(".json") for name in os.listdir(self.directory)):
+                logger.warning("对话索引文件不存在，扫描对话文件重建索引")
+                return self.rebuild_index()
+            return {}
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                return {item["id"]: item for item in json.load(f)}
+        except Exception as e:
+            logger.error(f"加载对话索引失败: {e}，扫描对话文件重建索引")
+            return self.rebuild_index()
+
+    def rebuild_index(self) -> Dict[str, dict]:
+        """扫描所有对话文件重建索引，并立即写盘"""
+        index = {chat_data["id"]: _summary(chat_data) for chat_data in self.iter_chats()}
+        _atomic_write_json(self.index_file, list(index.values()), indent=2)
+        if os.path.exists(self.dirty_marker):
+            os.remove(self.dirty_marker)
+        logger.info(f"对话索引重建完成，共 {len(index)} 个对话")
+        return index
+
+    def _mark_dirty(self):
+        """记录索引有未落盘的变更并安排一次延迟写盘（调用方需持有 _lock）"""
+        if self.multiprocess:
+            # 其他 worker 需要立即看到变更，在文件锁内直接写盘
+            _atomic_write_json(self.index_file, list(self._index.values()), indent=2)
+            self._index_stat = self._stat_index()
+            return
+        if not self._dirty:
+            self._dirty = True
+            with open(self.dirty_marker, 'w', encoding='utf-8'):
+                pass
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """把内存中的索引原子地写入 index.json"""
+        with self._flush_lock:
+            with self._lock:
+                self._flush_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                index = list(self._index.values())
+            try:
+                _atomic_write_json(self.index_file, index, indent=2)
+            except Exception as e:
+                logger.error(f"保存对话索引失败: {e}")
+                with self._lock:
+                    self._mark_dirty()
+                return
+            with self._lock:
+                if not self._dirty and os.path.exists(self.dirty_marker):
+                    os.remove(self.dirty_marker)
+
+    def close(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        self.flush()
+
+    def _write_chat_file(self, path: str, chat_data: dict):
+        chat_data = {key: value for key, value in chat_data.items() if key != "version"}
+        _atomic_write_json(path, chat_data, indent=2)
+
+    def _write_snapshot(self, chat_data: dict, generation: int):
+        """
+        把完整对话写入对话文件，并清空已合并的追加日志（调用方需持有写锁）
+
+        Args:
+            generation: 对话文件当前的日志代数（新对话为 0），写入时加一
+        """
+        self._write_chat_file(self._chat_path(chat_data["id"]), {**chat_data, "log_generation": generation + 1})
+        log_path = self._log_path(chat_data["id"])
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+    def _remove_order_key(self, item: dict):
+        key = (item.get("updated_at", ""), item["id"])
+        position = bisect.bisect_left(self._order, key)
+        if position < len(self._order) and self._order[position] == key:
+            del self._order[position]
+
+    def _update_index_entry(self, chat_data: dict):
+        """更新内存索引，只移动这一个对话的排序位置（调用方需持有 _lock）"""
+        old_item = self._index.get(chat_data["id"])
+        if old_item is not None:
+            self._remove_order_key(old_item)
+        item = _summary(chat_data)
+        self._index[item["id"]] = item
+        bisect.insort(self._order, (item["updated_at"], item["id"]))
+        self._mark_dirty()
+
+    def _remove_index_entry(self, chat_id: str):
+        """从内存索引中删除对话（调用方需持有 _lock）"""
+        item = self._index.pop(chat_id, None)
+        if item is not None:
+            self._remove_order_key(item)
+            self._mark_dirty()
+
+    def list_chats(self) -> List[dict]:
+        with self._lock:
+            self._refresh_index()
+            return [dict(self._index[chat_id]) for _, chat_id in reversed(self._order)]
+
+    def get_chat_entries(self, chat_ids: List[str]) -> Dict[str, dict]:
+        with self._lock:
+            self._refresh_index()
+            return {chat_id: dict(self._index[chat_id]) for chat_id in chat_ids if chat_id in self._index}
+
+    def list_chats_page(self, limit: int, cursor: Optional[str] = None) -> dict:
+        with self._lock:
+            self._refresh_index()
+            end = len(self._order)
+            if cursor:
+                end = bisect.bisect_left(self._order, decode_cursor(cursor))
+            start = max(0, end - limit)
+            chats = [dict(self._index[chat_id]) for _, chat_id in reversed(self._order[start:end])]
+        return {
+            "chats": chats,
+            "next_cursor": encode_cursor(chats[-1]) if start > 0 else None
+        }
+
+    def _read_chat(self, chat_id: str) -> Optional[Tuple[dict, int, int]]:
+        """
+        读取对话文件并合并追加日志，返回 (对话, 日志代数, 追加日志中的记录数)
+
+        Raises:
+            _SnapshotChanged: 读取期间对话文件被并发的合并替换或删除
+        """
+        path = self._chat_path(chat_id)
+        if path is None:
+            return None
+        try:
+            f = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        # 读完追加日志之前保持对话文件打开，inode 不会被新文件复用
+        with f:
+            chat_data = json.load(f)
+            records = self._read_log(chat_id)
+            try:
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    raise _SnapshotChanged()
+            except FileNotFoundError:
+                raise _SnapshotChanged()
+        generation = chat_data.pop("log_generation", 0)
+        for record in records:
+            if record.get("generation", 0) < generation:
+                continue  # 已合并进对话文件（合并后删除日志之前读到的旧日志）
+            chat_data["history"].extend(record["messages"])
+            chat_data["updated_at"] = record["updated_at"]
+            if record.get("title"):
+                chat_data["title"] = record["title"]
+        chat_data["version"] = len(chat_data["history"])
+        return chat_data, generation, len(records)
+
+    def get_chat(self, chat_id: str) -> Optional[dict]:
+        for _ in range(CHAT_READ_RETRIES):
+            try:
+                result = self._read_chat(chat_id)
+            except _SnapshotChanged:
+                continue
+            return result[0] if result is not None else None
+        # 持续有并发合并时在写锁内读取，期间不会有合并
+        with self._write_lock():
+            result = self._read_chat(chat_id)
+        return result[0] if result is not None else None
+
+    def put_chat(self, chat_data: dict):
+        path = self._chat_path(chat_data["id"])
+        if path is None:
+            raise ValueError(f"非法的对话 ID: {chat_data['id']}")
+        with self._write_lock():
+            current = self._read_chat(chat_data["id"])
+            self._write_snapshot(chat_data, current[1] if current is not None else 0)
+            self._update_index_entry(chat_data)
+
+    def update_title(self, chat_id: str, title: str, updated_at: str) -> bool:
+        with self._write_lock():
+            result = self._read_chat(chat_id)
+            if result is None:
+                return False
+            chat_data, generation, _ = result
+            chat_data["title"] = title
+            chat_data["updated_at"] = updated_at
+            self._write_snapshot(chat_data, generation)
+            self._update_index_entry(chat_data)
+        return True
+
+    def append_messages(
+        self,
+        chat_id: str,
+        messages: List[dict],
+        updated_at: str,
+        expected_version: Optional[int] = None,
+        title: Optional[str] = None
+    ) -> dict:
+        path = self._chat_path(chat_id)
+        if path is None:
+            raise ValueError(f"非法的对话 ID: {chat_id}")
+        with self._write_lock():
+            result = self._read_chat(chat_id)
+            if result is None:
+                if expected_version:
+                    raise VersionConflict(0)
+                chat_data = {
+                    "id": chat_id,
+                    "title": title or DEFAULT_CHAT_TITLE,
+                    "history": messages,
+                    "created_at": updated_at,
+                    "updated_at": updated_at
+                }
+                self._write_snapshot(chat_data, 0)
+                self._update_index_entry(chat_data)
+                return {"version": len(messages), "title": chat_data["title"]}
+
+            chat_data, generation, log_records = result
+            if expected_version is not None and expected_version != chat_data["version"]:
+                raise VersionConflict(chat_data["version"])
+
+            record = {"messages": messages, "updated_at": updated_at, "generation": generation}
+            if title and chat_data["title"] in ("", DEFAULT_CHAT_TITLE):
+                record["title"] = title
+                chat_data["title"] = title
+            chat_data["history"].extend(messages)
+            chat_data["updated_at"] = updated_at
+
+            if log_records + 1 >= CHAT_LOG_COMPACT_THRESHOLD:
+                self._write_snapshot(chat_data, generation)
+            else:
+                with open(self._log_path(chat_id), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._update_index_entry(chat_data)
+        return {"version": len(chat_data["history"]), "title": chat_data["title"]}
+
+    def delete_chat(self, chat_id: str):
+        path = self._chat_path(chat_id)
+        with self._write_lock():
+            if path is not None:
+                for file_path in (path, self._log_path(chat_id), self._summary_path(chat_id)):
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+            self._remove_index_entry(chat_id)
+
+    def get_summary(self, chat_id: str) -> Optional[dict]:
+        if self._chat_path(chat_id) is None:
+            return None
+        try:
+            with open(self._summary_path(chat_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_summary(self, chat_id: str, summary: dict):
+        if self._chat_path(chat_id) is None:
+            raise ValueError(f"非法的对话 ID: {chat_id}")
+        _atomic_write_json(self._summary_path(chat_id), summary, indent=2)
+
+    def iter_chats(self) -> Iterator[dict]:
+        """扫描目录中所有对话文件（不依赖 index.json，索引缺失或损坏时也能导出）"""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json") or name == "index.json" or name.endswith(".summary.json"):
+                continue
+            try:
+                chat_data = self.get_chat(name[:-len(".json")])
+            except Exception as e:
+                logger.error(f"读取对话文件失败 {name}: {e}")
+                continue
+            if isinstance(chat_data, dict) and chat_data.get("id"):
+                yield chat_data
+
+
+class SqliteChatStore(ChatStore):
+    """
+    SQLite 存储
+
+    chats 表保存对话元数据（id 主键，updated_at 建索引），messages 表按
+    (chat_id, seq) 保存每条消息的 JSON。
+    """
+
+    def __init__(self, path: str = CHAT_STORE_SQLITE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # timeout：多个 worker 同时写入时等待写锁的秒数
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chats (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_chats_updated_at_id ON chats(updated_at, id);
+            DROP INDEX IF EXISTS idx_chats_updated_at;
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                PRIMARY KEY (chat_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                chat_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL
+            );
+        """)
+
+    def list_chats(self) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, title, created_at, updated_at FROM chats ORDER BY updated_at DESC, id DESC"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_chat_entries(self, chat_ids: List[str]) -> Dict[str, dict]:
+        if not chat_ids:
+            return {}
+        placeholders = ", ".join("?" * len(chat_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, title, created_at, updated_at FROM chats WHERE id IN ({placeholders})", list(chat_ids)
+            ).fetchall()
+        return {row["id"]: dict(row) for row in rows}
+
+    def list_chats_page(self, limit: int, cursor: Optional[str] = None) -> dict:
+        # 多取一条用于判断是否还有下一页
+        if cursor:
+            query = (
+                "SELECT id, title, created_at, updated_at FROM chats WHERE (updated_at, id) < (?, ?) "
+                "ORDER BY updated_at DESC, id DESC LIMIT ?"
+            )
+            params = (*decode_cursor(cursor), limit + 1)
+        else:
+            query = "SELECT id, title, created_at, updated_at FROM chats ORDER BY updated_at DESC, id DESC LIMIT ?"
+            params = (limit + 1,)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        chats = [dict(row) for row in rows[:limit]]
+        return {
+            "chats": chats,
+            "next_cursor": encode_cursor(chats[-1]) if len(rows) > limit else None
+        }
+
+    def get_chat(self, chat_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, title, created_at, updated_at FROM chats WHERE id = ?", (chat_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            messages = self._conn.execute(
+                "SELECT message FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+            ).fetchall()
+        chat_data = dict(row)
+        chat_data["history"] = [json.loads(m["message"]) for m in messages]
+        chat_data["version"] = len(chat_data["history"])
+        return chat_data
+
+    def put_chat(self, chat_data: dict):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO chats (id, title, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at",
+                    (chat_data["id"], chat_data["title"], chat_data["created_at"], chat_data["updated_at"])
+                )
+                self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_data["id"],))
+                self._conn.executemany(
+                    "INSERT INTO messages (chat_id, seq, message) VALUES (?, ?, ?)",
+                    [
+                        (chat_data["id"], seq, json.dumps(message, ensure_ascii=False))
+                        for seq, message in enumerate(chat_data.get("history", []))
+                    ]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def update_title(self, chat_id: str, title: str, updated_at: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE chats SET title = ?, updated_at = ? WHERE id = ?",
+                (title, updated_at, chat_id)
+            )
+        return cursor.rowcount > 0
+
+    def append_messages(
+        self,
+        chat_id: str,
+        messages: List[dict],
+        updated_at: str,
+        expected_version: Optional[int] = None,
+        title: Optional[str] = None
+    ) -> dict:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT title FROM chats WHERE id = ?", (chat_id,)).fetchone()
+                if row is None:
+                    if expected_version:
+                        raise VersionConflict(0)
+                    current_title = title or DEFAULT_CHAT_TITLE
+                    self._conn.execute(
+                        "INSERT INTO chats (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                        (chat_id, current_title, updated_at, updated_at)
+                    )
+                    version = 0
+                else:
+                    current_title = row["title"]
+                    version = self._conn.execute(
+                        "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE chat_id = ?", (chat_id,)
+                    ).fetchone()[0]
+                    if expected_version is not None and expected_version != version:
+                        raise VersionConflict(version)
+                    if title and current_title in ("", DEFAULT_CHAT_TITLE):
+                        current_title = title
+                    self._conn.execute(
+                        "UPDATE chats SET title = ?, updated_at = ? WHERE id = ?",
+                        (current_title, updated_at, chat_id)
+                    )
+
+                self._conn.executemany(
+                    "INSERT INTO messages (chat_id, seq, message) VALUES (?, ?, ?)",
+                    [
+                        (chat_id, version + i, json.dumps(message, ensure_ascii=False))
+                        for i, message in enumerate(messages)
+                    ]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {"version": version + len(messages), "title": current_title}
+
+    def delete_chat(self, chat_id: str):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                self._conn.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+                self._conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get_summary(self, chat_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM summaries WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row["summary"]) if row is not None else None
+
+    def put_summary(self, chat_id: str, summary: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO summaries (chat_id, summary) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary",
+                (chat_id, json.dumps(summary, ensure_ascii=False))
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate(source: ChatStore, target: ChatStore) -> int:
+    """
+    把 source 中的所有对话及其滚动摘要写入 target（同 ID 的对话会被覆盖）
+
+    Returns:
+        int: 迁移的对话数
+    """
+    count = 0
+    for chat_data in source.iter_chats():
+        chat_data.setdefault("title", "新对话")
+        chat_data.setdefault("history", [])
+        chat_data.setdefault("created_at", chat_data.get("updated_at", ""))
+        chat_data.setdefault("updated_at", chat_data["created_at"])
+        target.put_chat(chat_data)
+        summary = source.get_summary(chat_data["id"])
+        if summary is not None:
+            target.put_summary(chat_data["id"], summary)
+        count += 1
+    return count
+
+
+class MeteredChatStore(ChatStore):
+    """把每个存储操作的耗时记入 chat_store_operation_seconds 指标和当前 trace 的包装"""
+
+    def __init__(self, store: ChatStore, backend: str):
+        self.store = store
+        self.backend = backend
+
+    @contextmanager
+    def _timed(self, operation: str):
+        with tracer.span(f"chat_store.{operation}", backend=self.backend), \
+                metrics.chat_store_seconds.time(backend=self.backend, operation=operation):
+            yield
+
+    def list_chats(self) -> List[dict]:
+        with self._timed("list_chats"):
+            return self.store.list_chats()
+
+    def list_chats_page(self, limit: int, cursor: Optional[str] = None) -> dict:
+        with self._timed("list_chats_page"):
+            return self.store.list_chats_page(limit, cursor)
+
+    def get_chat(self, chat_id: str) -> Optional[dict]:
+        with self._timed("get_chat"):
+            return self.store.get_chat(chat_id)
+
+    def get_chat_entries(self, chat_ids: List[str]) -> Dict[str, dict]:
+        with self._timed("get_chat_entries"):
+            return self.store.get_chat_entries(chat_ids)
+
+    def put_chat(self, chat_data: dict):
+        with self._timed("put_chat"):
+            return self.store.put_chat(chat_data)
+
+    def update_title(self, chat_id: str, title: str, updated_at: str) -> bool:
+        with self._timed("update_title"):
+            return self.store.update_title(chat_id, title, updated_at)
+
+    def append_messages(
+        self,
+        chat_id: str,
+        messages: List[dict],
+        updated_at: str,
+        expected_version: Optional[int] = None,
+        title: Optional[str] = None
+    ) -> dict:
+        with self._timed("append_messages"):
+            return self.store.append_messages(chat_id, messages, updated_at, expected_version, title)
+
+    def delete_chat(self, chat_id: str):
+        with self._timed("delete_chat"):
+            return self.store.delete_chat(chat_id)
+
+    def get_summary(self, chat_id: str) -> Optional[dict]:
+        with self._timed("get_summary"):
+            return self.store.get_summary(chat_id)
+
+    def put_summary(self, chat_id: str, summary: dict):
+        with self._timed("put_summary"):
+            return self.store.put_summary(chat_id, summary)
+
+    def close(self):
+        self.store.close()
+
+    def iter_chats(self) -> Iterator[dict]:
+        return self.store.iter_chats()
+
+
+def create_chat_store(backend: str = CHAT_STORE_BACKEND, multiprocess: bool = False) -> ChatStore:
+    """
+    根据配置创建存储后端（带操作耗时指标）
+
+    Args:
+        backend: file 或 sqlite
+        multiprocess: 是否有多个 worker 进程共用同一份存储（sqlite 后端本身支持多进程）
+    """
+    if backend == "file":
+        return MeteredChatStore(FileChatStore(CHAT_HISTORY_DIR, multiprocess=multiprocess), backend)
+    if backend == "sqlite":
+        return MeteredChatStore(SqliteChatStore(CHAT_STORE_SQLITE_PATH), backend)
+    raise ValueError(f"未知的对话存储后端: {backend}")
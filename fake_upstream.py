@@ -0,0 +1,283 @@
+"""
+压测用的本地 AI Builder Space 替身
+
+模拟 POST /chat/completions（包括 tool_calls 和流式输出）和 POST /search/，
+延迟按可配置的分布随机抽样，不需要真实的 AI_BUILDER_TOKEN。对话行为：
+- 请求带 tools、且本轮用户消息之后的工具调用轮数少于 FAKE_TOOL_ROUNDS 时，
+  返回 FAKE_TOOL_CALLS 个 search 工具调用
+- 否则返回 FAKE_ANSWER_CHUNKS 个片段组成的最终答案；流式输出先等待首字延迟，
+  之后每个片段间隔 FAKE_TOKEN_INTERVAL
+
+延迟分布的写法：
+- "0.5"：固定 0.5 秒
+- "uniform:0.2,1.0"：0.2 到 1.0 秒之间均匀分布
+- "lognormal:0.8,0.5"：中位数 0.8 秒、sigma 为 0.5 的对数正态分布（长尾）
+
+启动：
+    python fake_upstream.py --port 9100
+    AI_BUILDER_BASE_URL=http://127.0.0.1:9100 AI_BUILDER_TOKEN=bench uvicorn main:app
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+from typing import Callable, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    解析延迟分布，返回每次调用抽样一个延迟（秒）的函数
+
+    Raises:
+        ValueError: 当写法无法识别时
+    """
+    kind, _, params = spec.strip().partition(":")
+    if not params:
+        value = float(kind)
+        return lambda: value
+    args = [float(part) for part in params.split(",")]
+    if kind == "uniform" and len(args) == 2:
+        low, high = args
+        return lambda: random.uniform(low, high)
+    if kind == "lognormal" and len(args) == 2:
+        median, sigma = args
+        return lambda: random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+    raise ValueError(f"无法识别的延迟分布: {spec}")
+
+
+class FakeConfig:
+    """替身的行为配置，默认值来自环境变量"""
+
+    def __init__(self):
+        self.chat_latency = os.getenv("FAKE_CHAT_LATENCY", "lognormal:0.8,0.4")
+        self.ttft = os.getenv("FAKE_TTFT", "lognormal:0.4,0.4")
+        self.token_interval = os.getenv("FAKE_TOKEN_INTERVAL", "0.02")
+        self.search_latency = os.getenv("FAKE_SEARCH_LATENCY", "lognormal:0.3,0.4")
+        self.answer_chunks = int(os.getenv("FAKE_ANSWER_CHUNKS", "40"))
+        self.tool_rounds = int(os.getenv("FAKE_TOOL_ROUNDS", "1"))
+        self.tool_calls = int(os.getenv("FAKE_TOOL_CALLS", "2"))
+        self.error_rate = float(os.getenv("FAKE_ERROR_RATE", "0"))
+        self.compile()
+
+    def compile(self):
+        """校验并生成各延迟分布的抽样函数"""
+        self.sample_chat = parse_latency(self.chat_latency)
+        self.sample_ttft = parse_latency(self.ttft)
+        self.sample_token_interval = parse_latency(self.token_interval)
+        self.sample_search = parse_latency(self.search_latency)
+
+    def to_dict(self) -> dict:
+        return {
+            "chat_latency": self.chat_latency,
+            "ttft": self.ttft,
+            "token_interval": self.token_interval,
+            "search_latency": self.search_latency,
+            "answer_chunks": self.answer_chunks,
+            "tool_rounds": self.tool_rounds,
+            "tool_calls": self.tool_calls,
+            "error_rate": self.error_rate,
+        }
+
+
+config = FakeConfig()
+stats = {"chat": 0, "chat_stream": 0, "search": 0, "search_keywords": 0, "errors": 0}
+
+app = FastAPI(title="Fake AI Builder Space")
+
+
+def _injected_error() -> Optional[JSONResponse]:
+    if config.error_rate > 0 and random.random() < config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"error": "fake upstream error"}, status_code=503)
+    return None
+
+
+def _last_user_content(messages: List[dict]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+
+def _tool_rounds_done(messages: List[dict]) -> int:
+    """最后一条用户消息之后已经进行的工具调用轮数"""
+    rounds = 0
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            break
+        if message.get("role") == "assistant" and message.get("tool_calls"):
+            rounds += 1
+    return rounds
+
+
+def _estimate_tokens(messages: List[dict]) -> int:
+    return sum(len(message.get("content") or "") for message in messages) // 2 + 1
+
+
+def _plan_response(body: dict):
+    """决定本次返回工具调用还是最终答案，返回 (answer_chunks, tool_calls)"""
+    messages = body.get("messages") or []
+    question = _last_user_content(messages)
+    rounds = _tool_rounds_done(messages)
+    if body.get("tools") and body.get("tool_choice") != "none" and rounds < config.tool_rounds:
+        tool_calls = [
+            {
+                "id": f"call_{rounds}_{i}_{random.getrandbits(32):08x}",
+                "type": "function",
+                "function": {
+                    "name": "search",
+                    "arguments": json.dumps({"keyword": f"{question[:30]} 第{rounds + 1}轮 {i}", "max_results": 6},
+                                            ensure_ascii=False)
+                }
+            }
+            for i in range(config.tool_calls)
+        ]
+        return None, tool_calls
+    chunks = [f"第{i + 1}段回答。" for i in range(config.answer_chunks)]
+    return chunks, None
+
+
+def _usage(body: dict, completion_tokens: int) -> dict:
+    prompt_tokens = _estimate_tokens(body.get("messages") or [])
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+
+def _sse(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream(body: dict, chunks: Optional[List[str]], tool_calls: Optional[List[dict]]):
+    await asyncio.sleep(config.sample_ttft())
+    created = int(time.time())
+    base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": body.get("model")}
+    if tool_calls:
+        for index, tool_call in enumerate(tool_calls):
+            arguments = tool_call["function"]["arguments"]
+            half = len(arguments) // 2
+            yield _sse({**base, "choices": [{"index": 0, "finish_reason": None, "delta": {"tool_calls": [{
+                "index": index, "id": tool_call["id"], "type": "function",
+                "function": {"name": "search", "arguments": arguments[:half]}
+            }]}}]})
+            yield _sse({**base, "choices": [{"index": 0, "finish_reason": None, "delta": {"tool_calls": [{
+                "index": index, "function": {"arguments": arguments[half:]}
+            }]}}]})
+        yield _sse({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}],
+                    "usage": _usage(body, 20 * len(tool_calls))})
+    else:
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(config.sample_token_interval())
+            yield _sse({**base, "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]})
+        yield _sse({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                    "usage": _usage(body, len(chunks))})
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    error = _injected_error()
+    if error is not None:
+        return error
+    chunks, tool_calls = _plan_response(body)
+
+    if body.get("stream"):
+        stats["chat_stream"] += 1
+        return StreamingResponse(_stream(body, chunks, tool_calls), media_type="text/event-stream")
+
+    stats["chat"] += 1
+    await asyncio.sleep(config.sample_chat())
+    if tool_calls:
+        message = {"role": "assistant", "content": None, "tool_calls": tool_calls}
+        finish_reason, completion_tokens = "tool_calls", 20 * len(tool_calls)
+    else:
+        message = {"role": "assistant", "content": "".join(chunks)}
+        finish_reason, completion_tokens = "stop", len(chunks)
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": _usage(body, completion_tokens)
+    }
+
+
+@app.post("/search/")
+async def search(request: Request):
+    body = await request.json()
+    error = _injected_error()
+    if error is not None:
+        return error
+    keywords = body.get("keywords") or []
+    max_results = int(body.get("max_results") or 6)
+    stats["search"] += 1
+    stats["search_keywords"] += len(keywords)
+    await asyncio.sleep(config.sample_search())
+    return {
+        "queries": [
+            {
+                "keyword": keyword,
+                "response": {
+                    "results": [
+                        {
+                            "title": f"{keyword} - 结果 {i + 1}",
+                            "url": f"https://example.com/{i + 1}",
+                            "content": f"关于 {keyword} 的模拟搜索结果内容。" * 8
+                        }
+                        for i in range(max_results)
+                    ]
+                }
+            }
+            for keyword in keywords
+        ],
+        "combined_answer": ""
+    }
+
+
+@app.get("/fake/stats")
+async def get_stats():
+    """调用计数和当前配置"""
+    return {"calls": stats, "config": config.to_dict()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 AI Builder Space 替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--chat-latency", help="非流式调用的延迟分布")
+    parser.add_argument("--ttft", help="流式调用的首字延迟分布")
+    parser.add_argument("--token-interval", help="流式片段间隔分布")
+    parser.add_argument("--search-latency", help="搜索延迟分布")
+    parser.add_argument("--answer-chunks", type=int, help="最终答案的片段数")
+    parser.add_argument("--tool-rounds", type=int, help="每次对话的工具调用轮数")
+    parser.add_argument("--tool-calls", type=int, help="每轮工具调用数")
+    parser.add_argument("--error-rate", type=float, help="返回 503 的比例")
+    parser.add_argument("--seed", type=int, help="随机数种子")
+    args = parser.parse_args()
+
+    for name in ("chat_latency", "ttft", "token_interval", "search_latency",
+                 "answer_chunks", "tool_rounds", "tool_calls", "error_rate"):
+        value = getattr(args, name)
+        if value is not None:
+            setattr(config, name, value)
+    config.compile()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+LLM 请求对冲（hedged requests）
+
+/chat 的 p99 延迟主要来自偶发的、远慢于中位数的上游补全。开启后，Agentic
+Loop 的每一轮非流式 LLM 调用：
+- 按模型记录最近 LLM_HEDGE_WINDOW 次成功调用的耗时
+- 调用超过这些耗时的第 LLM_HEDGE_PERCENTILE 百分位（且不少于
+  LLM_HEDGE_MIN_DELAY 秒）仍未返回时，再发一个相同的请求
+- 两个请求谁先成功返回就用谁的结果，另一个立即取消；其中一个失败时继续
+  等待另一个
+- 最近的调用中被对冲的比例不超过 LLM_HEDGE_MAX_RATE，避免上游整体变慢时
+  请求量翻倍
+- 样本数不足 LLM_HEDGE_MIN_SAMPLES 时不对冲
+
+默认关闭（LLM_HEDGE_ENABLED）。对冲请求同样经过准入控制和熔断器。
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))
+
+
+class LatencyWindow:
+    """最近 N 次调用耗时的滑动窗口"""
+
+    def __init__(self, size: int):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """第 p 百分位（最近秩法），没有样本返回 None"""
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        rank = max(1, math.ceil(p / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+
+class Hedger:
+    """按近期耗时百分位触发的请求对冲"""
+
+    def __init__(
+        self,
+        enabled: bool = LLM_HEDGE_ENABLED,
+        percentile: float = LLM_HEDGE_PERCENTILE,
+        min_delay: float = LLM_HEDGE_MIN_DELAY,
+        max_rate: float = LLM_HEDGE_MAX_RATE,
+        min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+        window: int = LLM_HEDGE_WINDOW
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies: Dict[str, LatencyWindow] = {}
+        self._recent_hedged = deque(maxlen=window)  # 最近的调用是否被对冲
+        self.stats = {
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "rate_limited": 0,
+            "hedge_failures": 0,
+        }
+
+    def _window(self, key: str) -> LatencyWindow:
+        window = self._latencies.get(key)
+        if window is None:
+            window = self._latencies[key] = LatencyWindow(self.window)
+        return window
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """多久没有返回就发对冲请求，样本不足时返回 None"""
+        window = self._window(key)
+        if len(window) < max(self.min_samples, 1):
+            return None
+        return max(self.min_delay, window.percentile(self.percentile))
+
+    def _allow_hedge(self) -> bool:
+        hedged = sum(self._recent_hedged)
+        return hedged < self.max_rate * max(len(self._recent_hedged), 1)
+
+    async def _timed(self, fn: Callable[[], Awaitable]):
+        started_at = time.perf_counter()
+        result = await fn()
+        return result, time.perf_counter() - started_at
+
+    async def run(self, key: str, fn: Callable[[], Awaitable]):
+        """
+        执行 fn()，超过对冲延迟仍未返回时并发执行第二次 fn()，返回先成功的结果
+
+        Args:
+            key: 延迟统计的分组（模型名）
+            fn: 发出一次上游调用的函数，每次调用都会发出一个新请求
+
+        Raises:
+            两个请求都失败时，抛出先发出的请求的异常
+        """
+        if not self.enabled:
+            return await fn()
+
+        self.stats["calls"] += 1
+        window = self._window(key)
+        delay = self.hedge_delay(key)
+        started_at = time.perf_counter()
+        primary = asyncio.create_task(self._timed(fn))
+        hedge = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done:
+                    if self._allow_hedge():
+                        hedge = asyncio.create_task(self._timed(fn))
+                        self.stats["hedged"] += 1
+                        logger.info(f"🪁 LLM 调用超过 {delay:.1f}s 未返回，发出对冲请求")
+                    else:
+                        self.stats["rate_limited"] += 1
+            self._recent_hedged.append(hedge is not None)
+
+            if hedge is None:
+                result, elapsed = await primary
+                window.add(elapsed)
+                return result
+
+            pending = {primary, hedge}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先使用先发出的请求
+                for task in sorted(done, key=lambda t: t is hedge):
+                    if task.exception() is None:
+                        result, elapsed = task.result()
+                        # 对冲请求获胜时，先发出的请求至少已经耗时这么久；只记录对冲请求
+                        # 自身的耗时会低估延迟分布，使对冲延迟越来越短
+                        window.add(time.perf_counter() - started_at if task is hedge else elapsed)
+                        self.stats["hedge_wins" if task is hedge else "primary_wins"] += 1
+                        return result
+                    if task is hedge:
+                        self.stats["hedge_failures"] += 1
+                if not pending:
+                    # 两个都失败了
+                    return primary.result()[0]
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "hedge_rate": round(sum(self._recent_hedged) / len(self._recent_hedged), 4)
+            if self._recent_hedged else 0.0,
+            "max_rate": self.max_rate,
+            "delays": {
+                key: round(delay, 3) if (delay := self.hedge_delay(key)) is not None else None
+                for key in list(self._latencies)
+            },
+        }
+
+
+llm_hedger = Hedger()
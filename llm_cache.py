@@ -0,0 +1,155 @@
+"""
+LLM 响应缓存（精确匹配）
+
+演示问题、客户端断开后的重试、脚本化的测试流量会反复向上游发送完全相同的
+请求。这里按请求体的规范化哈希缓存上游的完整响应：
+- 键：去掉 stream 字段后按键排序序列化的请求体的 SHA-256，模型、消息、工具
+  结果、温度等任何字段不同都不会命中
+- 只缓存正常结束（finish_reason 为 stop 或 tool_calls）的响应；命中时不带
+  usage，避免重复计入 token 用量
+- 内存层是有容量上限的 LRU，条目带 TTL；多 worker 模式下增加 shared_state
+  共享层
+- 默认关闭（LLM_CACHE_ENABLED），请求可以单独要求跳过缓存
+
+Agentic Loop 的每一轮（包括流式和非流式）都会先查缓存。
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from shared_state import SharedState, shared_state
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "256"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "300"))
+
+CACHEABLE_FINISH_REASONS = ("stop", "tool_calls")
+
+
+def payload_key(payload: dict) -> str:
+    """请求体的规范化哈希（不区分流式和非流式）"""
+    canonical = json.dumps(
+        {key: value for key, value in payload.items() if key != "stream"},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """按请求体精确匹配的 LLM 响应缓存"""
+
+    def __init__(self, enabled: bool, max_entries: int, ttl: float, shared: Optional[SharedState] = None):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "skipped": 0,
+            "bypassed": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _memory_get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.stats["expirations"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["memory_hits"] += 1
+        return copy.deepcopy(response)
+
+    def _memory_put(self, key: str, response: dict):
+        with self._lock:
+            self._entries[key] = (response, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def _shared_get(self, key: str) -> Optional[dict]:
+        response = self.shared.get(f"llm:{key}")
+        if response is None:
+            return None
+        self._memory_put(key, response)
+        self._count("shared_hits")
+        # 内存层保存的是同一个对象，返回副本，调用方修改响应不会影响缓存
+        return copy.deepcopy(response)
+
+    def use_for(self, bypass: bool) -> bool:
+        """本次请求是否使用缓存（bypass 为请求中的跳过标志）"""
+        if not self.enabled:
+            return False
+        if bypass:
+            self._count("bypassed")
+            return False
+        return True
+
+    async def get(self, payload: dict) -> Optional[dict]:
+        """查找缓存，未命中返回 None"""
+        key = payload_key(payload)
+        response = self._memory_get(key)
+        if response is None and self.shared is not None:
+            response = await asyncio.to_thread(self._shared_get, key)
+        if response is None:
+            self._count("misses")
+        return response
+
+    async def put(self, payload: dict, response: dict):
+        """写入缓存（只缓存正常结束的响应）"""
+        choices = response.get("choices") or []
+        if not choices or choices[0].get("finish_reason") not in CACHEABLE_FINISH_REASONS:
+            self._count("skipped")
+            return
+        response = {key: copy.deepcopy(value) for key, value in response.items() if key != "usage"}
+        key = payload_key(payload)
+        self._memory_put(key, response)
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.set, f"llm:{key}", response, self.ttl)
+        self._count("stores")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            size = len(self._entries)
+        hits = stats["memory_hits"] + stats["shared_hits"]
+        lookups = hits + stats["misses"]
+        return {
+            **stats,
+            "enabled": self.enabled,
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+llm_cache = LLMResponseCache(
+    enabled=LLM_CACHE_ENABLED,
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    ttl=LLM_CACHE_TTL,
+    shared=shared_state
+)
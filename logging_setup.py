@@ -0,0 +1,140 @@
+"""
+日志配置
+
+原先日志通过同步的 FileHandler + StreamHandler 输出，每轮对话的大量日志（包括
+完整消息历史的 JSON）在请求路径上格式化并写盘。这里改为：
+- 请求路径上的 logger 只把记录放进内存队列（QueueHandler），格式化和写盘在
+  后台线程（QueueListener）中完成
+- 日志文件为每行一条的 JSON 记录，按大小轮转（LOG_MAX_BYTES / LOG_BACKUP_COUNT）；
+  控制台仍输出便于阅读的文本
+- 完整消息历史记录到单独的 transcript logger，级别为 DEBUG，默认不记录；
+  LOG_TRANSCRIPT_SAMPLE_RATE 大于 0 时按比例抽样记录
+
+多 worker 模式下每个 worker 写各自的日志文件（文件名带 pid），避免多个进程
+同时轮转同一个文件。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from datetime import datetime, timezone
+
+from shared_state import WORKER_COUNT
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# 抽样记录完整消息历史的比例（0 表示不记录，1 表示每次都记录）
+LOG_TRANSCRIPT_SAMPLE_RATE = float(os.getenv("LOG_TRANSCRIPT_SAMPLE_RATE", "0"))
+
+CONSOLE_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# LogRecord 自带的属性，其余属性视为通过 extra 传入的结构化字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+transcript_logger = logging.getLogger("transcript")
+
+_listener = None
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """文本格式，结构化字段以缩进的 JSON 附在消息之后"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        for key, value in _extra_fields(record).items():
+            text += f"\n   {key}: {json.dumps(value, ensure_ascii=False, indent=2, default=str)}"
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    只在请求路径上合并消息参数，不做格式化
+
+    标准 QueueHandler 会在入队前用默认格式把异常堆栈拼进消息，这样后台的
+    JSON 格式化就拿不到原始字段了
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _log_file() -> str:
+    name = f"chat_agentic.{os.getpid()}.log" if WORKER_COUNT > 1 else "chat_agentic.log"
+    return os.path.join(LOG_DIR, name)
+
+
+def setup_logging():
+    """为根 logger 配置基于队列的日志输出，重复调用无效"""
+    global _listener
+    if _listener is not None:
+        return
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        _log_file(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ConsoleFormatter(CONSOLE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+
+    # 完整消息历史单独控制：开启抽样时放行 DEBUG 记录，与 LOG_LEVEL 无关
+    transcript_logger.setLevel(logging.DEBUG if LOG_TRANSCRIPT_SAMPLE_RATE > 0 else logging.WARNING)
+
+
+def shutdown_logging():
+    """停止后台线程，写出队列中剩余的记录"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def should_log_transcript() -> bool:
+    """本次对话是否记录完整消息历史（按 LOG_TRANSCRIPT_SAMPLE_RATE 抽样）"""
+    if not transcript_logger.isEnabledFor(logging.DEBUG):
+        return False
+    return random.random() < LOG_TRANSCRIPT_SAMPLE_RATE
@@ -1,44 +1,63 @@
-from fastapi import FastAPI, Path, Query, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import FastAPI, Header, Path, Query, HTTPException, Request
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional, List
-import requests
+from typing import Awaitable, Callable, Optional, List, Union
+import httpx
 import os
 import json as json_lib
 import logging
 import asyncio
+import math
+import time
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import uuid
 
+import metrics
+from logging_setup import setup_logging
+from tracing import TracingMiddleware, tracer
+import upstream
+from agent import (
+    AgentCancelled,
+    AgentEngine,
+    AgentError,
+    AgentRun,
+    CONTENT as AGENT_CONTENT,
+    DONE as AGENT_DONE,
+    ROUND_STARTED as AGENT_ROUND_STARTED,
+    TOOL_FINISHED as AGENT_TOOL_FINISHED,
+    TOOL_STARTED as AGENT_TOOL_STARTED
+)
+from search_cache import search_cache, normalize_keyword, truncate_results
+from singleflight import SingleFlight
+from speculative_search import Speculation, SpeculativeSearch
+from tools import ToolSpec, tool_registry, tool_executor
+from chat_store import create_chat_store, VersionConflict
+from chat_search import chat_search_index
+from shared_state import shared_state, MULTI_WORKER, WORKER_COUNT
+from chat_context import ChatContextManager
+from llm_cache import llm_cache
+from hedging import llm_hedger
+from resilience import CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from admission import (
+    AdmissionRejected,
+    PRIORITY_API,
+    PRIORITY_INTERACTIVE,
+    llm_admission,
+    parse_priority,
+    search_admission,
+    set_priority
+)
+
 # 加载环境变量
 load_dotenv()
 
-# 配置日志
-log_dir = "logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-log_file = os.path.join(log_dir, f"chat_agentic_{datetime.now().strftime('%Y%m%d')}.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
-        logging.StreamHandler()  # 同时输出到控制台
-    ]
-)
+# 配置日志（写盘在后台线程中进行）
+setup_logging()
 
 logger = logging.getLogger(__name__)
 
-# AI Builder Space 配置
-AI_BUILDER_BASE_URL = "https://space.ai-builders.com/backend/v1"
-AI_BUILDER_CHAT_ENDPOINT = f"{AI_BUILDER_BASE_URL}/chat/completions"
-AI_BUILDER_SEARCH_ENDPOINT = f"{AI_BUILDER_BASE_URL}/search/"
-
 app = FastAPI(
     title="Challen的AI应用",
     description="""
@@ -65,42 +84,75 @@ app = FastAPI(
     },
 )
 
+# 为对话、搜索和对话历史接口记录 trace（响应头 X-Trace-Id）
+app.add_middleware(TracingMiddleware)
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    """应用关闭时释放上游连接池"""
+    await upstream.close()
+
+
+@app.on_event("startup")
+async def build_chat_search_index():
+    """在后台线程中为已有对话建立全文索引，不阻塞启动"""
+    if shared_state is not None:
+        # 记录事件日志的当前位置，构建开始之后其他 worker 的修改由 _sync_chat_search_index 补上
+        shared_state.poll("chats")
+
+    def build():
+        started_at = time.perf_counter()
+        count = chat_search_index.build(chat_store.iter_chats())
+        logger.info(f"🔎 对话全文索引构建完成: {count} 个对话，耗时 {time.perf_counter() - started_at:.2f}s")
+
+    asyncio.get_running_loop().run_in_executor(None, build)
+
+
+@app.on_event("shutdown")
+def close_chat_store():
+    """应用关闭时把尚未落盘的对话索引写入磁盘"""
+    chat_store.close()
+    if shared_state is not None:
+        shared_state.close()
+
+
 # 挂载静态文件
 static_dir = os.path.join(os.path.dirname(__file__), "static")
 if os.path.exists(static_dir):
     app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
-# 对话历史存储目录
-CHAT_HISTORY_DIR = "chat_history"
-if not os.path.exists(CHAT_HISTORY_DIR):
-    os.makedirs(CHAT_HISTORY_DIR)
-
-# 对话历史索引文件
-CHAT_INDEX_FILE = os.path.join(CHAT_HISTORY_DIR, "index.json")
-
-def load_chat_index():
-    """加载对话索引"""
-    if os.path.exists(CHAT_INDEX_FILE):
-        try:
-            with open(CHAT_INDEX_FILE, 'r', encoding='utf-8') as f:
-                return json_lib.load(f)
-        except Exception as e:
-            logger.error(f"加载对话索引失败: {e}")
-            return []
-    return []
-
-def save_chat_index(index):
-    """保存对话索引"""
-    try:
-        with open(CHAT_INDEX_FILE, 'w', encoding='utf-8') as f:
-            json_lib.dump(index, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"保存对话索引失败: {e}")
-        raise HTTPException(status_code=500, detail=f"保存对话索引失败: {e}")
+# 对话历史存储（后端由 CHAT_STORE_BACKEND 选择，多 worker 模式下文件后端使用文件锁）
+chat_store = create_chat_store(multiprocess=MULTI_WORKER)
+# 按 token 预算裁剪发给 LLM 的对话历史，较早的消息用存储中的滚动摘要代替
+chat_context = ChatContextManager(chat_store)
+# 对话列表分页的默认/最大每页条数
+CHAT_LIST_DEFAULT_LIMIT = int(os.getenv("CHAT_LIST_DEFAULT_LIMIT", "50"))
+CHAT_LIST_MAX_LIMIT = 200
+CHAT_SEARCH_MAX_LIMIT = 100
+
+def _publish_chat_change(chat_id: str):
+    """多 worker 模式下通知其他 worker 该对话已变更"""
+    if shared_state is not None:
+        shared_state.publish("chats", chat_id)
+
+
+def _sync_chat_search_index():
+    """把其他 worker 修改过的对话同步到本进程的全文索引"""
+    if shared_state is None:
+        return
+    changed = shared_state.poll("chats")
+    if changed is None:
+        logger.warning("⚠️ 落后于其他 worker 的对话变更过多，重建对话全文索引")
+        chat_search_index.clear()
+        chat_search_index.build(chat_store.iter_chats())
+        return
+    for chat_id in dict.fromkeys(changed):
+        chat_data = chat_store.get_chat(chat_id)
+        if chat_data is None:
+            chat_search_index.remove_chat(chat_id)
+        else:
+            chat_search_index.index_chat(chat_data)
 
-def get_chat_file_path(chat_id):
-    """获取对话文件的路径"""
-    return os.path.join(CHAT_HISTORY_DIR, f"{chat_id}.json")
 
 def generate_title_from_message(message: str) -> str:
     """根据用户消息生成标题"""
@@ -110,6 +162,34 @@ def generate_title_from_message(message: str) -> str:
         title = title[:30] + "..."
     return title if title else "新对话"
 
+
+def _append_to_chat(chat_id: str, messages: List[dict], expected_version: Optional[int] = None) -> dict:
+    """
+    追加消息到对话末尾，并同步全文索引和其他 worker
+
+    对话仍是默认标题时，用新增消息中的第一条用户消息生成标题。
+
+    Returns:
+        dict: {"version": 追加后的版本, "title": 当前标题, "updated_at": 更新时间}
+    """
+    title = None
+    for msg in messages:
+        if msg.get("role") == "user" and msg.get("content"):
+            title = generate_title_from_message(msg["content"])
+            break
+    
+    now = datetime.now().isoformat()
+    result = chat_store.append_messages(
+        chat_id,
+        messages,
+        now,
+        expected_version=expected_version,
+        title=title
+    )
+    chat_search_index.add_messages(chat_id, messages, result["title"])
+    _publish_chat_change(chat_id)
+    return {**result, "updated_at": now}
+
 @app.get("/")
 async def root():
     """返回前端页面"""
@@ -211,6 +291,7 @@ class ChatRequest(BaseModel):
     model: Optional[str] = "gpt-5"
     temperature: Optional[float] = 1.0
     max_tokens: Optional[int] = None
+    bypass_cache: bool = False  # 为 True 时本次请求不读写 LLM 响应缓存
     
     class Config:
         json_schema_extra = {
@@ -242,93 +323,229 @@ class ChatResponse(BaseModel):
         }
 
 
-def _execute_single_tool_call(tool_call: dict) -> tuple:
+def _format_search_content(keyword: str, search_result: dict, searched_keyword: Optional[str] = None) -> str:
     """
-    执行单个工具调用
+    将搜索结果格式化为提供给模型的工具结果文本
     
     Args:
-        tool_call: 工具调用对象
+        keyword: 搜索关键字
+        search_result: 搜索 API 返回的结果
+        searched_keyword: 实际搜索的关键字（使用相近关键字的推测搜索结果时），为空表示就是 keyword
         
     Returns:
-        tuple: (tool_call_id, search_content)
+        str: 搜索结果文本
     """
-    function_name = tool_call["function"]["name"]
-    tool_call_id = tool_call["id"]
+    results = []
+    if "queries" in search_result and len(search_result["queries"]) > 0:
+        query_result = search_result["queries"][0]
+        if "response" in query_result and "results" in query_result["response"]:
+            results = query_result["response"]["results"]
     
-    logger.info("=" * 80)
-    logger.info(f"🔧 开始执行工具调用")
-    logger.info(f"   工具ID: {tool_call_id}")
-    logger.info(f"   工具名称: {function_name}")
+    logger.info(f"   ✅ 搜索完成，找到 {len(results)} 个结果")
+    metrics.search_results.observe(len(results), source="tool")
+    tracer.annotate(results=len(results))
     
-    if function_name == "search":
-        try:
-            function_args = json_lib.loads(tool_call["function"]["arguments"])
-            keyword = function_args.get("keyword")
-            max_results = function_args.get("max_results", 6)
-            
-            logger.info(f"   工具参数:")
-            logger.info(f"     - keyword: {keyword}")
-            logger.info(f"     - max_results: {max_results}")
+    # 构建搜索结果文本
+    if searched_keyword and normalize_keyword(searched_keyword) != normalize_keyword(keyword):
+        # 推测搜索的关键字与模型给出的只是相近，告诉模型实际搜索的是什么
+        search_content = f"搜索关键字: {searched_keyword}（与请求的关键字「{keyword}」相近，以下是该关键字的结果）\n\n"
+    else:
+        search_content = f"搜索关键字: {keyword}\n\n"
+    if results:
+        search_content += f"找到 {len(results)} 个结果:\n\n"
+        for i, result in enumerate(results[:5], 1):  # 只取前5个结果
+            title = result.get('title', 'N/A')
+            url = result.get('url', 'N/A')
+            search_content += f"{i}. {title}\n"
+            search_content += f"   URL: {url}\n"
+            content = result.get('content', '')
+            if content:
+                # 限制内容长度
+                content_preview = content[:300] + "..." if len(content) > 300 else content
+                search_content += f"   内容: {content_preview}\n"
+            search_content += "\n"
             
-            if not keyword:
-                search_content = "错误: 搜索关键字不能为空。"
-                logger.warning(f"   ⚠️ 搜索关键字为空")
-            else:
-                # 执行搜索
-                try:
-                    logger.info(f"   🔍 正在执行搜索...")
-                    search_result = _execute_search(keyword, max_results)
-                    
-                    # 格式化搜索结果
-                    results = []
-                    if "queries" in search_result and len(search_result["queries"]) > 0:
-                        query_result = search_result["queries"][0]
-                        if "response" in query_result and "results" in query_result["response"]:
-                            results = query_result["response"]["results"]
-                    
-                    logger.info(f"   ✅ 搜索完成，找到 {len(results)} 个结果")
-                    
-                    # 构建搜索结果文本
-                    search_content = f"搜索关键字: {keyword}\n\n"
-                    if results:
-                        search_content += f"找到 {len(results)} 个结果:\n\n"
-                        for i, result in enumerate(results[:5], 1):  # 只取前5个结果
-                            title = result.get('title', 'N/A')
-                            url = result.get('url', 'N/A')
-                            search_content += f"{i}. {title}\n"
-                            search_content += f"   URL: {url}\n"
-                            content = result.get('content', '')
-                            if content:
-                                # 限制内容长度
-                                content_preview = content[:300] + "..." if len(content) > 300 else content
-                                search_content += f"   内容: {content_preview}\n"
-                            search_content += "\n"
-                            
-                            # 记录每个搜索结果
-                            logger.info(f"     结果 {i}: {title}")
-                            logger.info(f"       URL: {url}")
-                    else:
-                        search_content += "未找到相关结果。\n"
-                        logger.warning(f"   ⚠️ 未找到搜索结果")
-                    
-                    logger.info(f"   📄 搜索结果内容长度: {len(search_content)} 字符")
-                except Exception as e:
-                    search_content = f"搜索失败: {str(e)}"
-                    logger.error(f"   ❌ 搜索执行失败: {str(e)}")
-        except Exception as e:
-            search_content = f"解析搜索参数失败: {str(e)}"
-            logger.error(f"   ❌ 解析工具参数失败: {str(e)}")
+            # 记录每个搜索结果
+            logger.info(f"     结果 {i}: {title}")
+            logger.info(f"       URL: {url}")
     else:
-        search_content = f"未知的工具类型: {function_name}"
-        logger.warning(f"   ⚠️ 未知的工具类型: {function_name}")
+        search_content += "未找到相关结果。\n"
+        logger.warning(f"   ⚠️ 未找到搜索结果")
+    
+    logger.info(f"   📄 搜索结果内容长度: {len(search_content)} 字符")
+    return search_content
+
+
+# 批量搜索统计
+search_batch_stats = {
+    "batches": 0,
+    "batched_keywords": 0,
+    "fallbacks": 0,
+}
+
+
+async def _batch_search_tool_calls(tool_calls: List[dict], exclude: Optional[set] = None) -> dict:
+    """
+    把一轮中所有 search 工具调用合并为一次多关键字上游请求
+    
+    先逐个查搜索缓存，未命中的关键字（至少两个时）合并到一个
+    {"keywords": [...]} 请求中，再把返回的 queries[i] 按顺序拆回各个关键字并写入缓存。
+    批量请求失败时不抛出异常，未拿到结果的关键字由 search 工具
+    逐个搜索（回退路径）。
+    
+    Args:
+        tool_calls: 本轮的工具调用列表
+        exclude: 不需要搜索的规范化关键字（例如已由推测的搜索提供结果）
+        
+    Returns:
+        dict: 规范化关键字 -> 搜索结果
+    """
+    requested = {}
+    for tool_call in tool_calls:
+        if tool_call["function"]["name"] != "search":
+            continue
+        # 参数格式不对的调用跳过，由 search 工具单独处理并返回错误信息
+        try:
+            function_args = json_lib.loads(tool_call["function"]["arguments"] or "{}")
+        except ValueError:
+            continue
+        if not isinstance(function_args, dict):
+            continue
+        keyword = function_args.get("keyword")
+        if not keyword or not isinstance(keyword, str):
+            continue
+        try:
+            max_results = int(function_args["max_results"]) if function_args.get("max_results") is not None else 6
+        except (TypeError, ValueError):
+            continue
+        max_results = _build_search_payload(keyword, max_results)["max_results"]
+        key = normalize_keyword(keyword)
+        if exclude and key in exclude:
+            continue
+        if key not in requested or requested[key][1] < max_results:
+            requested[key] = (keyword, max_results)
+    
+    prefetched = {}
+    misses = []
+    for key, (keyword, max_results) in requested.items():
+        cached = await search_cache.aget(keyword, max_results)
+        if cached is not None:
+            prefetched[key] = cached
+        else:
+            misses.append((key, keyword, max_results))
+    
+    if len(misses) < 2:
+        return prefetched
+    
+    batch_max_results = max(max_results for _, _, max_results in misses)
+    payload = {
+        "keywords": [keyword for _, keyword, _ in misses],
+        "max_results": batch_max_results
+    }
+    
+    logger.info(f"   📦 合并 {len(misses)} 个搜索为一次批量请求: {payload['keywords']}")
+    try:
+        with tracer.span("search.batch", keywords=payload["keywords"], max_results=batch_max_results):
+            data = await upstream.post_search(payload)
+            queries = data.get("queries") or []
+            if len(queries) != len(misses):
+                raise ValueError(f"批量搜索返回 {len(queries)} 个结果，期望 {len(misses)} 个")
+    except Exception as e:
+        search_batch_stats["fallbacks"] += 1
+        logger.warning(f"   ⚠️ 批量搜索失败，回退为逐个搜索: {str(e)}")
+        return prefetched
+    
+    search_batch_stats["batches"] += 1
+    search_batch_stats["batched_keywords"] += len(misses)
+    for (key, keyword, _), query_result in zip(misses, queries):
+        keyword_data = {"queries": [query_result]}
+        await search_cache.aput(keyword, batch_max_results, keyword_data)
+        prefetched[key] = keyword_data
+    return prefetched
+
+
+async def _search_tool_handler(arguments: dict, context: dict) -> str:
+    """
+    search 工具的处理函数
+    
+    Args:
+        arguments: 模型给出的工具参数
+        context: 本轮上下文，其中 prefetched 是批量搜索和推测搜索预取的结果，
+            命中时不再单独请求上游；searched_keywords 是推测搜索实际使用的关键字
+        
+    Returns:
+        str: 提供给模型的搜索结果文本
+    """
+    keyword = arguments.get("keyword")
+    max_results = arguments.get("max_results", 6)
+    
+    logger.info(f"   工具参数:")
+    logger.info(f"     - keyword: {keyword}")
+    logger.info(f"     - max_results: {max_results}")
+    
+    if not keyword:
+        logger.warning(f"   ⚠️ 搜索关键字为空")
+        return "错误: 搜索关键字不能为空。"
+    
+    try:
+        key = normalize_keyword(keyword)
+        search_result = context.get("prefetched", {}).get(key)
+        if search_result is not None:
+            logger.info(f"   📦 使用预取的搜索结果")
+            tracer.annotate(source="prefetched")
+            search_result = truncate_results(search_result, max_results)
+        else:
+            logger.info(f"   🔍 正在执行搜索...")
+            search_result = await _execute_search(keyword, max_results)
+        return _format_search_content(keyword, search_result, context.get("searched_keywords", {}).get(key))
+    except Exception as e:
+        logger.error(f"   ❌ 搜索执行失败: {str(e)}")
+        return f"搜索失败: {str(e)}"
+
+
+def _build_search_payload(keyword: str, max_results: int) -> dict:
+    max_results = max(1, min(20, max_results))
+    return {
+        "keywords": [keyword],
+        "max_results": max_results
+    }
+
+
+# 并发的相同搜索（规范化关键字 + max_results 相同）只向上游发送一次
+search_flight = SingleFlight()
+
+
+async def _search_with_cache(keyword: str, max_results: int) -> dict:
+    """
+    带缓存的上游搜索，/search 接口和 search 工具共用
+    
+    缓存未命中时经过 single-flight 合并：同一时刻的相同搜索共享一次上游调用，
+    所有调用方得到同一个结果或同一个异常。
+    
+    Raises:
+        upstream.UpstreamTokenMissing: 当 AI_BUILDER_TOKEN 未配置时
+        httpx.HTTPError: 当上游请求失败时
+    """
+    payload = _build_search_payload(keyword, max_results)
+    max_results = payload["max_results"]
+    
+    cached = await search_cache.aget(keyword, max_results)
+    if cached is not None:
+        logger.info(f"   💾 搜索缓存命中: {keyword}")
+        tracer.annotate(cache="hit")
+        return cached
+    tracer.annotate(cache="miss")
     
-    logger.info(f"✅ 工具调用完成")
-    logger.info("=" * 80)
+    async def fetch():
+        data = await upstream.post_search(payload)
+        await search_cache.aput(keyword, max_results, data)
+        return data
     
-    return tool_call_id, search_content
+    flight_key = (normalize_keyword(keyword), max_results)
+    return await search_flight.do(flight_key, fetch)
 
 
-def _execute_search(keyword: str, max_results: int = 6) -> dict:
+async def _execute_search(keyword: str, max_results: int = 6) -> dict:
     """
     内部函数：执行搜索并返回结果
     
@@ -342,32 +559,80 @@ def _execute_search(keyword: str, max_results: int = 6) -> dict:
     Raises:
         Exception: 当搜索失败时
     """
-    token = os.getenv("AI_BUILDER_TOKEN")
-    if not token:
+    try:
+        with tracer.span("search", keyword=keyword, max_results=max_results):
+            return await _search_with_cache(keyword, max_results)
+    except upstream.UpstreamTokenMissing:
         raise Exception("AI_BUILDER_TOKEN 未配置")
+    except httpx.HTTPError as e:
+        raise Exception(f"搜索请求失败: {str(e)}")
+
+
+# 注册 search 工具
+tool_registry.register(ToolSpec(
+    name="search",
+    description="搜索网络获取最新信息和实时数据。当用户询问关于最近发生的事件、最新新闻、当前信息、实时数据或需要网络搜索才能回答的问题时，必须使用此工具。如果问题涉及'最近'、'最新'、'现在'、'当前'等时间相关的词汇，或者涉及你不知道的最新信息，都应该调用此工具。",
+    parameters={
+        "type": "object",
+        "properties": {
+            "keyword": {
+                "type": "string",
+                "description": "要搜索的关键字，应该包含问题的核心信息"
+            },
+            "max_results": {
+                "type": "integer",
+                "description": "最大返回结果数，默认6，最大20",
+                "default": 6,
+                "minimum": 1,
+                "maximum": 20
+            }
+        },
+        "required": ["keyword"]
+    },
+    handler=_search_tool_handler,
+    timeout=float(os.getenv("SEARCH_TOOL_TIMEOUT", "45")),
+    max_concurrency=int(os.getenv("SEARCH_TOOL_MAX_CONCURRENCY", "16")),
+    cacheable=True
+))
+
+
+# 第一轮 LLM 调用的同时推测执行可能需要的搜索（SPECULATIVE_SEARCH_ENABLED）
+speculative_search = SpeculativeSearch(_execute_search)
+
+
+async def _prepare_tool_context(tool_calls: List[dict], speculation: Optional[Speculation] = None) -> dict:
+    """
+    每轮工具调用前，把本轮的搜索合并为一次批量请求
     
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    
-    max_results = max(1, min(20, max_results))
-    payload = {
-        "keywords": [keyword],
-        "max_results": max_results
-    }
+    第一轮工具调用时先认领推测的搜索：与之匹配的关键字使用推测的结果，
+    其余关键字照常批量搜索，两者并发等待。
+    """
+    keyword = speculation.match(tool_calls) if speculation is not None else None
+    if keyword is None:
+        return {"prefetched": await _batch_search_tool_calls(tool_calls)}
     
-    try:
-        response = requests.post(
-            AI_BUILDER_SEARCH_ENDPOINT,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"搜索请求失败: {str(e)}")
+    key = normalize_keyword(keyword)
+    speculated, prefetched = await asyncio.gather(
+        speculation.result(),
+        _batch_search_tool_calls(tool_calls, exclude={key})
+    )
+    if speculated is None:
+        return {"prefetched": prefetched}
+    prefetched[key] = speculated
+    return {"prefetched": prefetched, "searched_keywords": {key: speculation.keyword}}
+
+
+agent_engine = AgentEngine(tool_registry, tool_executor, _prepare_tool_context, speculator=speculative_search)
+
+
+def _upstream_unavailable(e: Union[CircuitOpenError, AdmissionRejected]) -> HTTPException:
+    """上游熔断或排队超限时返回 503，并通过 Retry-After 告诉客户端何时重试"""
+    logger.error(f"⛔ {e}")
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(math.ceil(e.retry_after))}
+    )
 
 
 @app.post(
@@ -415,10 +680,16 @@ def _execute_search(keyword: str, max_results: int = 6) -> dict:
     },
     tags=["聊天"]
 )
-async def chat(request: ChatRequest) -> ChatResponse:
+async def chat(
+    request: ChatRequest,
+    http_request: Request,
+    x_request_priority: Optional[str] = Header(None, description="设为 batch 表示批量任务，排在其他请求之后")
+) -> ChatResponse:
     """
     Chat 聊天接口，实现 Agentic Loop：支持工具调用（search）
     
+    客户端断开连接时取消对话，进行中的上游请求和工具调用随之中断。
+    
     Args:
         request: Chat 请求对象，包含用户消息和参数
         
@@ -428,7 +699,10 @@ async def chat(request: ChatRequest) -> ChatResponse:
     Raises:
         400: 当 AI_BUILDER_TOKEN 未配置时
         500: 当转发请求失败时
+        503: 当上游熔断或服务繁忙时（响应带 Retry-After）
     """
+    turn_started_at = time.perf_counter()
+    
     # 获取认证 token
     token = os.getenv("AI_BUILDER_TOKEN")
     if not token:
@@ -437,335 +711,102 @@ async def chat(request: ChatRequest) -> ChatResponse:
             detail="AI_BUILDER_TOKEN 未配置，请在 .env 文件中设置 AI_BUILDER_TOKEN"
         )
     
-    # 构建请求到 AI Builder Space
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    
-    # 定义 search 工具
-    search_tool = {
-        "type": "function",
-        "function": {
-            "name": "search",
-            "description": "搜索网络获取最新信息和实时数据。当用户询问关于最近发生的事件、最新新闻、当前信息、实时数据或需要网络搜索才能回答的问题时，必须使用此工具。如果问题涉及'最近'、'最新'、'现在'、'当前'等时间相关的词汇，或者涉及你不知道的最新信息，都应该调用此工具。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "keyword": {
-                        "type": "string",
-                        "description": "要搜索的关键字，应该包含问题的核心信息"
-                    },
-                    "max_results": {
-                        "type": "integer",
-                        "description": "最大返回结果数，默认6，最大20",
-                        "default": 6,
-                        "minimum": 1,
-                        "maximum": 20
-                    }
-                },
-                "required": ["keyword"]
-            }
-        }
-    }
+    # 按优先级排队；预计排队时间过长时直接返回 503，不接受无法按时完成的请求
+    priority = parse_priority(x_request_priority, PRIORITY_API)
+    set_priority(priority)
+    try:
+        llm_admission.check(priority)
+    except AdmissionRejected as e:
+        raise _upstream_unavailable(e)
     
-    # 构建消息列表
     messages = [
         {
             "role": "user",
             "content": request.message
         }
     ]
+    tracer.annotate(model=request.model)
+    logger.info(f"💬 收到消息: {request.message}")
     
-    # GPT-5 模型特殊处理：temperature 固定为 1.0，使用 max_completion_tokens
-    base_payload = {
-        "model": request.model,
-        "messages": messages,
-        "temperature": 1.0 if request.model == "gpt-5" else (request.temperature or 0.7),
-        "tools": [search_tool]
-    }
-    
-    # GPT-5 使用 max_completion_tokens 而不是 max_tokens
-    if request.max_tokens:
-        if request.model == "gpt-5":
-            base_payload["max_completion_tokens"] = request.max_tokens
-        else:
-            base_payload["max_tokens"] = request.max_tokens
-    
+    run = agent_engine.start(
+        messages,
+        request.model,
+        endpoint="chat",
+        stream=False,
+        use_cache=llm_cache.use_for(request.bypass_cache),
+        temperature=request.temperature,
+        max_tokens=request.max_tokens,
+        started_at=turn_started_at
+    )
+    watcher = asyncio.create_task(_cancel_on_disconnect(http_request, run))
     try:
-        # Agentic Loop: 最多允许三轮工具调用
-        max_tool_rounds = 3
-        tool_round = 0
-        total_usage = None
-        
-        logger.info("=" * 80)
-        logger.info("🚀 开始 Agentic Loop")
-        logger.info(f"   用户消息: {request.message}")
-        logger.info(f"   模型: {request.model}")
-        logger.info(f"   最大工具调用轮数: {max_tool_rounds}")
-        logger.info("=" * 80)
-        
-        while tool_round <= max_tool_rounds:
-            logger.info("")
-            logger.info(f"📊 第 {tool_round + 1} 轮交互")
-            logger.info(f"   当前工具调用轮数: {tool_round}/{max_tool_rounds}")
-            
-            # 发送请求到 AI Builder Space
-            logger.info("   📤 发送请求到 AI Builder Space...")
-            response = requests.post(
-                AI_BUILDER_CHAT_ENDPOINT,
-                headers=headers,
-                json=base_payload,
-                timeout=120
-            )
-            
-            response.raise_for_status()
-            data = response.json()
-            
-            if "choices" not in data or len(data["choices"]) == 0:
-                raise HTTPException(
-                    status_code=500,
-                    detail="AI Builder Space 返回了无效的响应格式"
-                )
-            
-            choice = data["choices"][0]
-            message = choice["message"]
-            finish_reason = choice.get("finish_reason")
-            tool_calls = message.get("tool_calls")
-            
-            logger.info("   ✅ 收到模型响应")
-            logger.info(f"   Finish reason: {finish_reason}")
-            
-            # 累计 token 使用量
-            if data.get("usage"):
-                if total_usage is None:
-                    total_usage = data["usage"].copy()
-                else:
-                    total_usage["prompt_tokens"] += data["usage"].get("prompt_tokens", 0)
-                    total_usage["completion_tokens"] += data["usage"].get("completion_tokens", 0)
-                    total_usage["total_tokens"] += data["usage"].get("total_tokens", 0)
-                
-                logger.info(f"   本轮 Token 使用: {data['usage'].get('total_tokens', 0)}")
-                logger.info(f"   累计 Token 使用: {total_usage.get('total_tokens', 0)}")
-            
-            # 检查是否有工具调用
-            has_tool_calls = tool_calls and len(tool_calls) > 0
-            
-            if has_tool_calls:
-                logger.info(f"   🔧 检测到 {len(tool_calls)} 个工具调用")
-                for i, tc in enumerate(tool_calls, 1):
-                    logger.info(f"      工具调用 {i}: {tc['function']['name']}")
-                    logger.info(f"        参数: {tc['function']['arguments']}")
-            else:
-                logger.info("   💬 模型直接生成回复，无工具调用")
-            
-            # 如果达到最大轮数，强制不调用工具，生成最终答案
-            if tool_round >= max_tool_rounds:
-                logger.info("")
-                logger.info("⚠️  已达到最大工具调用轮数，强制生成最终答案")
-                logger.info("   设置 tool_choice='none'，移除工具定义")
-                
-                # 强制生成最终答案（无论是否有工具调用）
-                # 移除工具定义，强制生成答案
-                final_payload = {
-                    **base_payload,
-                    "messages": messages,
-                    "tool_choice": "none"
-                }
-                # 移除 tools 字段
-                final_payload.pop("tools", None)
-                
-                logger.info("   📤 发送最终生成请求...")
-                final_response = requests.post(
-                    AI_BUILDER_CHAT_ENDPOINT,
-                    headers=headers,
-                    json=final_payload,
-                    timeout=120
-                )
-                
-                final_response.raise_for_status()
-                final_data = final_response.json()
-                
-                if "choices" in final_data and len(final_data["choices"]) > 0:
-                    final_message = final_data["choices"][0]["message"]
-                    final_content = final_message.get("content", "")
-                    
-                    # 累计最终回复的 token 使用量
-                    if final_data.get("usage"):
-                        total_usage["prompt_tokens"] += final_data["usage"].get("prompt_tokens", 0)
-                        total_usage["completion_tokens"] += final_data["usage"].get("completion_tokens", 0)
-                        total_usage["total_tokens"] += final_data["usage"].get("total_tokens", 0)
-                    
-                    logger.info("")
-                    logger.info("=" * 80)
-                    logger.info("✅ Agentic Loop 完成")
-                    logger.info(f"   最终答案长度: {len(final_content)} 字符")
-                    logger.info(f"   总 Token 使用: {total_usage.get('total_tokens', 0)}")
-                    logger.info(f"      - Prompt tokens: {total_usage.get('prompt_tokens', 0)}")
-                    logger.info(f"      - Completion tokens: {total_usage.get('completion_tokens', 0)}")
-                    logger.info("=" * 80)
-                    
-                    # 打印完整的消息历史
-                    logger.info("")
-                    logger.info("=" * 80)
-                    logger.info("📋 完整消息历史")
-                    logger.info("=" * 80)
-                    
-                    # 1. 初始用户消息
-                    if messages and messages[0].get("role") == "user":
-                        logger.info("")
-                        logger.info("1️⃣ 初始用户消息:")
-                        logger.info(f"   {json_lib.dumps(messages[0], ensure_ascii=False, indent=2)}")
-                    
-                    # 2. 遍历所有消息，按顺序显示 assistant 的 tool_calls 和 tool 的结果
-                    msg_index = 2
-                    for msg in messages[1:]:  # 跳过第一条用户消息
-                        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-                            logger.info("")
-                            logger.info(f"{msg_index}️⃣ Assistant 工具调用:")
-                            logger.info(f"   {json_lib.dumps(msg, ensure_ascii=False, indent=2)}")
-                            msg_index += 1
-                        elif msg.get("role") == "tool":
-                            logger.info("")
-                            logger.info(f"{msg_index}️⃣ 工具搜索结果:")
-                            tool_result_display = {
-                                "role": msg.get("role"),
-                                "tool_call_id": msg.get("tool_call_id"),
-                                "content": msg.get("content", "")
-                            }
-                            logger.info(f"   {json_lib.dumps(tool_result_display, ensure_ascii=False, indent=2)}")
-                            msg_index += 1
-                    
-                    # 3. 最终 assistant 消息
-                    logger.info("")
-                    logger.info(f"{msg_index}️⃣ 最终 Assistant 回复:")
-                    final_message_display = {
-                        "role": "assistant",
-                        "content": final_content
-                    }
-                    logger.info(f"   {json_lib.dumps(final_message_display, ensure_ascii=False, indent=2)}")
-                    
-                    logger.info("")
-                    logger.info("=" * 80)
-                    
-                    return ChatResponse(
-                        message=final_content,
-                        model=final_data.get("model", request.model),
-                        usage=total_usage
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=500,
-                        detail="AI Builder Space 返回了无效的响应格式"
-                    )
-            
-            # 如果有工具调用且未达到最大轮数
-            if has_tool_calls:
-                tool_round += 1
-                logger.info(f"   🔄 进入工具调用阶段（第 {tool_round} 轮）")
-                
-                # 添加 assistant 消息（包含工具调用）
-                messages.append({
-                    "role": "assistant",
-                    "content": None,
-                    "tool_calls": tool_calls
-                })
-                
-                # 并行执行所有工具调用
-                logger.info(f"   ⚡ 开始并行执行 {len(tool_calls)} 个工具调用...")
-                tool_results = {}
-                with ThreadPoolExecutor(max_workers=len(tool_calls)) as executor:
-                    # 提交所有工具调用任务
-                    future_to_tool_call = {
-                        executor.submit(_execute_single_tool_call, tool_call): tool_call 
-                        for tool_call in tool_calls
-                    }
-                    
-                    # 收集结果
-                    for future in as_completed(future_to_tool_call):
-                        tool_call_id, search_content = future.result()
-                        tool_results[tool_call_id] = search_content
-                
-                logger.info(f"   ✅ 所有工具调用完成，共 {len(tool_results)} 个结果")
-                
-                # 按工具调用的顺序添加工具结果
-                for tool_call in tool_calls:
-                    tool_call_id = tool_call["id"]
-                    search_content = tool_results.get(tool_call_id, "工具调用失败")
-                    
-                    logger.info(f"   📝 添加工具结果到消息列表 (ID: {tool_call_id[:20]}...)")
-                    
-                    messages.append({
-                        "role": "tool",
-                        "content": search_content,
-                        "tool_call_id": tool_call_id
-                    })
-                
-                # 更新 payload，准备下一轮
-                base_payload["messages"] = messages
-                logger.info(f"   ➡️  准备进入下一轮交互...")
-                # 继续允许工具调用（如果还有轮数）
-                
-            else:
-                # 没有工具调用，直接返回回复
-                message_content = message.get("content", "")
-                
-                logger.info("")
-                logger.info("=" * 80)
-                logger.info("✅ Agentic Loop 完成（无工具调用）")
-                logger.info(f"   最终答案长度: {len(message_content)} 字符")
-                logger.info(f"   总 Token 使用: {total_usage.get('total_tokens', 0) if total_usage else 0}")
-                logger.info("=" * 80)
-                
-                # 打印完整的消息历史（无工具调用的情况）
-                logger.info("")
-                logger.info("=" * 80)
-                logger.info("📋 完整消息历史")
-                logger.info("=" * 80)
-                
-                # 1. 初始用户消息
-                if messages and messages[0].get("role") == "user":
-                    logger.info("")
-                    logger.info("1️⃣ 初始用户消息:")
-                    logger.info(f"   {json_lib.dumps(messages[0], ensure_ascii=False, indent=2)}")
-                
-                # 2. 最终 assistant 消息（无工具调用）
-                logger.info("")
-                logger.info("2️⃣ 最终 Assistant 回复（无工具调用）:")
-                final_message_display = {
-                    "role": "assistant",
-                    "content": message_content
-                }
-                logger.info(f"   {json_lib.dumps(final_message_display, ensure_ascii=False, indent=2)}")
-                
-                logger.info("")
-                logger.info("=" * 80)
-                
-                return ChatResponse(
-                    message=message_content,
-                    model=data.get("model", request.model),
-                    usage=total_usage
-                )
-        
-        # 如果循环结束（理论上不应该到达这里）
-        logger.error("❌ Agentic Loop 异常结束")
-        raise HTTPException(
-            status_code=500,
-            detail="Agentic Loop 异常结束"
-        )
-            
-    except requests.exceptions.RequestException as e:
+        done = await run.result()
+    except AgentCancelled:
+        raise HTTPException(status_code=499, detail="客户端已断开连接")
+    except (CircuitOpenError, AdmissionRejected) as e:
+        raise _upstream_unavailable(e)
+    except httpx.HTTPError as e:
         logger.error(f"❌ 请求失败: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"转发请求失败: {str(e)}"
         )
+    except AgentError as e:
+        logger.error(f"❌ {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         logger.error(f"❌ 处理错误: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"处理请求时发生错误: {str(e)}"
         )
+    finally:
+        watcher.cancel()
+    
+    return ChatResponse(
+        message=done["content"],
+        model=done["model"],
+        usage=done["usage"]
+    )
+
+
+async def _cancel_on_disconnect(http_request: Request, run: AgentRun):
+    """客户端断开连接时取消对话"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            run.cancel("client_disconnected")
+            return
+
+
+def _agent_event_to_sse(event: dict) -> List[dict]:
+    """把 Agentic Loop 引擎的事件转换为前端使用的 SSE 事件（done 事件除外）"""
+    if event["type"] == AGENT_CONTENT:
+        return [{"type": "content", "content": event["content"]}]
+    if event["type"] == AGENT_ROUND_STARTED:
+        if event["tool_round"] == 0:
+            events = [{"type": "log", "content": "🧠 正在经过 LLM 分析问题..."}]
+        else:
+            events = [{"type": "log", "content": f"🧠 正在经过 LLM 处理（第 {event['round']} 轮）..."}]
+        if event["final"]:
+            events.append({"type": "log", "content": "⚠️ 已达到最大工具调用轮数，正在生成最终答案..."})
+        return events
+    if event["type"] == AGENT_TOOL_STARTED:
+        events = []
+        if event["index"] == 0:
+            events.append({
+                "type": "log",
+                "content": f"🔧 正在调用第 {event['round']} 轮工具（共 {event['total']} 个工具）..."
+            })
+        try:
+            keyword = json_lib.loads(event["arguments"] or "{}").get("keyword", "")
+        except ValueError:
+            keyword = ""
+        events.append({"type": "log", "content": f"🔍 正在搜索: {keyword}"})
+        return events
+    if event["type"] == AGENT_TOOL_FINISHED:
+        return [{"type": "log", "content": f"✅ 搜索完成 ({event['completed']}/{event['total']})"}]
+    return []
 
 
 def send_sse_event(data: dict):
@@ -774,15 +815,43 @@ def send_sse_event(data: dict):
     return f"data: {json_str}\n\n"
 
 
-def stream_chat_response(chat_history: List[dict], model: str = "gpt-5"):
+async def _complete_event(content: str, on_complete: Optional[Callable[[str], Awaitable[dict]]]) -> dict:
+    event = {"type": "complete", "content": content}
+    if on_complete is not None:
+        event.update(await on_complete(content))
+    return event
+
+
+async def stream_chat_response(
+    chat_history: List[dict],
+    model: str = "gpt-5",
+    chat_id: Optional[str] = None,
+    use_cache: bool = False,
+    on_complete: Optional[Callable[[str], Awaitable[dict]]] = None,
+    http_request: Optional[Request] = None
+):
     """
     流式返回聊天响应，使用 Server-Sent Events
     支持对话历史，保持上下文连贯性
     
+    Agentic Loop 以流式模式运行，模型生成的文本片段到达后立即以 content 事件
+    转发，工具调用的进度以 log 事件汇报，最后发送包含完整文本的 complete 事件。
+    客户端断开连接（或事件流被关闭）时取消对话，不再继续调用上游。
+    
     Args:
         chat_history: 对话历史列表，格式为 [{"role": "user", "content": "..."}, ...]
         model: 模型名称
+        chat_id: 对话 ID，用于读取和更新较早消息的滚动摘要
+        use_cache: 每轮 LLM 调用是否使用 LLM 响应缓存
+        on_complete: 得到最终答案后调用（参数为答案文本），返回的字段合并进 complete 事件
+        http_request: 当前请求，用于检测客户端断开连接
     """
+    turn_started_at = time.perf_counter()
+    # 交互式请求，上游调用排在 /chat 和批量任务之前
+    set_priority(PRIORITY_INTERACTIVE)
+    run = None
+    watcher = None
+    
     try:
         # 发送开始日志
         yield send_sse_event({
@@ -799,234 +868,180 @@ def stream_chat_response(chat_history: List[dict], model: str = "gpt-5"):
             })
             return
         
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
-        # 定义 search 工具
-        search_tool = {
-            "type": "function",
-            "function": {
-                "name": "search",
-                "description": "搜索网络获取最新信息和实时数据。当用户询问关于最近发生的事件、最新新闻、当前信息、实时数据或需要网络搜索才能回答的问题时，必须使用此工具。如果问题涉及'最近'、'最新'、'现在'、'当前'等时间相关的词汇，或者涉及你不知道的最新信息，都应该调用此工具。",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "keyword": {
-                            "type": "string",
-                            "description": "要搜索的关键字，应该包含问题的核心信息"
-                        },
-                        "max_results": {
-                            "type": "integer",
-                            "description": "最大返回结果数，默认6，最大20",
-                            "default": 6,
-                            "minimum": 1,
-                            "maximum": 20
-                        }
-                    },
-                    "required": ["keyword"]
-                }
-            }
-        }
-        
-        # 使用传入的对话历史
-        messages = chat_history.copy()
-        
-        base_payload = {
-            "model": model,
-            "messages": messages,
-            "temperature": 1.0 if model == "gpt-5" else 0.7,
-            "tools": [search_tool]
-        }
+        # 按 token 预算裁剪对话历史，较早的消息用滚动摘要代替
+        with tracer.span("context.prepare", messages=len(chat_history)) as span:
+            messages, context_info = await chat_context.prepare(chat_id, chat_history, model)
+            if span is not None:
+                span.set(trimmed=context_info["trimmed"], summarized=context_info["summarized"])
+        if context_info["trimmed"]:
+            yield send_sse_event({
+                "type": "log",
+                "content": f"✂️ 对话较长，已将较早的消息{'压缩为摘要' if context_info['summarized'] else '省略'}"
+                           f"（保留最近 {context_info['kept_messages']} 条）"
+            })
         
-        max_tool_rounds = 3
-        tool_round = 0
+        run = agent_engine.start(messages, model, endpoint="stream", stream=True, use_cache=use_cache,
+                                 started_at=turn_started_at)
+        if http_request is not None:
+            watcher = asyncio.create_task(_cancel_on_disconnect(http_request, run))
         
-        while tool_round <= max_tool_rounds:
-            # 发送日志：正在经过 LLM
-            if tool_round == 0:
-                yield send_sse_event({
-                    "type": "log",
-                    "content": "🧠 正在经过 LLM 分析问题..."
-                })
+        # StreamingResponse 只在客户端断开连接时提前关闭事件流
+        async for event in run.events(close_reason="client_disconnected"):
+            if event["type"] == AGENT_DONE:
+                yield send_sse_event(await _complete_event(event["content"], on_complete))
             else:
-                yield send_sse_event({
-                    "type": "log",
-                    "content": f"🧠 正在经过 LLM 处理（第 {tool_round + 1} 轮）..."
-                })
-            
-            # 发送请求
-            response = requests.post(
-                AI_BUILDER_CHAT_ENDPOINT,
-                headers=headers,
-                json=base_payload,
-                timeout=120
-            )
-            
-            response.raise_for_status()
-            data = response.json()
-            
-            if "choices" not in data or len(data["choices"]) == 0:
-                yield send_sse_event({
-                    "type": "error",
-                    "message": "AI Builder Space 返回了无效的响应格式"
-                })
-                return
-            
-            choice = data["choices"][0]
-            message_obj = choice["message"]
-            finish_reason = choice.get("finish_reason")
-            tool_calls = message_obj.get("tool_calls")
-            
-            has_tool_calls = tool_calls and len(tool_calls) > 0
-            
-            # 如果达到最大轮数，强制生成最终答案
-            if tool_round >= max_tool_rounds:
-                yield send_sse_event({
-                    "type": "log",
-                    "content": "⚠️ 已达到最大工具调用轮数，正在生成最终答案..."
-                })
-                
-                final_payload = {
-                    **base_payload,
-                    "messages": messages,
-                    "tool_choice": "none"
-                }
-                final_payload.pop("tools", None)
-                
-                final_response = requests.post(
-                    AI_BUILDER_CHAT_ENDPOINT,
-                    headers=headers,
-                    json=final_payload,
-                    timeout=120
-                )
-                
-                final_response.raise_for_status()
-                final_data = final_response.json()
-                
-                if "choices" in final_data and len(final_data["choices"]) > 0:
-                    final_message = final_data["choices"][0]["message"]
-                    final_content = final_message.get("content", "")
-                    
-                    # 发送最终内容
-                    yield send_sse_event({
-                        "type": "complete",
-                        "content": final_content
-                    })
-                    return
-                else:
-                    yield send_sse_event({
-                        "type": "error",
-                        "message": "生成最终答案失败"
-                    })
-                    return
-            
-            # 如果有工具调用
-            if has_tool_calls:
-                tool_round += 1
-                
-                yield send_sse_event({
-                    "type": "log",
-                    "content": f"🔧 正在调用第 {tool_round} 轮工具（共 {len(tool_calls)} 个工具）..."
-                })
-                
-                messages.append({
-                    "role": "assistant",
-                    "content": None,
-                    "tool_calls": tool_calls
-                })
-                
-                # 并行执行工具调用
-                tool_results = {}
-                with ThreadPoolExecutor(max_workers=len(tool_calls)) as executor:
-                    futures = {
-                        executor.submit(_execute_single_tool_call, tool_call): tool_call 
-                        for tool_call in tool_calls
-                    }
-                    
-                    for i, future in enumerate(as_completed(futures), 1):
-                        tool_call = futures[future]
-                        function_args = json_lib.loads(tool_call["function"]["arguments"])
-                        keyword = function_args.get("keyword", "")
-                        
-                        yield send_sse_event({
-                            "type": "log",
-                            "content": f"🔍 正在搜索: {keyword}"
-                        })
-                        
-                        tool_call_id, search_content = future.result()
-                        tool_results[tool_call_id] = search_content
-                        
-                        yield send_sse_event({
-                            "type": "log",
-                            "content": f"✅ 搜索完成 ({i}/{len(tool_calls)})"
-                        })
-                
-                # 添加工具结果
-                for tool_call in tool_calls:
-                    tool_call_id = tool_call["id"]
-                    search_content = tool_results.get(tool_call_id, "工具调用失败")
-                    
-                    messages.append({
-                        "role": "tool",
-                        "content": search_content,
-                        "tool_call_id": tool_call_id
-                    })
-                
-                base_payload["messages"] = messages
-                
-            else:
-                # 没有工具调用，直接返回回复
-                message_content = message_obj.get("content", "")
-                
-                yield send_sse_event({
-                    "type": "complete",
-                    "content": message_content
-                })
-                return
+                for sse_event in _agent_event_to_sse(event):
+                    yield send_sse_event(sse_event)
                 
+    except AgentCancelled:
+        # 客户端已经断开，不再发送事件
+        return
+    except (CircuitOpenError, AdmissionRejected) as e:
+        logger.error(f"⛔ {e}")
+        yield send_sse_event({
+            "type": "error",
+            "message": str(e),
+            "retry_after": math.ceil(e.retry_after)
+        })
+    except AgentError as e:
+        logger.error(f"流式响应错误: {str(e)}")
+        yield send_sse_event({
+            "type": "error",
+            "message": str(e)
+        })
     except Exception as e:
         logger.error(f"流式响应错误: {str(e)}")
         yield send_sse_event({
             "type": "error",
             "message": f"处理请求时发生错误: {str(e)}"
         })
+    finally:
+        if watcher is not None:
+            watcher.cancel()
 
 
 class ChatStreamRequest(BaseModel):
-    """流式聊天请求模型"""
-    history: List[dict]  # 使用 dict 以支持灵活的消息格式
+    """
+    流式聊天请求模型
+
+    推荐只上传本轮的用户消息 message：历史由服务端按 chat_id 从对话存储加载，
+    回答完成后服务端把用户消息和最终答案追加到对话中。chat_id 为空时服务端
+    新建对话。仍然支持旧的用法：上传完整的 history，由客户端自行保存。
+    """
+    message: Optional[str] = None  # 本轮的用户消息
+    history: Optional[List[dict]] = None  # 完整对话历史（旧用法，使用 dict 以支持灵活的消息格式）
     model: Optional[str] = "gpt-5"
+    chat_id: Optional[str] = None  # 对话 ID，用于加载历史和维护较早消息的滚动摘要
+    bypass_cache: bool = False  # 为 True 时本次请求不读写 LLM 响应缓存
+
+
+def _validate_stream_history(chat_history: List[dict]):
+    """校验客户端上传的完整对话历史"""
+    if not isinstance(chat_history, list):
+        raise ValueError("对话历史必须是数组格式")
+    
+    for i, msg in enumerate(chat_history):
+        if not isinstance(msg, dict):
+            raise ValueError(f"对话历史第 {i+1} 条消息格式错误，必须是对象格式")
+        if "role" not in msg or "content" not in msg:
+            raise ValueError(f"对话历史第 {i+1} 条消息缺少 role 或 content 字段")
+    
+    # 确保最后一条是用户消息
+    if not chat_history or chat_history[-1].get("role") != "user":
+        raise ValueError("对话历史必须以用户消息结尾")
+
+
+async def _persist_turn(chat_id: str, user_message: str, content: str) -> dict:
+    """把本轮的用户消息和最终答案追加到对话中，返回合并进 complete 事件的字段"""
+    messages = [{"role": "user", "content": user_message}]
+    if content and content.strip():
+        messages.append({"role": "assistant", "content": content})
+    try:
+        result = await asyncio.to_thread(_append_to_chat, chat_id, messages)
+    except Exception as e:
+        logger.error(f"保存对话失败: {e}")
+        return {"chat": {"id": chat_id}, "save_error": f"保存对话失败: {e}"}
+    logger.info(f"💾 已保存对话 {chat_id}，当前共 {result['version']} 条消息")
+    return {"chat": {"id": chat_id, **result}}
+
+
+async def _server_session_stream(chat_id: str, chat_history: List[dict], model: str, use_cache: bool,
+                                 http_request: Optional[Request] = None):
+    """服务端维护历史的流式对话：先告知客户端对话 ID，完成后保存本轮消息"""
+    yield send_sse_event({
+        "type": "chat",
+        "chat_id": chat_id
+    })
+    user_message = chat_history[-1]["content"]
+    async for event in stream_chat_response(
+        chat_history,
+        model,
+        chat_id,
+        use_cache,
+        on_complete=lambda content: _persist_turn(chat_id, user_message, content),
+        http_request=http_request
+    ):
+        yield event
 
 
 @app.post("/api/chat/stream")
-def chat_stream(request: ChatStreamRequest):
+async def chat_stream(request: ChatStreamRequest, http_request: Request):
     """
     流式聊天接口，使用 Server-Sent Events
     支持对话历史，保持上下文连贯性
+    
+    上传 message 时历史由服务端加载和保存，客户端每轮只需要这一个请求；
+    上传 history 时按旧方式处理，不写入对话存储。客户端断开连接时停止生成。
     """
     try:
-        # 使用请求中的历史（已经是 dict 格式）
-        chat_history = request.history
-        
-        # 验证历史格式
-        if not isinstance(chat_history, list):
-            raise ValueError("对话历史必须是数组格式")
+        # 准入控制的状态只在事件循环线程中访问，因此这里是 async 接口
+        llm_admission.check(PRIORITY_INTERACTIVE)
         
-        # 验证每条消息格式
-        for i, msg in enumerate(chat_history):
-            if not isinstance(msg, dict):
-                raise ValueError(f"对话历史第 {i+1} 条消息格式错误，必须是对象格式")
-            if "role" not in msg or "content" not in msg:
-                raise ValueError(f"对话历史第 {i+1} 条消息缺少 role 或 content 字段")
-        
-        # 确保最后一条是用户消息
-        if not chat_history or chat_history[-1].get("role") != "user":
-            raise ValueError("对话历史必须以用户消息结尾")
-        
-        logger.info(f"收到流式请求，对话历史长度: {len(chat_history)}")
+        if request.message is not None:
+            message = request.message.strip()
+            if not message:
+                raise ValueError("消息内容不能为空")
+            
+            if request.chat_id:
+                chat_id = request.chat_id
+                chat_data = await asyncio.to_thread(chat_store.get_chat, chat_id)
+                if chat_data is None:
+                    raise HTTPException(status_code=404, detail="对话不存在")
+                history = chat_data["history"]
+            else:
+                # 新对话在本轮完成、第一次保存时创建
+                chat_id = str(uuid.uuid4())
+                history = []
+            
+            chat_history = history + [{"role": "user", "content": message}]
+            tracer.annotate(chat_id=chat_id, model=request.model)
+            logger.info(f"收到流式请求，对话 {chat_id}，历史长度: {len(chat_history)}")
+            events = _server_session_stream(
+                chat_id,
+                chat_history,
+                request.model,
+                llm_cache.use_for(request.bypass_cache),
+                http_request
+            )
+        elif request.history is not None:
+            chat_history = request.history
+            _validate_stream_history(chat_history)
+            tracer.annotate(chat_id=request.chat_id, model=request.model)
+            logger.info(f"收到流式请求，对话历史长度: {len(chat_history)}")
+            events = stream_chat_response(
+                chat_history,
+                request.model,
+                request.chat_id,
+                llm_cache.use_for(request.bypass_cache),
+                http_request=http_request
+            )
+        else:
+            raise ValueError("必须提供 message 或 history")
         
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise _upstream_unavailable(e)
     except ValueError as e:
         logger.error(f"请求验证失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -1035,7 +1050,7 @@ def chat_stream(request: ChatStreamRequest):
         raise HTTPException(status_code=500, detail=f"处理请求时发生错误: {str(e)}")
     
     return StreamingResponse(
-        stream_chat_response(chat_history, request.model),
+        events,
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -1130,7 +1145,10 @@ class SearchResponse(BaseModel):
     },
     tags=["搜索"]
 )
-async def search(request: SearchRequest) -> SearchResponse:
+async def search(
+    request: SearchRequest,
+    x_request_priority: Optional[str] = Header(None, description="设为 batch 表示批量任务，排在其他请求之后")
+) -> SearchResponse:
     """
     Search 搜索接口，转发到 AI Builder Space
     
@@ -1143,6 +1161,7 @@ async def search(request: SearchRequest) -> SearchResponse:
     Raises:
         400: 当 AI_BUILDER_TOKEN 未配置时
         500: 当转发请求失败时
+        503: 当上游熔断或服务繁忙时（响应带 Retry-After）
     """
     # 获取认证 token
     token = os.getenv("AI_BUILDER_TOKEN")
@@ -1152,32 +1171,19 @@ async def search(request: SearchRequest) -> SearchResponse:
             detail="AI_BUILDER_TOKEN 未配置，请在 .env 文件中设置 AI_BUILDER_TOKEN"
         )
     
-    # 构建请求到 AI Builder Space
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+    priority = parse_priority(x_request_priority, PRIORITY_API)
+    set_priority(priority)
+    try:
+        search_admission.check(priority)
+    except AdmissionRejected as e:
+        raise _upstream_unavailable(e)
     
     # 限制 max_results 在有效范围内（1-20）
     max_results = max(1, min(20, request.max_results or 6))
     
-    payload = {
-        "keywords": [request.keyword],
-        "max_results": max_results
-    }
-    
     try:
-        # 转发请求到 AI Builder Space
-        response = requests.post(
-            AI_BUILDER_SEARCH_ENDPOINT,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        # 检查响应状态
-        response.raise_for_status()
-        data = response.json()
+        # 转发请求到 AI Builder Space（优先使用搜索缓存）
+        data = await _search_with_cache(request.keyword, max_results)
         
         # 提取搜索结果
         if "queries" in data and len(data["queries"]) > 0:
@@ -1188,6 +1194,7 @@ async def search(request: SearchRequest) -> SearchResponse:
             results = []
             if "response" in query_result and "results" in query_result["response"]:
                 results = query_result["response"]["results"]
+            metrics.search_results.observe(len(results), source="api")
             
             return SearchResponse(
                 keyword=request.keyword,
@@ -1201,7 +1208,9 @@ async def search(request: SearchRequest) -> SearchResponse:
                 detail="AI Builder Space 返回了无效的响应格式"
             )
             
-    except requests.exceptions.RequestException as e:
+    except (CircuitOpenError, AdmissionRejected) as e:
+        raise _upstream_unavailable(e)
+    except httpx.HTTPError as e:
         raise HTTPException(
             status_code=500,
             detail=f"转发请求失败: {str(e)}"
@@ -1244,31 +1253,65 @@ class SaveChatRequest(BaseModel):
     history: List[dict]
     title: Optional[str] = None
 
+class AppendMessagesRequest(BaseModel):
+    """追加消息请求"""
+    messages: List[dict]
+    expected_version: Optional[int] = None
+
 
 @app.get("/api/chats", tags=["对话历史"])
-async def get_chat_list():
-    """获取对话列表"""
+def get_chat_list(
+    limit: int = Query(CHAT_LIST_DEFAULT_LIMIT, ge=1, le=CHAT_LIST_MAX_LIMIT, description="每页条数"),
+    cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor，为空表示第一页")
+):
+    """获取对话列表（按更新时间倒序，游标分页）"""
     try:
-        index = load_chat_index()
-        # 按更新时间倒序排列
-        index.sort(key=lambda x: x.get('updated_at', ''), reverse=True)
-        return {"chats": index}
+        return chat_store.list_chats_page(limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"获取对话列表失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取对话列表失败: {e}")
 
 
+@app.get("/api/chats/search", tags=["对话历史"])
+def search_chats(
+    q: str = Query(..., min_length=1, description="检索词，支持中文和英文"),
+    limit: int = Query(20, ge=1, le=CHAT_SEARCH_MAX_LIMIT, description="最多返回的对话数")
+):
+    """在对话标题和消息内容中全文检索，按相关度排序并返回命中摘要"""
+    try:
+        _sync_chat_search_index()
+        hits = chat_search_index.search(q, limit)
+        # 标题和时间取自对话列表，摘要取自检索索引，不读取完整对话
+        entries = chat_store.get_chat_entries([chat_id for chat_id, _ in hits])
+        results = []
+        for chat_id, score in hits:
+            entry = entries.get(chat_id)
+            if entry is None:
+                continue
+            results.append({
+                "id": chat_id,
+                "title": entry["title"],
+                "created_at": entry["created_at"],
+                "updated_at": entry["updated_at"],
+                "score": score,
+                "snippet": chat_search_index.snippet(chat_id, entry["title"], q)
+            })
+        return {"query": q, "results": results, "indexing": chat_search_index.get_stats()["building"]}
+    except Exception as e:
+        logger.error(f"检索对话失败: {e}")
+        raise HTTPException(status_code=500, detail=f"检索对话失败: {e}")
+
+
 @app.get("/api/chats/{chat_id}", tags=["对话历史"])
-async def get_chat_detail(chat_id: str):
+def get_chat_detail(chat_id: str):
     """获取对话详情"""
     try:
-        chat_file = get_chat_file_path(chat_id)
-        if not os.path.exists(chat_file):
+        chat_data = chat_store.get_chat(chat_id)
+        if chat_data is None:
             raise HTTPException(status_code=404, detail="对话不存在")
         
-        with open(chat_file, 'r', encoding='utf-8') as f:
-            chat_data = json_lib.load(f)
-        
         return chat_data
     except HTTPException:
         raise
@@ -1278,7 +1321,7 @@ async def get_chat_detail(chat_id: str):
 
 
 @app.post("/api/chats", tags=["对话历史"])
-async def create_chat(request: CreateChatRequest):
+def create_chat(request: CreateChatRequest):
     """创建新对话"""
     try:
         chat_id = str(uuid.uuid4())
@@ -1300,20 +1343,9 @@ async def create_chat(request: CreateChatRequest):
             "updated_at": now
         }
         
-        # 保存对话文件
-        chat_file = get_chat_file_path(chat_id)
-        with open(chat_file, 'w', encoding='utf-8') as f:
-            json_lib.dump(chat_data, f, ensure_ascii=False, indent=2)
-        
-        # 更新索引
-        index = load_chat_index()
-        index.append({
-            "id": chat_id,
-            "title": title,
-            "created_at": now,
-            "updated_at": now
-        })
-        save_chat_index(index)
+        chat_store.put_chat(chat_data)
+        chat_search_index.index_chat(chat_data)
+        _publish_chat_change(chat_id)
         
         return chat_data
     except Exception as e:
@@ -1322,31 +1354,13 @@ async def create_chat(request: CreateChatRequest):
 
 
 @app.put("/api/chats/{chat_id}/title", tags=["对话历史"])
-async def update_chat_title(chat_id: str, request: UpdateChatTitleRequest):
+def update_chat_title(chat_id: str, request: UpdateChatTitleRequest):
     """更新对话标题"""
     try:
-        chat_file = get_chat_file_path(chat_id)
-        if not os.path.exists(chat_file):
+        if not chat_store.update_title(chat_id, request.title, datetime.now().isoformat()):
             raise HTTPException(status_code=404, detail="对话不存在")
-        
-        # 更新对话文件
-        with open(chat_file, 'r', encoding='utf-8') as f:
-            chat_data = json_lib.load(f)
-        
-        chat_data["title"] = request.title
-        chat_data["updated_at"] = datetime.now().isoformat()
-        
-        with open(chat_file, 'w', encoding='utf-8') as f:
-            json_lib.dump(chat_data, f, ensure_ascii=False, indent=2)
-        
-        # 更新索引
-        index = load_chat_index()
-        for item in index:
-            if item["id"] == chat_id:
-                item["title"] = request.title
-                item["updated_at"] = chat_data["updated_at"]
-                break
-        save_chat_index(index)
+        chat_search_index.update_title(chat_id, request.title)
+        _publish_chat_change(chat_id)
         
         return {"success": True, "title": request.title}
     except HTTPException:
@@ -1357,18 +1371,14 @@ async def update_chat_title(chat_id: str, request: UpdateChatTitleRequest):
 
 
 @app.post("/api/chats/{chat_id}/save", tags=["对话历史"])
-async def save_chat(chat_id: str, request: SaveChatRequest):
+def save_chat(chat_id: str, request: SaveChatRequest):
     """保存对话历史"""
     try:
-        chat_file = get_chat_file_path(chat_id)
         now = datetime.now().isoformat()
         
         # 读取或创建对话数据
-        if os.path.exists(chat_file):
-            with open(chat_file, 'r', encoding='utf-8') as f:
-                chat_data = json_lib.load(f)
-        else:
-            # 创建新对话
+        chat_data = chat_store.get_chat(chat_id)
+        if chat_data is None:
             chat_data = {
                 "id": chat_id,
                 "title": request.title or "新对话",
@@ -1376,15 +1386,6 @@ async def save_chat(chat_id: str, request: SaveChatRequest):
                 "created_at": now,
                 "updated_at": now
             }
-            # 添加到索引
-            index = load_chat_index()
-            index.append({
-                "id": chat_id,
-                "title": chat_data["title"],
-                "created_at": now,
-                "updated_at": now
-            })
-            save_chat_index(index)
         
         # 更新对话数据
         chat_data["history"] = request.history
@@ -1401,39 +1402,137 @@ async def save_chat(chat_id: str, request: SaveChatRequest):
                 if first_user_message:
                     chat_data["title"] = generate_title_from_message(first_user_message)
         
-        # 保存对话文件
-        with open(chat_file, 'w', encoding='utf-8') as f:
-            json_lib.dump(chat_data, f, ensure_ascii=False, indent=2)
-        
-        # 更新索引
-        index = load_chat_index()
-        for item in index:
-            if item["id"] == chat_id:
-                item["title"] = chat_data["title"]
-                item["updated_at"] = now
-                break
-        save_chat_index(index)
+        chat_store.put_chat(chat_data)
+        chat_search_index.index_chat(chat_data)
+        _publish_chat_change(chat_id)
         
-        return {"success": True, "chat_id": chat_id, "title": chat_data["title"]}
+        return {
+            "success": True,
+            "chat_id": chat_id,
+            "title": chat_data["title"],
+            "version": len(chat_data["history"])
+        }
     except Exception as e:
         logger.error(f"保存对话失败: {e}")
         raise HTTPException(status_code=500, detail=f"保存对话失败: {e}")
 
 
+@app.post("/api/chats/{chat_id}/messages", tags=["对话历史"])
+def append_chat_messages(chat_id: str, request: AppendMessagesRequest):
+    """
+    追加消息到对话末尾（只上传和写入新增的消息）
+    
+    expected_version 是客户端已知的消息数，与服务端不一致时返回 409，
+    客户端应重新加载对话或改用 /save 整体保存。
+    """
+    try:
+        result = _append_to_chat(chat_id, request.messages, request.expected_version)
+        return {"success": True, "chat_id": chat_id, **result}
+    except VersionConflict as e:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "对话版本冲突", "version": e.current_version}
+        )
+    except Exception as e:
+        logger.error(f"追加消息失败: {e}")
+        raise HTTPException(status_code=500, detail=f"追加消息失败: {e}")
+
+
 @app.delete("/api/chats/{chat_id}", tags=["对话历史"])
-async def delete_chat(chat_id: str):
+def delete_chat(chat_id: str):
     """删除对话"""
     try:
-        chat_file = get_chat_file_path(chat_id)
-        if os.path.exists(chat_file):
-            os.remove(chat_file)
-        
-        # 从索引中删除
-        index = load_chat_index()
-        index = [item for item in index if item["id"] != chat_id]
-        save_chat_index(index)
+        chat_store.delete_chat(chat_id)
+        chat_search_index.remove_chat(chat_id)
+        _publish_chat_change(chat_id)
         
         return {"success": True}
     except Exception as e:
         logger.error(f"删除对话失败: {e}")
         raise HTTPException(status_code=500, detail=f"删除对话失败: {e}")
+
+
+def _breaker_state_samples():
+    return [
+        ((name, state), 1 if breaker.state == state else 0)
+        for name, breaker in upstream.breakers.items()
+        for state in (CLOSED, OPEN, HALF_OPEN)
+    ]
+
+
+def _admission_samples(field: str):
+    def samples():
+        result = []
+        for controller in (llm_admission, search_admission):
+            if field == "in_flight":
+                result.append(((controller.name,), controller.in_flight))
+            else:
+                for priority, count in controller.get_stats()["waiting"].items():
+                    result.append(((controller.name, priority), count))
+        return result
+    return samples
+
+
+metrics.registry.gauge_callback(
+    "upstream_circuit_state", "上游熔断器状态（当前状态为 1）", ("upstream", "state"), _breaker_state_samples
+)
+metrics.registry.gauge_callback(
+    "admission_in_flight", "正在占用并发名额的上游调用数", ("upstream",), _admission_samples("in_flight")
+)
+metrics.registry.gauge_callback(
+    "admission_waiting", "排队等待并发名额的上游调用数", ("upstream", "priority"), _admission_samples("waiting")
+)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus 格式的运行指标（多 worker 模式下只包含处理本次请求的 worker）"""
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/api/debug/stats", tags=["运行状态"])
+async def get_debug_stats():
+    """获取运行状态统计（上游连接池、搜索缓存等，多 worker 模式下只包含处理本次请求的 worker）"""
+    return {
+        "worker": {"pid": os.getpid(), "workers": WORKER_COUNT},
+        "shared_state": shared_state.get_stats() if shared_state is not None else None,
+        "upstream": upstream.get_stats(),
+        "search_cache": search_cache.get_stats(),
+        "search_singleflight": search_flight.get_stats(),
+        "search_batch": dict(search_batch_stats),
+        "tools": tool_executor.get_stats(),
+        "chat_search": chat_search_index.get_stats(),
+        "chat_context": chat_context.get_stats(),
+        "llm_cache": llm_cache.get_stats(),
+        "llm_hedging": llm_hedger.get_stats(),
+        "agent": agent_engine.get_stats(),
+        "speculative_search": speculative_search.get_stats(),
+        "admission": {
+            "llm": llm_admission.get_stats(),
+            "search": search_admission.get_stats()
+        },
+        "tracing": tracer.get_stats()
+    }
+
+
+@app.get("/api/debug/traces", tags=["运行状态"])
+async def list_traces(limit: int = Query(50, ge=1, le=500, description="返回的 trace 数")):
+    """列出本 worker 最近的 trace（按开始时间倒序，包括进行中的请求）"""
+    return {"traces": tracer.recent(limit)}
+
+
+@app.get("/api/debug/traces/{trace_id}", tags=["运行状态"])
+async def get_trace(trace_id: str = Path(..., description="响应头 X-Trace-Id 中的 trace ID")):
+    """
+    获取一个请求的 span 树
+
+    每个 span 包含名称、相对请求开始的时间（start_ms）、耗时（duration_ms）、
+    状态和属性（模型、轮次、搜索关键字、token 用量等），子 span 在 children 中。
+
+    Raises:
+        404: 当 trace 不存在或已被淘汰时
+    """
+    trace = await asyncio.to_thread(tracer.get_trace, trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="trace 不存在或已过期")
+    return trace
@@ -0,0 +1,244 @@
+"""
+Prometheus 格式的运行指标
+
+不依赖 prometheus_client，只实现需要的三种指标：
+- Counter：单调递增的计数
+- Histogram：按固定桶统计分布（输出 _bucket、_sum、_count）
+- 采集时回调的 Gauge（GaugeCallback），用于导出其他模块已有的状态
+
+指标在进程内累计，GET /metrics 按 Prometheus 文本格式（0.0.4）输出。多 worker
+模式下每个 worker 各自统计，抓取到的是处理该次请求的 worker 的指标（带
+worker_pid 标签便于区分）。
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4"  # 响应会自动加上 charset=utf-8
+
+# 默认的耗时桶（秒），覆盖本地存储操作到慢速 LLM 调用
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+STORE_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """单调递增的计数"""
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("Counter 只能增加")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    """按固定桶统计的分布"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], list] = {}  # key -> [各桶计数..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """在 with 范围内计时，结束时记录耗时（秒）"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        inf = 'le="+Inf"'
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, inf)} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class GaugeCallback(_Metric):
+    """采集时调用 callback 取值的 Gauge，callback 返回 [(标签值元组, 数值)]"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str],
+                 callback: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, tuple(str(v) for v in key))} {_format_value(value)}"
+            for key, value in self.callback()
+        ]
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已注册: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, labelnames: Iterable[str],
+                       callback: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]) -> GaugeCallback:
+        return self.register(GaugeCallback(name, documentation, labelnames, callback))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+# ---- Agentic Loop ----
+
+llm_round_seconds = registry.histogram(
+    "agent_llm_round_seconds", "每轮 LLM 调用耗时（不含命中缓存的轮次）", ("endpoint", "model")
+)
+turn_seconds = registry.histogram(
+    "agent_turn_seconds", "一次对话从收到请求到生成最终答案的耗时", ("endpoint",)
+)
+sse_first_token_seconds = registry.histogram(
+    "agent_sse_first_token_seconds", "流式接口从收到请求到发出第一个文本片段的耗时", ()
+)
+turns_total = registry.counter("agent_turns_total", "完成的对话轮次数", ("endpoint",))
+tool_rounds_total = registry.counter("agent_tool_rounds_total", "工具调用轮数（除以 agent_turns_total 得到每轮对话的平均值）", ("endpoint",))
+forced_final_answers_total = registry.counter(
+    "agent_forced_final_answers_total", "达到最大工具轮数后强制生成最终答案的次数", ("endpoint",)
+)
+cancelled_turns_total = registry.counter(
+    "agent_cancelled_turns_total", "被取消的对话数（reason 为 client_disconnected 等）", ("endpoint", "reason")
+)
+llm_tokens_total = registry.counter("llm_tokens_total", "上游返回的 token 用量", ("endpoint", "type"))
+
+# ---- 工具与搜索 ----
+
+tool_call_seconds = registry.histogram("tool_call_seconds", "工具调用耗时（不含排队）", ("tool", "status"))
+search_results = registry.histogram(
+    "search_results", "每次搜索返回的结果数", ("source",), buckets=COUNT_BUCKETS
+)
+speculative_searches_total = registry.counter(
+    "speculative_searches_total", "推测执行的搜索数，outcome 为 hit / mismatch / unused / failed / cancelled", ("outcome",)
+)
+
+# ---- 上游 ----
+
+upstream_errors_total = registry.counter("upstream_errors_total", "上游调用失败次数（含重试前的失败）", ("upstream", "reason"))
+
+# ---- 对话存储 ----
+
+chat_store_seconds = registry.histogram(
+    "chat_store_operation_seconds", "对话存储操作耗时", ("backend", "operation"), buckets=STORE_LATENCY_BUCKETS
+)
+
+registry.gauge_callback("process_worker_info", "当前 worker 进程", ("worker_pid",), lambda: [((os.getpid(),), 1)])
+
+
+def record_usage(endpoint: str, usage: Optional[dict]):
+    """把上游返回的 usage 计入 token 用量"""
+    if not usage:
+        return
+    for token_type in ("prompt_tokens", "completion_tokens"):
+        if usage.get(token_type):
+            llm_tokens_total.inc(usage[token_type], endpoint=endpoint, type=token_type.replace("_tokens", ""))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+把文件存储的对话历史（chat_history/ 目录）导入 SQLite 存储
+
+用法:
+    python migrate_chat_history.py
+    python migrate_chat_history.py chat_history backup/chat_history --db chat_history/chats.db
+
+导入完成后设置 CHAT_STORE_BACKEND=sqlite 即可切换到 SQLite 后端。
+"""
+
+import argparse
+
+from chat_store import CHAT_HISTORY_DIR, CHAT_STORE_SQLITE_PATH, FileChatStore, SqliteChatStore, migrate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把 chat_history/ 目录中的对话导入 SQLite")
+    parser.add_argument("sources", nargs="*", default=[CHAT_HISTORY_DIR], help="对话历史目录，可以指定多个")
+    parser.add_argument("--db", default=CHAT_STORE_SQLITE_PATH, help="SQLite 数据库路径")
+    args = parser.parse_args()
+
+    target = SqliteChatStore(args.db)
+    total = 0
+    for source_dir in args.sources:
+        count = migrate(FileChatStore(source_dir), target)
+        print(f"✅ {source_dir}: 导入 {count} 个对话")
+        total += count
+    target.close()
+
+    print(f"\n共导入 {total} 个对话到 {args.db}")
+
+
+if __name__ == "__main__":
+    main()
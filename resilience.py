@@ -0,0 +1,257 @@
+"""
+上游调用的容错：重试 + 熔断
+
+AI Builder Space 偶尔返回 429/502，原先一次失败就让整轮对话失败；上游大面积
+故障时，每个请求仍然要等满 120 秒超时。这里为 chat 和 search 各维护一个熔断
+器，并提供统一的调用包装：
+- 有限次数的重试，等待时间按指数退避并加随机抖动（full jitter），多个请求
+  不会在同一时刻一起重试
+- 上游返回 Retry-After 时按它等待；要求等待的时间超过 UPSTREAM_RETRY_MAX_DELAY
+  时不再重试，直接把错误返回给调用方
+- 只重试不会重复消耗上游时间的错误：429/5xx、连接失败、连接被断开；读超时
+  不重试（已经等满了超时时间）
+- 熔断器统计最近 UPSTREAM_BREAKER_WINDOW 秒内的调用，失败率超过阈值后打开，
+  打开期间的调用立即失败（CircuitOpenError）；冷却时间过后放行一个探测请求，
+  成功则关闭，失败则重新打开
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 每次调用的最多尝试次数（含第一次）
+UPSTREAM_RETRY_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_MAX_ATTEMPTS", "3"))
+# 指数退避的基础等待时间（秒）和单次等待上限（秒）
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+# 熔断器：统计窗口（秒）、窗口内最少调用数、打开熔断的失败率、打开后的冷却时间（秒）
+UPSTREAM_BREAKER_WINDOW = float(os.getenv("UPSTREAM_BREAKER_WINDOW", "30"))
+UPSTREAM_BREAKER_MIN_REQUESTS = int(os.getenv("UPSTREAM_BREAKER_MIN_REQUESTS", "10"))
+UPSTREAM_BREAKER_FAILURE_RATE = float(os.getenv("UPSTREAM_BREAKER_FAILURE_RATE", "0.5"))
+UPSTREAM_BREAKER_OPEN_SECONDS = float(os.getenv("UPSTREAM_BREAKER_OPEN_SECONDS", "15"))
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# 请求可能还没有被上游处理的传输错误
+RETRYABLE_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(httpx.HTTPError):
+    """熔断器打开，调用未发出即失败"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"上游 {name} 暂时不可用（熔断中），请 {retry_after:.0f} 秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数或 HTTP 日期），无法解析返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """该异常是否说明上游不健康（计入熔断器的失败）"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    # 连接池排队超时是本地资源不足，不是上游的问题
+    return isinstance(exc, httpx.TransportError) and not isinstance(exc, httpx.PoolTimeout)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, RETRYABLE_TRANSPORT_ERRORS)
+
+
+def _describe(exc: BaseException) -> str:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"HTTP {exc.response.status_code}"
+    return f"{type(exc).__name__}: {exc}"
+
+
+def _error_reason(exc: BaseException) -> str:
+    """指标中的失败原因：HTTP 状态码或异常类型"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return str(exc.response.status_code)
+    return type(exc).__name__
+
+
+def retry_delay(attempt: int, exc: BaseException) -> Optional[float]:
+    """
+    第 attempt 次尝试失败后的等待时间
+
+    Returns:
+        float: 等待秒数；上游要求的等待时间超过上限时返回 None，表示不再重试
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = parse_retry_after(exc.response.headers.get("retry-after"))
+        if retry_after is not None:
+            return retry_after if retry_after <= UPSTREAM_RETRY_MAX_DELAY else None
+    return random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """按滑动时间窗口内的失败率打开的熔断器"""
+
+    def __init__(
+        self,
+        name: str,
+        window: float = UPSTREAM_BREAKER_WINDOW,
+        min_requests: int = UPSTREAM_BREAKER_MIN_REQUESTS,
+        failure_rate: float = UPSTREAM_BREAKER_FAILURE_RATE,
+        open_seconds: float = UPSTREAM_BREAKER_OPEN_SECONDS
+    ):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._outcomes = deque()  # (时间, 是否失败)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "failures": 0,
+            "rejected": 0,
+            "retries": 0,
+            "opened": 0,
+        }
+
+    def _prune(self, now: float):
+        while self._outcomes and self._outcomes[0][0] <= now - self.window:
+            _, failed = self._outcomes.popleft()
+            self._failures -= failed
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self._opened_at = now
+        self._probing = False
+        self.stats["opened"] += 1
+        logger.warning(f"⛔ 上游 {self.name} 熔断器打开，{self.open_seconds:.0f} 秒内的调用直接失败")
+
+    def before_call(self):
+        """
+        发起调用前检查是否放行
+
+        Raises:
+            CircuitOpenError: 熔断器打开（或半开状态下探测请求尚未返回）时
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+            elif self.state != CLOSED:
+                self.stats["rejected"] += 1
+                metrics.upstream_errors_total.inc(upstream=self.name, reason="circuit_open")
+                retry_after = max(1.0, self._opened_at + self.open_seconds - now)
+                raise CircuitOpenError(self.name, retry_after)
+            self.stats["calls"] += 1
+
+    def after_call(self, failed: Optional[bool]):
+        """记录调用结果；failed 为 None 表示调用被取消，没有结果"""
+        now = time.monotonic()
+        with self._lock:
+            if failed:
+                self.stats["failures"] += 1
+            if self.state == HALF_OPEN:
+                if failed is None:
+                    self._probing = False
+                elif failed:
+                    self._open(now)
+                else:
+                    self.state = CLOSED
+                    self._probing = False
+                    self._outcomes.clear()
+                    self._failures = 0
+                    logger.info(f"✅ 上游 {self.name} 已恢复，熔断器关闭")
+                return
+            if failed is None or self.state != CLOSED:
+                return
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            self._prune(now)
+            if len(self._outcomes) >= self.min_requests and \
+                    self._failures / len(self._outcomes) >= self.failure_rate:
+                self._open(now)
+
+    def record_retry(self):
+        with self._lock:
+            self.stats["retries"] += 1
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            total = len(self._outcomes)
+            return {
+                **self.stats,
+                "state": self.state,
+                "window_requests": total,
+                "window_failure_rate": round(self._failures / total, 4) if total else 0.0,
+                "retry_after": round(max(0.0, self._opened_at + self.open_seconds - now), 1)
+                if self.state == OPEN else 0.0,
+            }
+
+
+async def call_with_retry(breaker: CircuitBreaker, fn: Callable[[], Awaitable]):
+    """
+    经过熔断器调用 fn()，失败时按退避策略重试
+
+    Raises:
+        CircuitOpenError: 熔断器打开时
+        fn() 最后一次抛出的异常
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_call()
+        try:
+            result = await fn()
+        except Exception as e:
+            breaker.after_call(is_upstream_failure(e))
+            metrics.upstream_errors_total.inc(upstream=breaker.name, reason=_error_reason(e))
+            if attempt >= UPSTREAM_RETRY_MAX_ATTEMPTS or not is_retryable(e):
+                raise
+            delay = retry_delay(attempt, e)
+            if delay is None:
+                raise
+            breaker.record_retry()
+            logger.warning(f"🔁 上游 {breaker.name} 调用失败（{_describe(e)}），{delay:.1f} 秒后第 {attempt + 1} 次尝试")
+            await asyncio.sleep(delay)
+        except BaseException:
+            breaker.after_call(None)
+            raise
+        else:
+            breaker.after_call(False)
+            return result
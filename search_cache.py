@@ -0,0 +1,264 @@
+"""
+搜索结果缓存
+
+多级缓存：
+- 内存层：有容量上限的 LRU，条目带 TTL
+- 共享层（多 worker 模式）：shared_state 中的 SQLite 键值存储，所有 worker 共用
+- 磁盘层（可选）：每个关键字一个 JSON 文件，进程重启后仍然有效
+
+缓存键是规范化后的关键字（NFKC 全角转半角、大小写折叠、合并空白），
+条目记录获取时使用的 max_results。已缓存的较大结果集可以直接截断后
+服务更小的 max_results 请求。
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from shared_state import SharedState, shared_state
+
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+# 磁盘层目录，留空表示不启用磁盘层
+SEARCH_CACHE_DIR = os.getenv("SEARCH_CACHE_DIR", "")
+SEARCH_CACHE_DISK_TTL = float(os.getenv("SEARCH_CACHE_DISK_TTL", "86400"))
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_keyword(keyword: str) -> str:
+    """
+    规范化搜索关键字
+
+    全角字符和标点统一为半角（NFKC），英文统一小写，连续空白合并为一个空格。
+    """
+    keyword = unicodedata.normalize("NFKC", keyword)
+    keyword = keyword.casefold()
+    return _WHITESPACE_RE.sub(" ", keyword).strip()
+
+
+def truncate_results(data: dict, max_results: int) -> dict:
+    """返回只保留前 max_results 条结果的副本"""
+    data = copy.deepcopy(data)
+    for query in data.get("queries", []):
+        response = query.get("response")
+        if isinstance(response, dict) and isinstance(response.get("results"), list):
+            response["results"] = response["results"][:max_results]
+    return data
+
+
+class SearchCache:
+    """多级（内存 LRU + 可选共享层 + 可选磁盘）搜索结果缓存"""
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        disk_dir: str = "",
+        disk_ttl: float = 0,
+        shared: Optional[SharedState] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl
+        self.shared = shared
+        self._entries = OrderedDict()  # key -> (max_results, data, expires_at)
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "shared_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.json")
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _memory_get(self, key: str, max_results: int) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_max_results, data, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.stats["expirations"] += 1
+                return None
+            if cached_max_results < max_results:
+                return None
+            self._entries.move_to_end(key)
+            self.stats["memory_hits"] += 1
+        return truncate_results(data, max_results)
+
+    def _memory_put(self, key: str, max_results: int, data: dict, expires_at: float):
+        with self._lock:
+            existing = self._entries.get(key)
+            # 保留仍然有效的更大结果集
+            if existing is not None and existing[0] > max_results and existing[2] > time.time():
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = (max_results, data, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def _shared_get(self, key: str, max_results: int) -> Optional[dict]:
+        record = self.shared.get(f"search:{key}")
+        if record is None or record["max_results"] < max_results:
+            return None
+        # 提升到内存层
+        self._memory_put(key, record["max_results"], record["data"], time.time() + self.ttl)
+        self._count("shared_hits")
+        return truncate_results(record["data"], max_results)
+
+    def _shared_put(self, key: str, max_results: int, data: dict):
+        existing = self.shared.get(f"search:{key}")
+        if existing is not None and existing["max_results"] > max_results:
+            return
+        self.shared.set(f"search:{key}", {"max_results": max_results, "data": data}, self.ttl)
+
+    def _slow_get(self, key: str, max_results: int) -> Optional[dict]:
+        """依次查找共享层和磁盘层（会做 I/O）"""
+        data = None
+        if self.shared is not None:
+            data = self._shared_get(key, max_results)
+        if data is None and self.disk_dir:
+            data = self._disk_get(key, max_results)
+        return data
+
+    def _slow_put(self, key: str, max_results: int, data: dict):
+        if self.shared is not None:
+            self._shared_put(key, max_results, data)
+        if self.disk_dir:
+            self._disk_put(key, max_results, data)
+
+    @property
+    def _has_slow_tier(self) -> bool:
+        return self.shared is not None or bool(self.disk_dir)
+
+    def _disk_get(self, key: str, max_results: int) -> Optional[dict]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("key") != key:
+            return None
+        if record["stored_at"] + self.disk_ttl <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._count("expirations")
+            return None
+        if record["max_results"] < max_results:
+            return None
+        # 提升到内存层
+        self._memory_put(key, record["max_results"], record["data"],
+                         min(time.time() + self.ttl, record["stored_at"] + self.disk_ttl))
+        self._count("disk_hits")
+        return truncate_results(record["data"], max_results)
+
+    def _disk_put(self, key: str, max_results: int, data: dict):
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                existing = json.load(f)
+            if (existing.get("key") == key and existing["max_results"] > max_results
+                    and existing["stored_at"] + self.disk_ttl > time.time()):
+                return
+        except (OSError, ValueError):
+            pass
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "key": key,
+                "max_results": max_results,
+                "stored_at": time.time(),
+                "data": data
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def get(self, keyword: str, max_results: int) -> Optional[dict]:
+        """查找缓存，未命中返回 None（共享层和磁盘层会做 I/O）"""
+        key = normalize_keyword(keyword)
+        data = self._memory_get(key, max_results)
+        if data is None and self._has_slow_tier:
+            data = self._slow_get(key, max_results)
+        if data is None:
+            self._count("misses")
+        return data
+
+    def put(self, keyword: str, max_results: int, data: dict):
+        """写入缓存（共享层和磁盘层会做 I/O）"""
+        key = normalize_keyword(keyword)
+        self._memory_put(key, max_results, data, time.time() + self.ttl)
+        self._slow_put(key, max_results, data)
+        self._count("stores")
+
+    async def aget(self, keyword: str, max_results: int) -> Optional[dict]:
+        """get 的异步版本，共享层和磁盘层 I/O 放到线程中执行，不阻塞事件循环"""
+        if not self._has_slow_tier:
+            return self.get(keyword, max_results)
+        key = normalize_keyword(keyword)
+        data = self._memory_get(key, max_results)
+        if data is None:
+            data = await asyncio.to_thread(self._slow_get, key, max_results)
+        if data is None:
+            self._count("misses")
+        return data
+
+    async def aput(self, keyword: str, max_results: int, data: dict):
+        """put 的异步版本"""
+        if not self._has_slow_tier:
+            self.put(keyword, max_results, data)
+            return
+        key = normalize_keyword(keyword)
+        self._memory_put(key, max_results, data, time.time() + self.ttl)
+        await asyncio.to_thread(self._slow_put, key, max_results, data)
+        self._count("stores")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            size = len(self._entries)
+        hits = stats["memory_hits"] + stats["shared_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        return {
+            **stats,
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "shared_enabled": self.shared is not None,
+            "disk_enabled": bool(self.disk_dir),
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+search_cache = SearchCache(
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    ttl=SEARCH_CACHE_TTL,
+    disk_dir=SEARCH_CACHE_DIR,
+    disk_ttl=SEARCH_CACHE_DISK_TTL,
+    shared=shared_state
+)
@@ -0,0 +1,228 @@
+"""
+多 worker 共享状态
+
+用 uvicorn --workers N（或环境变量 WEB_CONCURRENCY=N）启动多个 worker 进程
+时，进程内的缓存和计数器各自独立。这里提供一个基于本机 SQLite 文件（WAL
+模式）的共享存储，同一台机器上的所有 worker 读写同一个数据库：
+- 带 TTL 的键值存储（搜索缓存的共享层）
+- 按 worker 分别记录、合计判断上限的计数器（准入控制的整机并发数）
+- 事件日志（某个 worker 修改对话后，其他 worker 据此更新各自的内存索引）
+
+单 worker 运行时默认不启用。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# uvicorn 的 --workers 默认取 WEB_CONCURRENCY，应用据此判断是否处于多 worker 模式
+WORKER_COUNT = int(os.getenv("WEB_CONCURRENCY", "1"))
+MULTI_WORKER = WORKER_COUNT > 1
+# 共享状态数据库路径，多 worker 模式下默认启用，留空表示不启用
+SHARED_STATE_PATH = os.getenv(
+    "SHARED_STATE_PATH",
+    os.path.join("chat_history", "shared_state.db") if MULTI_WORKER else ""
+)
+# 每个频道保留的事件数
+SHARED_EVENT_RETENTION = int(os.getenv("SHARED_EVENT_RETENTION", "10000"))
+
+
+class SharedState:
+    """基于 SQLite 的进程间共享状态"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # timeout：其他进程持有写锁时最多等待的秒数
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_events_channel_seq ON events(channel, seq);
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                expires_at REAL,
+                PRIMARY KEY (name, pid)
+            );
+        """)
+        self._cursors = {}  # channel -> 本进程已读到的事件序号
+        self._writes = 0
+        self._appends = 0
+
+    # ---- 键值存储 ----
+
+    def get(self, key: str) -> Optional[Any]:
+        """读取未过期的值，不存在或已过期返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """写入值，ttl 为空表示不过期"""
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._writes += 1
+            # 过期的键只在这里清理：每 1000 次写入顺带删除一次
+            if self._writes % 1000 == 0:
+                self._conn.execute(
+                    "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+                )
+
+    # ---- 计数器 ----
+    # 每个 worker 在同一个计数名下各占一行，合计值是所有未过期行之和。worker
+    # 异常退出后它的行随 ttl 过期，不会永久占用计数。
+
+    def _counter_total(self, name: str, now: float) -> int:
+        row = self._conn.execute(
+            "SELECT COALESCE(SUM(value), 0) FROM counters "
+            "WHERE name = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (name, now)
+        ).fetchone()
+        return row[0]
+
+    def counter_add(self, name: str, amount: int, limit: Optional[int] = None,
+                    ttl: Optional[float] = None) -> Tuple[bool, int]:
+        """
+        原子地增加本 worker 的计数（amount 可以为负，计数不会小于 0），并续期
+
+        limit 不为空且增加后所有 worker 的合计会超过 limit 时不增加。
+
+        Returns:
+            tuple: (是否已增加, 操作之后所有 worker 的合计)
+        """
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                total = self._counter_total(name, now)
+                if limit is not None and amount > 0 and total + amount > limit:
+                    self._conn.execute("COMMIT")
+                    return False, total
+                # 本 worker 的行已过期时从 0 开始
+                self._conn.execute(
+                    "INSERT INTO counters (name, pid, value, expires_at) VALUES (?, ?, MAX(?, 0), ?) "
+                    "ON CONFLICT(name, pid) DO UPDATE SET "
+                    "value = MAX(CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN 0 ELSE value END + ?, 0), "
+                    "expires_at = excluded.expires_at",
+                    (name, os.getpid(), amount, expires_at, now, amount)
+                )
+                total = self._counter_total(name, now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True, total
+
+    def counter_touch(self, name: str, ttl: Optional[float] = None) -> int:
+        """为本 worker 的计数续期，返回所有 worker 的合计"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE counters SET expires_at = ? WHERE name = ? AND pid = ?",
+                (now + ttl if ttl else None, name, os.getpid())
+            )
+            # 已退出的 worker 留下的过期行在这里顺带删除
+            self._conn.execute(
+                "DELETE FROM counters WHERE name = ? AND expires_at IS NOT NULL AND expires_at <= ?", (name, now)
+            )
+            return self._counter_total(name, now)
+
+    # ---- 事件日志 ----
+
+    def publish(self, channel: str, data: Any):
+        """发布事件，其他 worker 通过 poll 读取"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO events (channel, pid, data) VALUES (?, ?, ?)",
+                (channel, os.getpid(), json.dumps(data, ensure_ascii=False))
+            )
+            self._appends += 1
+            if self._appends % 1000 == 0:
+                # 清理旧事件，并记录清理到的位置，落后于该位置的 worker 需要全量重新加载
+                trimmed_seq = cursor.lastrowid - SHARED_EVENT_RETENTION
+                self._conn.execute("DELETE FROM events WHERE channel = ? AND seq <= ?", (channel, trimmed_seq))
+                self._conn.execute(
+                    "INSERT INTO kv (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), excluded.value)",
+                    (f"events:{channel}:trimmed_seq", trimmed_seq)
+                )
+
+    def poll(self, channel: str) -> Optional[List[Any]]:
+        """
+        读取本进程上次 poll 之后其他 worker 发布的事件
+
+        第一次调用只记录当前位置，返回空列表。
+
+        Returns:
+            list: 事件数据；如果本进程落后太多、部分事件已被清理，返回 None，
+            调用方应当全量重新加载
+        """
+        with self._lock:
+            last_seq = self._cursors.get(channel)
+            if last_seq is None:
+                row = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()
+                self._cursors[channel] = row[0]
+                return []
+            rows = self._conn.execute(
+                "SELECT seq, pid, data FROM events WHERE channel = ? AND seq > ? ORDER BY seq",
+                (channel, last_seq)
+            ).fetchall()
+            trimmed = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ?", (f"events:{channel}:trimmed_seq",)
+            ).fetchone()
+            if rows:
+                self._cursors[channel] = rows[-1][0]
+            if trimmed is not None and int(trimmed[0]) > last_seq:
+                return None
+        pid = os.getpid()
+        return [json.loads(data) for _, event_pid, data in rows if event_pid != pid]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            keys = self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+            events = self._conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            counters = self._conn.execute("SELECT COUNT(*) FROM counters").fetchone()[0]
+        return {"path": self.path, "keys": keys, "events": events, "counters": counters}
+
+    def close(self):
+        with self._lock:
+            # 退出前清除本 worker 的计数，不必等它过期
+            self._conn.execute("DELETE FROM counters WHERE pid = ?", (os.getpid(),))
+            self._conn.close()
+
+
+shared_state = SharedState(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
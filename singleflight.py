@@ -0,0 +1,68 @@
+"""
+Single-flight 请求合并
+
+同一时刻对同一个键的多个并发调用只执行一次底层操作，所有调用方共享它的
+结果或异常。底层操作作为独立的 Task 运行，某个调用方被取消不会影响其他
+仍在等待的调用方；所有调用方都被取消时，底层操作也随之取消。
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """按键合并并发的异步调用"""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}  # 每个底层操作正在等待的调用方数
+        self.stats = {
+            "calls": 0,
+            "executions": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "abandoned": 0,
+        }
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """
+        执行 fn()，如果相同 key 的调用正在进行中则等待并复用它的结果
+
+        Raises:
+            fn() 抛出的异常（所有合并的调用方都会收到同一个异常）
+        """
+        self.stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["executions"] += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.stats["coalesced"] += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 最后一个调用方也被取消时，不再为没有人等待的结果继续执行
+            if self._waiters[task] == 1 and not task.done():
+                task.cancel()
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]  # 之后的调用方重新执行，不要等待已取消的操作
+                self.stats["abandoned"] += 1
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "inflight": len(self._inflight),
+        }
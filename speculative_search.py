@@ -0,0 +1,224 @@
+"""
+推测执行的搜索
+
+search 工具的描述要求模型对含有"最近"、"最新"、"现在"、"当前"等词的问题
+必须搜索。这类问题原先要先等一整轮 LLM 调用才知道模型要搜索，再串行等待
+搜索。开启 SPECULATIVE_SEARCH_ENABLED 后：
+- 用关键词规则判断用户消息是否很可能需要搜索，是则把消息去掉语气词和
+  标点后作为关键字，在第一轮 LLM 调用的同时开始搜索
+- 模型第一轮的 search 工具调用与推测的关键字足够相似（按 chat_search 的
+  检索词项计算 Dice 系数，不低于 SPECULATIVE_SEARCH_MATCH_THRESHOLD），
+  且 max_results 不超过推测时使用的值时，直接使用推测的结果；两者规范化后
+  不相同时，提供给模型的工具结果中注明实际搜索的关键字
+- 模型没有调用 search、关键字不匹配或对话被取消时，取消推测的搜索并计数
+
+推测的搜索同样经过搜索缓存、single-flight、准入控制和熔断器，结果写入
+搜索缓存。
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from typing import Awaitable, Callable, List, Optional
+
+import metrics
+from chat_search import tokenize
+from search_cache import normalize_keyword
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+SPECULATIVE_SEARCH_ENABLED = os.getenv("SPECULATIVE_SEARCH_ENABLED", "false").lower() in ("1", "true", "yes")
+SPECULATIVE_SEARCH_MATCH_THRESHOLD = float(os.getenv("SPECULATIVE_SEARCH_MATCH_THRESHOLD", "0.6"))
+# 超过该长度的消息不做推测（长消息通常不适合直接作为搜索关键字）
+SPECULATIVE_SEARCH_MAX_CHARS = int(os.getenv("SPECULATIVE_SEARCH_MAX_CHARS", "60"))
+SPECULATIVE_SEARCH_MAX_RESULTS = int(os.getenv("SPECULATIVE_SEARCH_MAX_RESULTS", "6"))
+
+# 出现这些词时模型几乎总会搜索（与 search 工具描述中的时间词一致）
+TRIGGER_WORDS = ("最近", "最新", "现在", "当前", "目前", "今天", "今年", "新闻", "latest", "recent", "today", "news")
+
+# 生成关键字时去掉的礼貌用语、疑问语气词和标点
+_FILLER_RE = re.compile(
+    r"请问|请帮我|帮我|给我|查一下|搜一下|搜索一下|告诉我|一下|有哪些|有什么|是什么|怎么样|"
+    r"[吗呢吧啊的]|[?？!！。.,，、:：;；\"“”'‘’]"
+)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+HIT = "hit"
+MISMATCH = "mismatch"
+UNUSED = "unused"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def keyword_similarity(a: str, b: str) -> float:
+    """两个关键字检索词项集合的 Dice 系数（0 到 1）"""
+    tokens_a = set(tokenize(a, for_query=True))
+    tokens_b = set(tokenize(b, for_query=True))
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return 2 * len(tokens_a & tokens_b) / (len(tokens_a) + len(tokens_b))
+
+
+def _search_arguments(tool_call: dict) -> Optional[dict]:
+    if tool_call["function"]["name"] != "search":
+        return None
+    try:
+        arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+    except ValueError:
+        return None
+    if not isinstance(arguments, dict) or not isinstance(arguments.get("keyword"), str):
+        return None
+    return arguments if arguments["keyword"] else None
+
+
+class Speculation:
+    """一次推测执行的搜索，由 SpeculativeSearch.start() 创建"""
+
+    def __init__(self, owner: "SpeculativeSearch", keyword: str, max_results: int):
+        self.owner = owner
+        self.keyword = keyword
+        self.max_results = max_results
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self.outcome: Optional[str] = None
+        self._task = asyncio.create_task(self._search())
+        self._task.add_done_callback(self._on_done)
+
+    async def _search(self) -> dict:
+        # 在任务内部记录完成时间：done 回调可能晚于等待者运行
+        try:
+            with tracer.span("search.speculative", keyword=self.keyword, max_results=self.max_results):
+                return await self.owner.search_fn(self.keyword, self.max_results)
+        finally:
+            self.finished_at = time.perf_counter()
+
+    def _on_done(self, task: asyncio.Task):
+        if not task.cancelled():
+            task.exception()  # 避免未取回的异常被记录为 "never retrieved"
+
+    def _resolve(self, outcome: str):
+        self.outcome = outcome
+        self.owner.stats[outcome] += 1
+        metrics.speculative_searches_total.inc(outcome=outcome)
+
+    def match(self, tool_calls: List[dict]) -> Optional[str]:
+        """
+        找出与推测的搜索匹配的 search 工具调用，返回模型给出的关键字
+
+        模型给出的关键字与实际搜索的 self.keyword 可能只是相近，使用结果时
+        需要告诉模型实际搜索的关键字。没有匹配的工具调用时取消推测的搜索。
+        只有第一次调用有效。
+        """
+        if self.outcome is not None:
+            return None
+        best_keyword, best_score = None, 0.0
+        for tool_call in tool_calls:
+            arguments = _search_arguments(tool_call)
+            if arguments is None:
+                continue
+            try:
+                max_results = int(arguments["max_results"]) if arguments.get("max_results") is not None else 6
+            except (TypeError, ValueError):
+                continue
+            if max_results > self.max_results:
+                continue
+            score = keyword_similarity(self.keyword, arguments["keyword"])
+            if score > best_score:
+                best_keyword, best_score = arguments["keyword"], score
+        if best_keyword is None or best_score < self.owner.match_threshold:
+            logger.info(f"   🎲 推测的搜索未被使用（关键字不匹配）: {self.keyword}")
+            self.discard(MISMATCH)
+            return None
+        logger.info(f"   🎯 推测的搜索命中: {self.keyword} -> {best_keyword}（相似度 {best_score:.2f}）")
+        return best_keyword
+
+    async def result(self) -> Optional[dict]:
+        """等待推测的搜索完成（match() 命中之后调用），失败时返回 None"""
+        claimed_at = time.perf_counter()
+        try:
+            data = await self._task
+        except asyncio.CancelledError:
+            self._resolve(CANCELLED)
+            raise
+        except Exception as e:
+            logger.warning(f"   ⚠️ 推测的搜索失败，改为重新搜索: {e}")
+            self._resolve(FAILED)
+            return None
+        self._resolve(HIT)
+        # 搜索在认领之前已经进行的时间，即与第一轮 LLM 调用重叠、不再需要等待的部分
+        self.owner.stats["saved_seconds"] += min(claimed_at, self.finished_at) - self.started_at
+        return data
+
+    def discard(self, outcome: str = UNUSED):
+        """取消未被使用的推测搜索（已经有结论时只确保任务被取消）"""
+        if not self._task.done():
+            self._task.cancel()
+        if self.outcome is None:
+            self._resolve(outcome)
+
+
+class SpeculativeSearch:
+    """
+    推测执行搜索的分类规则和统计
+
+    Args:
+        search_fn: 执行搜索的函数，参数为 (keyword, max_results)
+    """
+
+    def __init__(
+        self,
+        search_fn: Callable[[str, int], Awaitable[dict]],
+        enabled: bool = SPECULATIVE_SEARCH_ENABLED,
+        match_threshold: float = SPECULATIVE_SEARCH_MATCH_THRESHOLD,
+        max_chars: int = SPECULATIVE_SEARCH_MAX_CHARS,
+        max_results: int = SPECULATIVE_SEARCH_MAX_RESULTS
+    ):
+        self.search_fn = search_fn
+        self.enabled = enabled
+        self.match_threshold = match_threshold
+        self.max_chars = max_chars
+        self.max_results = max_results
+        self.stats = {
+            "started": 0,
+            HIT: 0,
+            MISMATCH: 0,
+            UNUSED: 0,
+            FAILED: 0,
+            CANCELLED: 0,
+            "saved_seconds": 0.0,
+        }
+
+    def classify(self, message: str) -> Optional[str]:
+        """判断用户消息是否很可能需要搜索，是则返回推测的关键字"""
+        text = normalize_keyword(message or "")
+        if not text or len(text) > self.max_chars:
+            return None
+        if not any(word in text for word in TRIGGER_WORDS):
+            return None
+        keyword = _WHITESPACE_RE.sub(" ", _FILLER_RE.sub(" ", text)).strip()
+        return keyword or None
+
+    def start(self, messages: List[dict]) -> Optional[Speculation]:
+        """最后一条消息是用户消息且很可能需要搜索时，开始推测的搜索"""
+        if not self.enabled or not messages or messages[-1].get("role") != "user":
+            return None
+        content = messages[-1].get("content")
+        keyword = self.classify(content) if isinstance(content, str) else None
+        if keyword is None:
+            return None
+        self.stats["started"] += 1
+        logger.info(f"🎲 推测用户问题需要搜索，提前开始搜索: {keyword}")
+        return Speculation(self, keyword, self.max_results)
+
+    def get_stats(self) -> dict:
+        resolved = self.stats[HIT] + self.stats[MISMATCH] + self.stats[UNUSED] + self.stats[FAILED] + self.stats[CANCELLED]
+        return {
+            **self.stats,
+            "saved_seconds": round(self.stats["saved_seconds"], 3),
+            "enabled": self.enabled,
+            "match_threshold": self.match_threshold,
+            "hit_rate": round(self.stats[HIT] / resolved, 3) if resolved else 0.0,
+        }
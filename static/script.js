@@ -1,6 +1,11 @@
 let currentChatId = null;
 let eventSource = null;
 let chatHistory = []; // 维护对话历史
+const CHAT_LIST_PAGE_SIZE = 50; // 对话列表每页条数
+let chatListItems = []; // 已加载的对话列表项
+let chatListCursor = null; // 下一页游标，null 表示已加载完
+let chatListLoading = false;
+let chatSearchTimer = null;
 
 // 初始化
 document.addEventListener('DOMContentLoaded', () => {
@@ -8,8 +13,25 @@ document.addEventListener('DOMContentLoaded', () => {
     input.addEventListener('input', autoResize);
     input.addEventListener('input', toggleSendButton);
     
-    // 加载历史对话列表
+    // 加载历史对话列表，滚动到底部时加载下一页
     loadChatList();
+    const chatHistoryDiv = document.querySelector('.chat-history');
+    if (chatHistoryDiv) {
+        chatHistoryDiv.addEventListener('scroll', () => {
+            if (!getChatSearchQuery() && chatHistoryDiv.scrollTop + chatHistoryDiv.clientHeight >= chatHistoryDiv.scrollHeight - 50) {
+                loadMoreChats();
+            }
+        });
+    }
+    
+    // 搜索对话（输入停止 300ms 后检索）
+    const searchInput = document.getElementById('chatSearchInput');
+    if (searchInput) {
+        searchInput.addEventListener('input', () => {
+            clearTimeout(chatSearchTimer);
+            chatSearchTimer = setTimeout(searchChats, 300);
+        });
+    }
 });
 
 // 自动调整输入框高度
@@ -43,11 +65,6 @@ async function sendMessage() {
     
     if (!message) return;
     
-    // 如果是新对话，创建对话记录
-    if (!currentChatId) {
-        await createNewChat(message);
-    }
-    
     // 禁用输入和按钮
     input.disabled = true;
     document.getElementById('sendBtn').disabled = true;
@@ -73,8 +90,8 @@ async function sendMessage() {
     const thinkingId = showThinking();
     
     try {
-        // 使用 Server-Sent Events 接收流式响应，传递对话历史
-        const assistantMessage = await streamChatResponse(chatHistory, thinkingId);
+        // 使用 Server-Sent Events 接收流式响应，只上传本轮消息，历史由服务端加载和保存
+        const assistantMessage = await streamChatResponse(message, thinkingId);
         
         // 将 AI 回复添加到对话历史
         if (assistantMessage && assistantMessage.trim()) {
@@ -86,9 +103,6 @@ async function sendMessage() {
         } else {
             console.warn('⚠️ AI 回复为空，未添加到历史');
         }
-        
-        // 保存对话历史
-        await saveChatHistory();
     } catch (error) {
         console.error('❌ Error:', error);
         const errorMsg = error.message || '请求失败，请重试';
@@ -302,7 +316,7 @@ function updateThinking(thinkingId, type, content) {
 }
 
 // 流式接收聊天响应（使用 fetch + ReadableStream）
-async function streamChatResponse(history, thinkingId) {
+async function streamChatResponse(message, thinkingId) {
     let reader = null;
     
     try {
@@ -312,18 +326,18 @@ async function streamChatResponse(history, thinkingId) {
             eventSource = null;
         }
         
-        console.log('📤 发送请求，对话历史长度:', history.length);
-        console.log('📤 对话历史:', JSON.stringify(history, null, 2));
+        console.log('📤 发送请求，对话 ID:', currentChatId);
         
-        // 使用 POST 方法发送请求，支持更长的对话历史
+        // 只发送本轮消息和对话 ID，新对话由服务端创建
         const response = await fetch('/api/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({
-                history: history,
-                model: 'gpt-5'
+                message: message,
+                model: 'gpt-5',
+                chat_id: currentChatId
             })
         });
         
@@ -367,6 +381,7 @@ async function streamChatResponse(history, thinkingId) {
                                 if (data.type === 'complete') {
                                     finalMessage = data.content || finalMessage;
                                     hasComplete = true;
+                                    handleChatSaved(data);
                                 }
                             } catch (e) {
                                 console.error('解析最后数据失败:', e);
@@ -395,7 +410,10 @@ async function streamChatResponse(history, thinkingId) {
                         const data = JSON.parse(jsonStr);
                         console.log('收到数据:', data.type, data.content ? data.content.substring(0, 50) : data.message);
                         
-                        if (data.type === 'log') {
+                        if (data.type === 'chat') {
+                            // 服务端确认的对话 ID（新对话由服务端生成）
+                            currentChatId = data.chat_id;
+                        } else if (data.type === 'log') {
                             // 日志信息
                             updateThinking(thinkingId, 'log', data.content);
                         } else if (data.type === 'content') {
@@ -407,6 +425,7 @@ async function streamChatResponse(history, thinkingId) {
                             finalMessage = data.content || finalMessage;
                             updateThinking(thinkingId, 'complete', finalMessage);
                             hasComplete = true;
+                            handleChatSaved(data);
                             // 继续读取直到流结束
                         } else if (data.type === 'error') {
                             // 错误
@@ -455,24 +474,95 @@ async function streamChatResponse(history, thinkingId) {
     }
 }
 
-// 加载对话列表
+// 对话列表项的排序比较：a 是否排在 b 之后（按 updated_at、id 倒序）
+function isOlderChat(a, b) {
+    return a.updated_at < b.updated_at || (a.updated_at === b.updated_at && a.id < b.id);
+}
+
+// 加载对话列表（只重新拉取第一页，已经加载的后续页保留）
 async function loadChatList() {
     try {
-        const response = await fetch('/api/chats');
+        const response = await fetch(`/api/chats?limit=${CHAT_LIST_PAGE_SIZE}`);
+        const data = await response.json();
+        const firstPage = data.chats || [];
+        if (data.next_cursor && chatListItems.length > firstPage.length) {
+            const ids = new Set(firstPage.map(chat => chat.id));
+            const last = firstPage[firstPage.length - 1];
+            const rest = chatListItems.filter(chat => !ids.has(chat.id) && isOlderChat(chat, last));
+            chatListItems = firstPage.concat(rest);
+        } else {
+            chatListItems = firstPage;
+            chatListCursor = data.next_cursor || null;
+        }
+        if (!getChatSearchQuery()) {
+            renderChatList(chatListItems);
+        }
+    } catch (error) {
+        console.error('加载对话列表失败:', error);
+    }
+}
+
+// 加载下一页对话列表
+async function loadMoreChats() {
+    if (!chatListCursor || chatListLoading) return;
+    chatListLoading = true;
+    try {
+        const response = await fetch(`/api/chats?limit=${CHAT_LIST_PAGE_SIZE}&cursor=${encodeURIComponent(chatListCursor)}`);
         const data = await response.json();
-        renderChatList(data.chats || []);
+        const ids = new Set(chatListItems.map(chat => chat.id));
+        chatListItems = chatListItems.concat((data.chats || []).filter(chat => !ids.has(chat.id)));
+        chatListCursor = data.next_cursor || null;
+        renderChatList(chatListItems);
     } catch (error) {
         console.error('加载对话列表失败:', error);
+    } finally {
+        chatListLoading = false;
+    }
+}
+
+// 当前的对话搜索词
+function getChatSearchQuery() {
+    const searchInput = document.getElementById('chatSearchInput');
+    return searchInput ? searchInput.value.trim() : '';
+}
+
+// 搜索对话，搜索词为空时恢复对话列表
+async function searchChats() {
+    const query = getChatSearchQuery();
+    if (!query) {
+        renderChatList(chatListItems);
+        return;
+    }
+    try {
+        const response = await fetch(`/api/chats/search?q=${encodeURIComponent(query)}`);
+        const data = await response.json();
+        if (query !== getChatSearchQuery()) return; // 结果返回前搜索词已改变
+        renderChatList(data.results || [], '没有找到相关对话');
+    } catch (error) {
+        console.error('搜索对话失败:', error);
+    }
+}
+
+// 渲染摘要，命中的部分高亮（高亮位置按 Unicode 字符计数）
+function renderSnippet(snippet) {
+    const chars = Array.from(snippet.text);
+    let html = '';
+    let position = 0;
+    for (const [start, end] of snippet.highlights || []) {
+        html += escapeHtml(chars.slice(position, start).join(''));
+        html += `<mark>${escapeHtml(chars.slice(start, end).join(''))}</mark>`;
+        position = end;
     }
+    return html + escapeHtml(chars.slice(position).join(''));
 }
 
 // 渲染对话列表
-function renderChatList(chats) {
+function renderChatList(chats, emptyText = '暂无历史对话') {
     const chatHistoryDiv = document.querySelector('.chat-history');
     if (!chatHistoryDiv) return;
     
     if (chats.length === 0) {
-        chatHistoryDiv.innerHTML = '<div class="empty-chat-list">暂无历史对话</div>';
+        chatHistoryDiv.innerHTML = `<div class="empty-chat-list">${emptyText}</div>`;
         return;
     }
     
@@ -485,6 +575,7 @@ function renderChatList(chats) {
                     <button class="chat-delete-btn" data-chat-id="${chat.id}" title="删除">🗑️</button>
                 </div>
             </div>
+            ${chat.snippet ? `<div class="chat-item-snippet">${renderSnippet(chat.snippet)}</div>` : ''}
         </div>
     `).join('');
     
@@ -517,67 +608,23 @@ function renderChatList(chats) {
     });
 }
 
-// 创建新对话
-async function createNewChat(firstMessage) {
-    try {
-        const response = await fetch('/api/chats', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                first_message: firstMessage
-            })
-        });
-        
-        const chat = await response.json();
-        currentChatId = chat.id;
-        
-        // 重新加载对话列表
-        await loadChatList();
-        
-        return chat;
-    } catch (error) {
-        console.error('创建新对话失败:', error);
-        // 即使创建失败，也继续发送消息
-        return null;
-    }
-}
-
-// 保存对话历史
-async function saveChatHistory() {
-    if (chatHistory.length === 0) return;
-    
-    // 如果没有currentChatId，尝试从历史记录中获取第一条用户消息来创建对话
-    if (!currentChatId) {
-        const firstUserMessage = chatHistory.find(msg => msg.role === 'user');
-        if (firstUserMessage) {
-            const chat = await createNewChat(firstUserMessage.content);
-            if (!chat) {
-                console.warn('创建对话失败，无法保存历史');
-                return;
-            }
-        } else {
-            return;
-        }
+// 服务端保存本轮消息后，在本地更新对话列表（不重新请求列表）
+function handleChatSaved(data) {
+    if (!data.chat) return;
+    if (data.save_error) {
+        console.warn('⚠️', data.save_error);
+        return;
     }
-    
-    try {
-        await fetch(`/api/chats/${currentChatId}/save`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                chat_id: currentChatId,
-                history: chatHistory
-            })
-        });
-        
-        // 更新对话列表（标题可能已更新）
-        await loadChatList();
-    } catch (error) {
-        console.error('保存对话历史失败:', error);
+    const existing = chatListItems.find(chat => chat.id === data.chat.id);
+    const item = {
+        id: data.chat.id,
+        title: data.chat.title,
+        created_at: existing ? existing.created_at : data.chat.updated_at,
+        updated_at: data.chat.updated_at
+    };
+    chatListItems = [item].concat(chatListItems.filter(chat => chat.id !== item.id));
+    if (!getChatSearchQuery()) {
+        renderChatList(chatListItems);
     }
 }
 
@@ -682,6 +729,7 @@ async function deleteChat(chatId, event) {
             }
             
             // 重新加载对话列表
+            chatListItems = chatListItems.filter(chat => chat.id !== chatId);
             await loadChatList();
         }
     } catch (error) {
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试上游调用的准入控制
+
+覆盖队列满时按优先级挤出等待者、按平均调用耗时估算的 Retry-After，以及
+排队或占用名额期间被取消时归还名额。只使用进程内的 AdmissionController，
+不需要启动服务。
+"""
+
+import asyncio
+
+import pytest
+
+from admission import (
+    AdmissionController,
+    AdmissionRejected,
+    PRIORITY_API,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+)
+
+
+async def _hold(controller: AdmissionController, priority: int, release: asyncio.Event):
+    async with controller.slot(priority):
+        await release.wait()
+
+
+async def _settle():
+    """让已创建的任务运行到各自的第一个等待点"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_full_queue_evicts_lowest_priority():
+    async def scenario():
+        controller = AdmissionController("test", 1, max_queue=2, max_wait=5)
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold(controller, PRIORITY_API, release))
+        batch = asyncio.create_task(_hold(controller, PRIORITY_BATCH, release))
+        api = asyncio.create_task(_hold(controller, PRIORITY_API, release))
+        await _settle()
+        assert controller.get_stats()["waiting"] == {"interactive": 0, "api": 1, "batch": 1}
+
+        # 队列已满：交互式调用挤掉批量任务
+        interactive = asyncio.create_task(_hold(controller, PRIORITY_INTERACTIVE, release))
+        await _settle()
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await batch
+        assert excinfo.value.reason == "被更高优先级的请求挤出队列"
+        assert controller.stats["evicted"] == 1
+
+        # 没有更低优先级的等待者时，新的批量任务直接被拒绝
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await _hold(controller, PRIORITY_BATCH, release)
+        assert excinfo.value.reason == "等待队列已满"
+
+        # 名额按优先级转交：交互式调用先于更早排队的 API 调用
+        order = []
+        api.add_done_callback(lambda _: order.append("api"))
+        interactive.add_done_callback(lambda _: order.append("interactive"))
+        release.set()
+        await asyncio.gather(holder, api, interactive)
+        assert order == ["interactive", "api"]
+        assert controller.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_follows_average_hold_time():
+    async def scenario():
+        controller = AdmissionController("test", 2, max_queue=10, max_wait=3.5)
+        # 名额空闲时不需要排队
+        assert controller.estimate_wait(PRIORITY_API) == 0.0
+
+        # 两次调用各耗时 4 秒后，平均耗时从初始的 1 秒向 4 秒靠近
+        for _ in range(2):
+            await controller.acquire(PRIORITY_API)
+        controller.release(4.0)
+        controller.release(4.0)
+        avg_hold = controller.get_stats()["avg_hold_seconds"]
+        assert 1.0 < avg_hold < 4.0
+
+        release = asyncio.Event()
+        holders = [asyncio.create_task(_hold(controller, PRIORITY_API, release)) for _ in range(2)]
+        waiters = [asyncio.create_task(_hold(controller, PRIORITY_BATCH, release)) for _ in range(3)]
+        await _settle()
+        # 新的 API 调用排在 3 个批量任务之前，只需等待一个名额
+        assert controller.estimate_wait(PRIORITY_API) == pytest.approx(avg_hold / 2, abs=1e-3)
+        # 新的批量任务排在 3 个批量任务之后，预计等待超过上限，Retry-After 即预计的排队时间
+        expected = 4 * avg_hold / 2
+        assert expected > controller.max_wait
+        with pytest.raises(AdmissionRejected) as excinfo:
+            controller.check(PRIORITY_BATCH)
+        assert excinfo.value.retry_after == pytest.approx(expected, abs=1e-3)
+        assert controller.stats["rejected_wait"] == 1
+
+        release.set()
+        await asyncio.gather(*holders, *waiters)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_calls_release_slots():
+    async def scenario():
+        controller = AdmissionController("test", 1, max_queue=10, max_wait=5)
+        release = asyncio.Event()
+        await controller.acquire(PRIORITY_API)
+        waiter = asyncio.create_task(_hold(controller, PRIORITY_API, release))
+        await _settle()
+        assert controller.in_flight == 1
+
+        # 取消排队中的调用：不占用名额，也不再留在队列中
+        waiter.cancel()
+        await _settle()
+        assert waiter.cancelled()
+        assert controller.get_stats()["waiting"]["api"] == 0
+
+        # 名额转交给等待者的同时等待者被取消：名额归还，不会泄漏
+        late = asyncio.create_task(_hold(controller, PRIORITY_API, release))
+        await _settle()
+        controller.release()
+        late.cancel()
+        await _settle()
+        assert late.cancelled()
+        assert controller.in_flight == 0
+
+        # 占用名额期间被取消：退出 slot() 时归还
+        holder = asyncio.create_task(_hold(controller, PRIORITY_API, release))
+        await _settle()
+        assert controller.in_flight == 1
+        holder.cancel()
+        await _settle()
+        assert holder.cancelled()
+        assert controller.in_flight == 0
+        assert controller.estimate_wait(PRIORITY_API) == 0.0
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_full_queue_evicts_lowest_priority()
+    test_retry_after_follows_average_hold_time()
+    test_cancelled_calls_release_slots()
+    print("✅ 准入控制测试通过")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试对话上下文裁剪和滚动摘要
+
+- split_context 按 token 预算从后往前保留消息，切分点只落在用户消息上
+- 切分点后移时只把新移出窗口的消息合并进已有摘要；已覆盖部分的历史被
+  改写（指纹不一致）时从头生成
+
+摘要模型用本地函数代替，对话存储使用临时目录中的文件存储，不需要启动服务。
+"""
+
+import asyncio
+import tempfile
+
+import pytest
+
+import upstream
+from chat_context import ChatContextManager, estimate_message_tokens, split_context
+from chat_store import FileChatStore
+
+# 每条消息 4 + 36 / 4 = 13 个 token
+TEXT = "x" * 36
+
+
+def _round(index: int) -> list:
+    return [
+        {"role": "user", "content": f"{TEXT[:-2]}q{index}"},
+        {"role": "assistant", "content": f"{TEXT[:-2]}a{index}"},
+    ]
+
+
+def _history(rounds: int) -> list:
+    return [message for index in range(rounds) for message in _round(index)]
+
+
+def test_split_context_keeps_recent_rounds_within_budget():
+    history = _history(3)
+    assert all(estimate_message_tokens(message) == 13 for message in history)
+
+    # 全部放得下时不裁剪
+    assert split_context(history, 1000) == 0
+    # 从后往前：最后一轮 26，最后两轮 52
+    assert split_context(history, 30) == 4
+    assert split_context(history, 60) == 2
+    # 最后一轮本身超出预算时仍然完整保留最后一轮
+    assert split_context(history, 10) == 4
+
+    # 工具调用和它的结果不会被拆开：切分点落在发起工具调用的那轮用户消息上
+    tool_round = [
+        {"role": "user", "content": TEXT},
+        {"role": "assistant", "content": None, "tool_calls": [
+            {"id": "call_1", "type": "function", "function": {"name": "search", "arguments": "{\"keyword\": \"x\"}"}}
+        ]},
+        {"role": "tool", "tool_call_id": "call_1", "content": TEXT * 3},
+        {"role": "assistant", "content": TEXT},
+    ]
+    history = _history(2) + tool_round
+    cut = split_context(history, 80)
+    assert cut == 4
+    assert history[cut]["role"] == "user"
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    """代替摘要模型，记录每次收到的 prompt"""
+    prompts = []
+
+    async def fake_post_chat(payload: dict, timeout: float = 0) -> dict:
+        prompts.append(payload["messages"][0]["content"])
+        return {"choices": [{"message": {"content": f"摘要{len(prompts)}"}}]}
+
+    monkeypatch.setattr(upstream, "post_chat", fake_post_chat)
+    return prompts
+
+
+def test_summary_is_extended_and_rebuilt_by_fingerprint(summarizer):
+    with tempfile.TemporaryDirectory() as directory:
+        store = FileChatStore(directory, flush_delay=0)
+        manager = ChatContextManager(store, budget=30)
+
+        # 三轮对话只保留最后一轮，前两轮生成摘要
+        history = _history(3)
+        messages, info = asyncio.run(manager.prepare("chat", history, "model"))
+        assert info["trimmed"] and info["summarized"]
+        assert info["kept_messages"] == 2
+        assert messages[0] == {"role": "system", "content": "以下是本次对话较早部分的摘要：\n摘要1"}
+        assert len(summarizer) == 1
+        assert "q0" in summarizer[0] and "a1" in summarizer[0]
+        record = store.get_summary("chat")
+        assert record["covered"] == 4
+
+        # 同一切分点再次请求：直接复用已保存的摘要
+        asyncio.run(manager.prepare("chat", history, "model"))
+        assert len(summarizer) == 1
+
+        # 新增一轮：只把新移出窗口的一轮合并进已有摘要
+        history = _history(4)
+        messages, _ = asyncio.run(manager.prepare("chat", history, "model"))
+        assert len(summarizer) == 2
+        assert "摘要1" in summarizer[1]
+        assert "q2" in summarizer[1] and "q0" not in summarizer[1] and "q1" not in summarizer[1]
+        assert messages[0]["content"].endswith("摘要2")
+        assert store.get_summary("chat")["covered"] == 6
+        assert manager.stats["summary_rebuilds"] == 0
+
+        # 已覆盖部分的历史被改写：指纹不一致，从头生成
+        history[0] = {"role": "user", "content": f"{TEXT[:-2]}改写"}
+        asyncio.run(manager.prepare("chat", history, "model"))
+        assert len(summarizer) == 3
+        assert "（无）" in summarizer[2]
+        assert "改写" in summarizer[2] and "q2" in summarizer[2]
+        assert manager.stats["summary_rebuilds"] == 1
+        store.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
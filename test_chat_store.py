@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试对话存储
+
+- 文件存储的并发读取：一个线程不断追加消息（追加日志很快达到合并阈值），
+  多个线程同时不加锁地读取同一个对话，读到的历史不能重复或乱序，也不能
+  因为文件在读取期间被替换或删除而出错
+- 从文件存储迁移到 SQLite 时对话和滚动摘要都被迁移
+
+不需要启动服务。
+"""
+
+import os
+import tempfile
+import threading
+
+import chat_store
+from chat_store import FileChatStore, SqliteChatStore, migrate
+
+WRITES = 300
+READERS = 4
+
+
+def test_concurrent_reads_during_compaction():
+    original_threshold = chat_store.CHAT_LOG_COMPACT_THRESHOLD
+    chat_store.CHAT_LOG_COMPACT_THRESHOLD = 3
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileChatStore(directory, flush_delay=0)
+            stop = threading.Event()
+            reads = [0]
+            errors = []
+
+            def writer():
+                try:
+                    for i in range(WRITES):
+                        store.append_messages("chat", [{"role": "user", "content": str(i)}], f"t{i:05d}")
+                finally:
+                    stop.set()
+
+            def reader():
+                while not stop.is_set():
+                    try:
+                        chat_data = store.get_chat("chat")
+                    except Exception as e:
+                        errors.append(f"读取出错: {e!r}")
+                        continue
+                    reads[0] += 1
+                    if chat_data is None:
+                        continue
+                    contents = [message["content"] for message in chat_data["history"]]
+                    if contents != [str(i) for i in range(len(contents))]:
+                        errors.append(f"历史重复或乱序: {contents[-6:]}")
+                    if chat_data["version"] != len(contents):
+                        errors.append(f"version 与历史长度不一致: {chat_data['version']} != {len(contents)}")
+
+            threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(READERS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            store.close()
+
+            final = store.get_chat("chat")
+            print(f"读取次数: {reads[0]}，错误: {len(errors)}")
+            for error in errors[:5]:
+                print(f"  {error}")
+            assert not errors, errors[:5]
+            assert final["version"] == WRITES
+            assert [message["content"] for message in final["history"]] == [str(i) for i in range(WRITES)]
+    finally:
+        chat_store.CHAT_LOG_COMPACT_THRESHOLD = original_threshold
+
+
+def test_migrate_copies_chats_and_summaries():
+    with tempfile.TemporaryDirectory() as directory:
+        source = FileChatStore(os.path.join(directory, "files"), flush_delay=0)
+        source.append_messages("with_summary", [{"role": "user", "content": "你好"}], "t1", title="问候")
+        source.append_messages("with_summary", [{"role": "assistant", "content": "你好！"}], "t2")
+        source.append_messages("plain", [{"role": "user", "content": "天气"}], "t3")
+        summary = {"content": "用户打招呼", "covered": 1, "fingerprint": "abc", "updated_at": "t2"}
+        source.put_summary("with_summary", summary)
+
+        target = SqliteChatStore(os.path.join(directory, "chats.db"))
+        assert migrate(source, target) == 2
+        chat_data = target.get_chat("with_summary")
+        assert chat_data["title"] == "问候"
+        assert [message["content"] for message in chat_data["history"]] == ["你好", "你好！"]
+        assert target.get_summary("with_summary") == summary
+        assert target.get_summary("plain") is None
+        source.close()
+        target.close()
+
+
+if __name__ == "__main__":
+    test_concurrent_reads_during_compaction()
+    test_migrate_copies_chats_and_summaries()
+    print("✅ 对话存储测试通过")
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试上游调用的熔断和重试
+
+用假时钟代替 resilience 中的 time，重试等待只记录时长、推进假时钟，不真正
+睡眠，测试结果与运行速度无关。不需要启动服务。
+"""
+
+import asyncio
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, call_with_retry
+
+
+class FakeClock:
+    """代替 time 模块的 monotonic() / time()，并提供推进时钟的 sleep()"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    async def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.advance(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(resilience, "time", clock)
+    monkeypatch.setattr(resilience.asyncio, "sleep", clock.sleep)
+    # 退避等待取抖动区间的上限，便于断言
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    return clock
+
+
+def _status_error(status: int, retry_after=None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://upstream.test/chat/completions")
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+
+def _calls(breaker: CircuitBreaker, *outcomes):
+    for failed in outcomes:
+        breaker.before_call()
+        breaker.after_call(failed)
+
+
+def _flaky(*errors, result="ok"):
+    """依次抛出 errors 中的异常，之后返回 result；记录调用次数"""
+    remaining = list(errors)
+    calls = []
+
+    async def fn():
+        calls.append(len(calls) + 1)
+        if remaining:
+            raise remaining.pop(0)
+        return result
+
+    return fn, calls
+
+
+def test_breaker_opens_half_opens_and_closes(clock):
+    breaker = CircuitBreaker("test", window=30, min_requests=4, failure_rate=0.5, open_seconds=15)
+
+    # 窗口外的失败不计入失败率
+    _calls(breaker, True, True, True)
+    clock.advance(31)
+    _calls(breaker, False, False, True)
+    assert breaker.state == CLOSED
+    # 窗口内 4 次调用中 2 次失败，达到失败率阈值
+    _calls(breaker, True)
+    assert breaker.state == OPEN
+    assert breaker.stats["opened"] == 1
+
+    # 冷却期间的调用立即失败，Retry-After 为剩余的冷却时间
+    clock.advance(10)
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.before_call()
+    assert excinfo.value.retry_after == pytest.approx(5)
+    assert breaker.get_stats()["retry_after"] == pytest.approx(5)
+
+    # 冷却结束后只放行一个探测请求，探测失败则重新打开
+    clock.advance(5)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.after_call(True)
+    assert breaker.state == OPEN
+    assert breaker.stats["opened"] == 2
+
+    # 探测请求被取消时放行下一个探测请求
+    clock.advance(15)
+    breaker.before_call()
+    breaker.after_call(None)
+    assert breaker.state == HALF_OPEN
+
+    # 探测成功则关闭，并清空窗口内的统计
+    breaker.before_call()
+    breaker.after_call(False)
+    assert breaker.state == CLOSED
+    assert breaker.get_stats()["window_requests"] == 0
+    assert breaker.stats["rejected"] == 2
+
+
+def test_retry_honors_retry_after(clock):
+    breaker = CircuitBreaker("test", min_requests=100)
+
+    # Retry-After 为秒数
+    fn, calls = _flaky(_status_error(503, "2"))
+    assert asyncio.run(call_with_retry(breaker, fn)) == "ok"
+    assert calls == [1, 2]
+    assert clock.sleeps == [2.0]
+
+    # Retry-After 为 HTTP 日期
+    clock.sleeps.clear()
+    fn, calls = _flaky(_status_error(429, formatdate(clock.now + 3, usegmt=True)))
+    assert asyncio.run(call_with_retry(breaker, fn)) == "ok"
+    assert calls == [1, 2]
+    assert clock.sleeps == [pytest.approx(3, abs=1)]
+
+    # 要求等待的时间超过 UPSTREAM_RETRY_MAX_DELAY 时不再重试
+    clock.sleeps.clear()
+    fn, calls = _flaky(_status_error(503, str(resilience.UPSTREAM_RETRY_MAX_DELAY + 1)))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(call_with_retry(breaker, fn))
+    assert calls == [1]
+    assert clock.sleeps == []
+    assert breaker.stats["retries"] == 2
+
+
+def test_retry_backs_off_and_skips_read_timeouts(clock):
+    breaker = CircuitBreaker("test", min_requests=100)
+
+    # 连接失败按指数退避重试，达到最多尝试次数后抛出最后一次的异常
+    errors = [httpx.ConnectError("refused") for _ in range(resilience.UPSTREAM_RETRY_MAX_ATTEMPTS)]
+    fn, calls = _flaky(*errors)
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(call_with_retry(breaker, fn))
+    assert len(calls) == resilience.UPSTREAM_RETRY_MAX_ATTEMPTS
+    base = resilience.UPSTREAM_RETRY_BASE_DELAY
+    assert clock.sleeps == [
+        min(resilience.UPSTREAM_RETRY_MAX_DELAY, base * 2 ** attempt)
+        for attempt in range(resilience.UPSTREAM_RETRY_MAX_ATTEMPTS - 1)
+    ]
+
+    # 读超时已经等满了超时时间，不重试，但计入熔断器的失败
+    clock.sleeps.clear()
+    failures = breaker.stats["failures"]
+    fn, calls = _flaky(httpx.ReadTimeout("timed out"))
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(call_with_retry(breaker, fn))
+    assert calls == [1]
+    assert clock.sleeps == []
+    assert breaker.stats["failures"] == failures + 1
+
+    # 4xx（429 除外）既不重试也不计入熔断器的失败
+    fn, calls = _flaky(_status_error(400))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(call_with_retry(breaker, fn))
+    assert calls == [1]
+    assert breaker.stats["failures"] == failures + 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-q"])
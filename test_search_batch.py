@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试一轮 search 工具调用的批量预取和推测搜索结果的使用
+
+模型偶尔给出格式不对的工具参数（max_results 为 null、参数是 JSON 数组、
+arguments 为 null），批量预取和推测搜索的匹配应跳过这些调用，只为正常的
+调用返回结果，而不是让整轮对话失败。推测搜索的关键字与模型给出的只是相近
+时，工具结果中注明实际搜索的关键字。上游搜索用本地函数代替，不需要启动服务。
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _tool_call(call_id: str, arguments) -> dict:
+    return {"id": call_id, "type": "function", "function": {"name": "search", "arguments": arguments}}
+
+
+def _import_main():
+    # main 在导入时创建日志和对话目录，放到临时目录中
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+def test_batch_skips_malformed_tool_calls():
+    main = _import_main()
+    import upstream
+
+    requests = []
+
+    async def fake_post_search(payload: dict) -> dict:
+        requests.append(payload)
+        return {"queries": [
+            {"keyword": keyword, "response": {"results": [{"title": keyword, "url": "https://example.com"}]}}
+            for keyword in payload["keywords"]
+        ]}
+
+    original_post_search = upstream.post_search
+    upstream.post_search = fake_post_search
+    try:
+        tool_calls = [
+            _tool_call("bad_null_max", json.dumps({"keyword": "坏参数一", "max_results": None})),
+            _tool_call("bad_array", "[1]"),
+            _tool_call("bad_none", None),
+            _tool_call("bad_max", json.dumps({"keyword": "坏参数二", "max_results": "很多"})),
+            _tool_call("ok_1", json.dumps({"keyword": "批量测试甲", "max_results": 3})),
+            _tool_call("ok_2", json.dumps({"keyword": "批量测试乙"})),
+        ]
+        context = asyncio.run(main._prepare_tool_context(tool_calls))
+    finally:
+        upstream.post_search = original_post_search
+
+    prefetched = context["prefetched"]
+    print(f"预取结果: {sorted(prefetched)}")
+    print(f"上游请求: {requests}")
+    # max_results 为 null 时按默认值处理；其余格式不对的调用被跳过
+    assert set(prefetched) == {"坏参数一", "批量测试甲", "批量测试乙"}
+    assert len(requests) == 1
+    assert requests[0]["keywords"] == ["坏参数一", "批量测试甲", "批量测试乙"]
+
+
+def test_speculative_result_names_searched_keyword():
+    main = _import_main()
+    from speculative_search import HIT, SpeculativeSearch
+
+    searched = []
+
+    async def fake_search(keyword: str, max_results: int) -> dict:
+        searched.append(keyword)
+        return {"queries": [{"keyword": keyword, "response": {"results": [{"title": "结果", "url": "https://example.com"}]}}]}
+
+    async def scenario():
+        speculator = SpeculativeSearch(fake_search, enabled=True)
+        speculation = speculator.start([{"role": "user", "content": "最新的 AI 新闻有哪些？"}])
+        assert speculation is not None
+        tool_calls = [
+            _tool_call("bad_array", "[1]"),
+            _tool_call("bad_keyword", json.dumps({"keyword": ["AI"]})),
+            _tool_call("ok", json.dumps({"keyword": "AI 最新新闻", "max_results": None})),
+        ]
+        context = await main._prepare_tool_context(tool_calls, speculation)
+        content = await main._search_tool_handler({"keyword": "AI 最新新闻"}, context)
+        return speculator, context, content
+
+    speculator, context, content = asyncio.run(scenario())
+    print(content)
+    assert speculator.stats[HIT] == 1
+    assert searched == ["最新 ai 新闻"]
+    assert context["searched_keywords"] == {"ai 最新新闻": "最新 ai 新闻"}
+    assert content.startswith("搜索关键字: 最新 ai 新闻（与请求的关键字「AI 最新新闻」相近")
+
+
+if __name__ == "__main__":
+    test_batch_skips_malformed_tool_calls()
+    test_speculative_result_names_searched_keyword()
+    print("✅ 批量预取测试通过")
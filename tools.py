@@ -0,0 +1,267 @@
+"""
+工具注册表与进程级工具执行器
+
+每个工具在注册表中声明自己的 JSON Schema、超时时间、最大并发数以及结果
+是否可缓存。Agentic Loop 从注册表生成 tools 定义，并通过共享的
+ToolExecutor 执行模型发出的工具调用：
+- 全局并发上限 + 每个工具的并发上限，超出的调用在信号量上排队
+- 每次调用有独立超时
+- 同一轮中参数完全相同的可缓存工具调用只执行一次
+- 记录排队深度和每个工具的延迟
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import metrics
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "32"))
+
+
+class ToolSpec:
+    """
+    工具定义
+
+    Args:
+        name: 工具名称（模型调用时使用）
+        description: 提供给模型的工具说明
+        parameters: 参数的 JSON Schema
+        handler: 异步处理函数 handler(arguments, context) -> str，context 是本轮共享的上下文字典
+        timeout: 单次调用超时（秒）
+        max_concurrency: 该工具的最大并发调用数
+        cacheable: 相同参数的调用结果是否可以复用
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        parameters: dict,
+        handler: Callable[..., Awaitable[str]],
+        timeout: float = 30,
+        max_concurrency: int = 8,
+        cacheable: bool = False
+    ):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.handler = handler
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.cacheable = cacheable
+
+    def schema(self) -> dict:
+        """返回 chat/completions 请求中 tools 字段使用的定义"""
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": self.parameters
+            }
+        }
+
+
+class ToolRegistry:
+    """工具注册表"""
+
+    def __init__(self):
+        self._tools: Dict[str, ToolSpec] = {}
+
+    def register(self, spec: ToolSpec) -> ToolSpec:
+        self._tools[spec.name] = spec
+        return spec
+
+    def get(self, name: str) -> Optional[ToolSpec]:
+        return self._tools.get(name)
+
+    def names(self) -> List[str]:
+        return list(self._tools)
+
+    def schemas(self) -> List[dict]:
+        """所有已注册工具的 tools 定义"""
+        return [spec.schema() for spec in self._tools.values()]
+
+
+class _ToolStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0  # 开始执行并已结束的调用（排队时被取消的不计入）
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "queued": self.queued,
+            "running": self.running,
+            "avg_latency_ms": round(self.total_latency / self.completed * 1000, 1) if self.completed else 0.0,
+            "max_latency_ms": round(self.max_latency * 1000, 1),
+        }
+
+
+class ToolExecutor:
+    """进程内共享的工具执行器"""
+
+    def __init__(self, registry: ToolRegistry, max_concurrency: int):
+        self.registry = registry
+        self.max_concurrency = max_concurrency
+        self._global_semaphore = asyncio.Semaphore(max_concurrency)
+        self._tool_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats: Dict[str, _ToolStats] = {}
+
+    def _semaphore_for(self, spec: ToolSpec) -> asyncio.Semaphore:
+        semaphore = self._tool_semaphores.get(spec.name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(spec.max_concurrency)
+            self._tool_semaphores[spec.name] = semaphore
+        return semaphore
+
+    async def _run(self, spec: ToolSpec, arguments: dict, context: dict) -> str:
+        with tracer.span("tool.call", tool=spec.name, arguments=arguments) as span:
+            stats = self._stats.setdefault(spec.name, _ToolStats())
+            stats.calls += 1
+            stats.queued += 1
+            queued_at = time.perf_counter()
+            dequeued = False
+            try:
+                # 先取本工具的名额再取全局名额：等待本工具名额的调用不占用全局名额，
+                # 一个工具的突发调用不会挤占其他工具
+                async with self._semaphore_for(spec), self._global_semaphore:
+                    stats.queued -= 1
+                    stats.running += 1
+                    dequeued = True
+                    started_at = time.perf_counter()
+                    status = "ok"
+                    if span is not None:
+                        span.set(queued_ms=round((started_at - queued_at) * 1000, 1))
+                    try:
+                        return await asyncio.wait_for(spec.handler(arguments, context), timeout=spec.timeout)
+                    except asyncio.TimeoutError:
+                        status = "timeout"
+                        stats.timeouts += 1
+                        logger.error(f"   ❌ 工具调用超时（{spec.timeout}s）: {spec.name}")
+                        return f"工具调用超时: {spec.name}"
+                    except Exception as e:
+                        status = "error"
+                        stats.errors += 1
+                        logger.error(f"   ❌ 工具执行失败: {str(e)}")
+                        return f"工具执行失败: {str(e)}"
+                    except asyncio.CancelledError:
+                        status = "cancelled"
+                        raise
+                    finally:
+                        latency = time.perf_counter() - started_at
+                        stats.running -= 1
+                        stats.completed += 1
+                        stats.total_latency += latency
+                        stats.max_latency = max(stats.max_latency, latency)
+                        metrics.tool_call_seconds.observe(latency, tool=spec.name, status=status)
+                        if span is not None and status in ("timeout", "error"):
+                            span.status = "error"
+                            span.error = status
+            finally:
+                if not dequeued:
+                    stats.queued -= 1
+
+    async def execute(self, tool_call: dict, context: Optional[dict] = None) -> tuple:
+        """
+        执行单个工具调用
+
+        Args:
+            tool_call: 模型返回的工具调用对象
+            context: 透传给工具处理函数的上下文
+
+        Returns:
+            tuple: (tool_call_id, content)
+        """
+        function_name = tool_call["function"]["name"]
+        tool_call_id = tool_call["id"]
+
+        logger.info("=" * 80)
+        logger.info(f"🔧 开始执行工具调用")
+        logger.info(f"   工具ID: {tool_call_id}")
+        logger.info(f"   工具名称: {function_name}")
+
+        spec = self.registry.get(function_name)
+        if spec is None:
+            content = f"未知的工具类型: {function_name}"
+            logger.warning(f"   ⚠️ 未知的工具类型: {function_name}")
+        else:
+            try:
+                arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+            except ValueError as e:
+                arguments = None
+                content = f"解析工具参数失败: {str(e)}"
+                logger.error(f"   ❌ 解析工具参数失败: {str(e)}")
+            if arguments is not None:
+                content = await self._run(spec, arguments, context or {})
+
+        logger.info(f"✅ 工具调用完成")
+        logger.info("=" * 80)
+
+        return tool_call_id, content
+
+    def _group_round(self, tool_calls: List[dict]) -> List[List[dict]]:
+        """把可缓存工具中名称和参数都相同的调用分到同一组"""
+        groups: Dict[str, List[dict]] = {}
+        for tool_call in tool_calls:
+            spec = self.registry.get(tool_call["function"]["name"])
+            group_key = tool_call["id"]
+            if spec is not None and spec.cacheable:
+                try:
+                    canonical_args = json.dumps(json.loads(tool_call["function"]["arguments"] or "{}"), sort_keys=True)
+                    group_key = f"{spec.name}:{canonical_args}"
+                except ValueError:
+                    pass
+            groups.setdefault(group_key, []).append(tool_call)
+        return list(groups.values())
+
+    async def iter_round(self, tool_calls: List[dict], context: Optional[dict] = None) -> AsyncIterator[tuple]:
+        """
+        并发执行一轮中的所有工具调用，按完成顺序产出结果
+
+        可缓存工具中名称和参数都相同的调用只执行一次，结果分发给同组的每个
+        tool_call_id。迭代被提前关闭时，尚未完成的工具调用会被取消。
+
+        Yields:
+            tuple: (tool_call_id, content)
+        """
+        async def run_group(group: List[dict]) -> tuple:
+            _, content = await self.execute(group[0], context)
+            return group, content
+
+        tasks = [asyncio.ensure_future(run_group(group)) for group in self._group_round(tool_calls)]
+        try:
+            for future in asyncio.as_completed(tasks):
+                group, content = await future
+                for tool_call in group:
+                    yield tool_call["id"], content
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def get_stats(self) -> dict:
+        tools = {name: stats.snapshot() for name, stats in self._stats.items()}
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queued": sum(stats["queued"] for stats in tools.values()),
+            "running": sum(stats["running"] for stats in tools.values()),
+            "tools": tools,
+        }
+
+
+tool_registry = ToolRegistry()
+tool_executor = ToolExecutor(tool_registry, TOOL_MAX_CONCURRENCY)
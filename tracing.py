@@ -0,0 +1,287 @@
+"""
+请求追踪
+
+用户反馈回答慢时，需要知道时间花在了哪一轮 LLM 调用、哪次搜索还是强制生成
+的最终答案上。这里提供轻量的进程内追踪：
+- TracingMiddleware 为 /chat、/api/chat/stream、/search 和 /api/chats* 请求
+  创建一个 trace，trace ID 通过响应头 X-Trace-Id 返回；流式接口的 trace
+  在事件流结束时才结束
+- 代码中用 tracer.span(name, **attributes) 记录嵌套的 span，父子关系通过
+  contextvar 传递，asyncio 任务和 asyncio.to_thread 中的调用自动继承；
+  不在 trace 中时 span() 什么也不做
+- 最近 TRACE_BUFFER_SIZE 个 trace 保存在内存环形缓冲区中（包括进行中的）；
+  多 worker 模式下结束的 trace 同时写入 shared_state，任意 worker 都能查到
+- GET /api/debug/traces/{trace_id} 返回 span 树
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional
+
+from shared_state import SharedState, shared_state
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "1000"))
+TRACE_SHARED_TTL = float(os.getenv("TRACE_SHARED_TTL", "3600"))
+
+TRACED_PATHS = ("/chat", "/search", "/api/chat/stream")
+TRACED_PREFIXES = ("/api/chats",)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """一个计时的操作"""
+
+    __slots__ = ("span_id", "parent_id", "name", "attributes", "start_time", "_started_at", "duration", "status", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: dict):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_time = time.time()
+        self._started_at = time.perf_counter()
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+
+    def set(self, **attributes):
+        """添加或更新属性"""
+        self.attributes.update(attributes)
+
+    def fail(self, error: BaseException):
+        self.status = "cancelled" if isinstance(error, asyncio.CancelledError) else "error"
+        self.error = str(error) or type(error).__name__
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started_at
+
+    def to_dict(self, trace_start: float) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start_time - trace_start) * 1000, 1),
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """一个请求的全部 span"""
+
+    def __init__(self, name: str, attributes: dict):
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(name, None, attributes)
+        self.spans: List[Span] = [self.root]
+        self.dropped_spans = 0
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append(span)
+
+    def to_dict(self) -> dict:
+        """序列化为 span 树，子 span 按开始时间排序"""
+        trace_start = self.root.start_time
+        with self._lock:
+            nodes = {span.span_id: {**span.to_dict(trace_start), "children": []} for span in self.spans}
+        for node in sorted(nodes.values(), key=lambda n: n["start_ms"]):
+            parent = nodes.get(node["parent_id"])
+            if parent is not None:
+                parent["children"].append(node)
+        root = nodes[self.root.span_id]
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "start_time": self.root.start_time,
+            "duration_ms": root["duration_ms"],
+            "status": self.root.status,
+            "span_count": len(nodes),
+            "dropped_spans": self.dropped_spans,
+            "root": root,
+        }
+
+    def summary(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "start_time": self.root.start_time,
+            "duration_ms": round(self.root.duration * 1000, 1) if self.root.duration is not None else None,
+            "status": self.root.status,
+        }
+
+
+class Tracer:
+    """进程内的 trace 环形缓冲区"""
+
+    def __init__(self, enabled: bool, buffer_size: int, shared: Optional[SharedState] = None):
+        self.enabled = enabled
+        self.buffer_size = buffer_size
+        self.shared = shared
+        self._traces = OrderedDict()  # trace_id -> Trace
+        self._lock = threading.Lock()
+        self.stats = {
+            "started": 0,
+            "evicted": 0,
+            "shared_writes": 0,
+            "shared_errors": 0,
+        }
+
+    def start_trace(self, name: str, **attributes) -> Trace:
+        """创建 trace 并设为当前 trace（调用方负责 finish_trace）"""
+        trace = Trace(name, attributes)
+        with self._lock:
+            self._traces[trace.trace_id] = trace
+            self.stats["started"] += 1
+            while len(self._traces) > self.buffer_size:
+                self._traces.popitem(last=False)
+                self.stats["evicted"] += 1
+        _current_trace.set(trace)
+        _current_span.set(trace.root)
+        return trace
+
+    async def finish_trace(self, trace: Trace, error: Optional[BaseException] = None):
+        """结束 trace 的根 span；多 worker 模式下写入共享状态"""
+        if error is not None:
+            trace.root.fail(error)
+        trace.root.end()
+        if self.shared is None:
+            return
+        try:
+            await asyncio.to_thread(self.shared.set, f"trace:{trace.trace_id}", trace.to_dict(), TRACE_SHARED_TTL)
+            self.stats["shared_writes"] += 1
+        except Exception as e:
+            self.stats["shared_errors"] += 1
+            logger.warning(f"⚠️ 写入共享 trace 失败: {e}")
+
+    def start_span(self, name: str, **attributes) -> Optional[Span]:
+        """
+        创建当前 span 的子 span，但不把它设为当前 span（调用方负责 span.end()）
+
+        用于异步生成器这类跨越多次 yield、可能在别的上下文中被关闭的代码。
+        不在 trace 中时返回 None。
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            return None
+        parent = _current_span.get()
+        span = Span(name, parent.span_id if parent is not None else None, attributes)
+        trace.add(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        记录一个 span，with 范围内创建的 span 是它的子 span
+
+        不在 trace 中时产出 None；异常会记录到 span 上并继续抛出。
+        """
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(e)
+            raise
+        finally:
+            span.end()
+            _current_span.reset(token)
+
+    def annotate(self, **attributes):
+        """给当前 span 添加属性（不在 trace 中时忽略）"""
+        span = _current_span.get()
+        if span is not None:
+            span.set(**attributes)
+
+    def current_trace_id(self) -> Optional[str]:
+        trace = _current_trace.get()
+        return trace.trace_id if trace is not None else None
+
+    def get_trace(self, trace_id: str) -> Optional[dict]:
+        with self._lock:
+            trace = self._traces.get(trace_id)
+        if trace is not None:
+            return trace.to_dict()
+        if self.shared is not None:
+            return self.shared.get(f"trace:{trace_id}")
+        return None
+
+    def recent(self, limit: int) -> List[dict]:
+        with self._lock:
+            traces = list(self._traces.values())[-limit:]
+        return [trace.summary() for trace in reversed(traces)]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            size = len(self._traces)
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "size": size,
+            "buffer_size": self.buffer_size,
+        }
+
+
+def _is_traced(path: str) -> bool:
+    return path in TRACED_PATHS or path.startswith(TRACED_PREFIXES)
+
+
+class TracingMiddleware:
+    """
+    为需要追踪的请求创建 trace（ASGI 中间件）
+
+    直接包装 ASGI 调用而不是使用 BaseHTTPMiddleware，这样流式响应的 trace
+    覆盖到事件流发送完毕。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled or not _is_traced(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        trace = tracer.start_trace(f"{scope['method']} {scope['path']}", method=scope["method"], path=scope["path"])
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                trace.root.set(status_code=message["status"])
+                if message["status"] >= 500:
+                    trace.root.status = "error"
+                message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode())]
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await tracer.finish_trace(trace, error)
+
+
+tracer = Tracer(TRACING_ENABLED, TRACE_BUFFER_SIZE, shared=shared_state)
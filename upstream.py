@@ -0,0 +1,332 @@
+"""
+AI Builder Space 上游 HTTP 客户端
+
+整个应用进程共享一个带连接池的 httpx.AsyncClient，所有上游调用都在事件循环中
+异步执行，不阻塞 uvicorn worker：
+- 连接池 + keep-alive，LLM 多轮调用和并行搜索复用已建立的 TCP/TLS 连接
+- 连接池大小、keep-alive 数量和过期时间可以通过环境变量配置
+- 认证请求头在创建客户端时一次性构建
+- 通过 httpx 的 trace 扩展统计新建连接数和复用连接数
+- chat 和 search 调用各自经过一个熔断器，失败时按退避策略重试（见 resilience.py）
+- 发出调用前先经过准入控制，占用 LLM 或搜索的并发名额（见 admission.py）
+"""
+import json
+import os
+import threading
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from admission import AdmissionController, llm_admission, search_admission
+from resilience import CircuitBreaker, call_with_retry
+
+# AI Builder Space 配置（压测时指向 fake_upstream.py）
+AI_BUILDER_BASE_URL = os.getenv("AI_BUILDER_BASE_URL", "https://space.ai-builders.com/backend/v1").rstrip("/")
+AI_BUILDER_CHAT_ENDPOINT = f"{AI_BUILDER_BASE_URL}/chat/completions"
+AI_BUILDER_SEARCH_ENDPOINT = f"{AI_BUILDER_BASE_URL}/search/"
+
+# 连接池配置（可通过环境变量覆盖）
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+
+# 各类调用的读超时（秒），与原先 requests.post 的 timeout 保持一致
+CHAT_TIMEOUT = 120
+SEARCH_TIMEOUT = 30
+
+
+class UpstreamTokenMissing(Exception):
+    """AI_BUILDER_TOKEN 未配置"""
+
+
+class PoolStats:
+    """连接池统计：请求数、新建连接数、TLS 握手数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        self.connect_failures = 0
+
+    async def trace(self, event_name: str, info: dict):
+        """httpx trace 扩展回调，由 httpcore 在连接和请求的各个阶段调用"""
+        with self._lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.connections_opened += 1
+            elif event_name == "connection.connect_tcp.failed":
+                self.connect_failures += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+            elif event_name.endswith(".send_request_headers.started"):
+                self.requests += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": max(0, self.requests - self.connections_opened),
+                "tls_handshakes": self.tls_handshakes,
+                "connect_failures": self.connect_failures,
+            }
+
+
+pool_stats = PoolStats()
+breakers = {
+    "chat": CircuitBreaker("chat"),
+    "search": CircuitBreaker("search"),
+}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _build_headers(token: str) -> dict:
+    return {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+    )
+
+
+def get_token() -> Optional[str]:
+    """读取 AI_BUILDER_TOKEN"""
+    return os.getenv("AI_BUILDER_TOKEN")
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    获取进程内共享的上游客户端（首次调用时在当前事件循环中创建）
+
+    Raises:
+        UpstreamTokenMissing: 当 AI_BUILDER_TOKEN 未配置时
+    """
+    global _client
+    if _client is None:
+        token = get_token()
+        if not token:
+            raise UpstreamTokenMissing("AI_BUILDER_TOKEN 未配置")
+        _client = httpx.AsyncClient(
+            headers=_build_headers(token),
+            limits=_pool_limits(),
+            timeout=httpx.Timeout(CHAT_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT)
+        )
+    return _client
+
+
+async def post_json(
+    url: str,
+    payload: dict,
+    timeout: float,
+    breaker: Optional[CircuitBreaker] = None,
+    admission: Optional[AdmissionController] = None
+) -> dict:
+    """
+    通过共享客户端发送 POST 请求并返回 JSON
+
+    指定 breaker 时经过该熔断器，并对可重试的错误按退避策略重试；指定
+    admission 时整个调用（包括重试）期间占用一个并发名额。
+
+    Raises:
+        UpstreamTokenMissing: 当 AI_BUILDER_TOKEN 未配置时
+        admission.AdmissionRejected: 当排队超限时
+        resilience.CircuitOpenError: 当熔断器打开时
+        httpx.HTTPError: 当请求失败或返回非 2xx 状态码时
+    """
+    client = get_client()
+
+    async def send() -> dict:
+        response = await client.post(
+            url,
+            json=payload,
+            timeout=httpx.Timeout(timeout, connect=UPSTREAM_CONNECT_TIMEOUT),
+            extensions={"trace": pool_stats.trace}
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def call() -> dict:
+        if breaker is None:
+            return await send()
+        return await call_with_retry(breaker, send)
+
+    if admission is None:
+        return await call()
+    async with admission.slot():
+        return await call()
+
+
+async def post_chat(payload: dict, timeout: float = CHAT_TIMEOUT) -> dict:
+    """调用 AI Builder Space 的 chat/completions 接口"""
+    return await post_json(AI_BUILDER_CHAT_ENDPOINT, payload, timeout, breakers["chat"], llm_admission)
+
+
+async def post_search(payload: dict, timeout: float = SEARCH_TIMEOUT) -> dict:
+    """调用 AI Builder Space 的 search 接口"""
+    return await post_json(AI_BUILDER_SEARCH_ENDPOINT, payload, timeout, breakers["search"], search_admission)
+
+
+async def stream_chat(payload: dict, timeout: float = CHAT_TIMEOUT) -> AsyncIterator[dict]:
+    """
+    以流式方式调用 chat/completions（stream: true），逐个产出上游 SSE 数据块
+
+    如果上游没有按 SSE 返回（例如不支持流式），则把完整 JSON 响应转换成一个
+    等价的数据块产出，调用方无需区分。
+
+    建立连接和收到响应头之前的失败经过 chat 熔断器重试；开始产出数据块之后
+    的错误直接抛给调用方（已经转发给客户端的内容无法撤回）。整个流读完之前
+    占用一个 LLM 并发名额。
+
+    Raises:
+        UpstreamTokenMissing: 当 AI_BUILDER_TOKEN 未配置时
+        admission.AdmissionRejected: 当排队超限时
+        resilience.CircuitOpenError: 当熔断器打开时
+        httpx.HTTPError: 当请求失败或返回非 2xx 状态码时
+    """
+    client = get_client()
+
+    async def open_stream() -> httpx.Response:
+        request = client.build_request(
+            "POST",
+            AI_BUILDER_CHAT_ENDPOINT,
+            json={**payload, "stream": True},
+            timeout=httpx.Timeout(timeout, connect=UPSTREAM_CONNECT_TIMEOUT),
+            extensions={"trace": pool_stats.trace}
+        )
+        response = await client.send(request, stream=True)
+        if response.is_error:
+            await response.aread()
+            await response.aclose()
+        response.raise_for_status()
+        return response
+
+    async with llm_admission.slot():
+        response = await call_with_retry(breakers["chat"], open_stream)
+        try:
+            if "text/event-stream" not in response.headers.get("content-type", ""):
+                yield response_to_chunk(json.loads(await response.aread()))
+                return
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if not data:
+                    continue
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
+        finally:
+            await response.aclose()
+
+
+def response_to_chunk(data: dict) -> dict:
+    """把非流式的完整响应转换成一个等价的流式数据块（message 改为 delta）"""
+    chunk = {key: value for key, value in data.items() if key != "choices"}
+    chunk["choices"] = [
+        {**{key: value for key, value in choice.items() if key != "message"}, "delta": choice.get("message", {})}
+        for choice in data.get("choices", [])
+    ]
+    return chunk
+
+
+class ChatStreamAssembler:
+    """
+    把流式响应的增量（delta）组装成完整消息
+
+    content 直接拼接；tool_calls 按 index 合并，id/name 取首次出现的值，
+    arguments 逐段拼接。
+    """
+
+    def __init__(self):
+        self.content = ""
+        self.tool_calls_by_index = {}
+        self.finish_reason = None
+        self.usage = None
+        self.model = None
+
+    def add(self, chunk: dict) -> str:
+        """
+        合并一个数据块
+
+        Returns:
+            str: 本数据块中的新增文本内容（没有则为空字符串）
+        """
+        if chunk.get("model"):
+            self.model = chunk["model"]
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+
+        choices = chunk.get("choices") or []
+        if not choices:
+            return ""
+        choice = choices[0]
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+
+        delta = choice.get("delta") or {}
+        for tc_delta in delta.get("tool_calls") or []:
+            index = tc_delta.get("index", len(self.tool_calls_by_index))
+            tool_call = self.tool_calls_by_index.setdefault(index, {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tc_delta.get("id"):
+                tool_call["id"] = tc_delta["id"]
+            if tc_delta.get("type"):
+                tool_call["type"] = tc_delta["type"]
+            function_delta = tc_delta.get("function") or {}
+            if function_delta.get("name"):
+                tool_call["function"]["name"] += function_delta["name"]
+            if function_delta.get("arguments"):
+                tool_call["function"]["arguments"] += function_delta["arguments"]
+
+        content = delta.get("content") or ""
+        self.content += content
+        return content
+
+    @property
+    def tool_calls(self) -> list:
+        return [self.tool_calls_by_index[i] for i in sorted(self.tool_calls_by_index)]
+
+    def to_response(self) -> dict:
+        """转换成与非流式调用相同格式的完整响应"""
+        message = {"role": "assistant", "content": self.content or None}
+        if self.tool_calls_by_index:
+            message["tool_calls"] = self.tool_calls
+        return {
+            "model": self.model,
+            "choices": [{"index": 0, "message": message, "finish_reason": self.finish_reason}],
+            "usage": self.usage
+        }
+
+
+def get_stats() -> dict:
+    """返回连接池配置和统计信息"""
+    return {
+        "limits": {
+            "max_connections": UPSTREAM_MAX_CONNECTIONS,
+            "max_keepalive_connections": UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            "keepalive_expiry": UPSTREAM_KEEPALIVE_EXPIRY
+        },
+        "client_initialized": _client is not None,
+        **pool_stats.snapshot(),
+        "breakers": {name: breaker.get_stats() for name, breaker in breakers.items()}
+    }
+
+
+async def close():
+    """关闭共享客户端，释放连接池（应用关闭时调用）"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None